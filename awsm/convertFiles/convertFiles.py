@@ -6,6 +6,72 @@ import numpy as np
 import netCDF4 as nc
 import glob
 from datetime import datetime
+from concurrent.futures import ProcessPoolExecutor
+
+from awsm.interface import pysnobal_io as io_mod
+
+# SMRF files in the order of the bands in the input and ppt images
+NC2IPW_INPUTS = ['thermal', 'air_temp', 'vapor_pressure', 'wind_speed',
+                 'net_solar']
+NC2IPW_PPT = ['precip', 'percent_snow', 'snow_density', 'precip_temp']
+
+
+def write_ipw_step(t, in_bands, ppt_bands, sun_up, geo, nbits, in_path,
+                   in_pathp, soil_temp):
+    """
+    Write the iSnobal input image and the precip image, if any, for one time
+    step. This is a module function so it can be run in another process.
+
+    Args:
+        t:          water year hour of the time step
+        in_bands:   thermal, air_temp, vapor_pressure, wind_speed and
+                    net_solar images
+        ppt_bands:  precip, percent_snow, snow_density and precip_temp
+                    images or None if there is no precip
+        sun_up:     add the net_solar band
+        geo:        arguments for the IPW geo header
+        nbits:      number of bits for the IPW images
+        in_path:    directory for the input images
+        in_pathp:   directory for the precip images
+        soil_temp:  soil temperature
+
+    Returns:
+        line for the ppt_desc file or None if there is no precip
+    """
+
+    trad_step, ta_step, ea_step, wind_step, sn_step = in_bands
+    tg_step = np.ones_like(trad_step)*(soil_temp)  # ground temp
+
+    in_step = os.path.join(in_path, 'in.%04i' % (t))
+
+    i = ipw.IPW()
+    i.new_band(trad_step)
+    i.new_band(ta_step)
+    i.new_band(ea_step)
+    i.new_band(wind_step)
+    i.new_band(tg_step)
+
+    # add solar if the sun is up
+    if sun_up:
+        i.new_band(sn_step)
+
+    i.add_geo_hdr(*geo)
+    i.write(in_step, nbits)
+
+    # only output if precip
+    line = None
+    if ppt_bands is not None:
+        in_stepp = os.path.join(os.path.abspath(in_pathp),
+                                'ppt.4b_%04i' % (t))
+        i = ipw.IPW()
+        for band in ppt_bands:
+            i.new_band(band)
+        i.add_geo_hdr(*geo)
+        i.write(in_stepp, nbits)
+        line = '%i %s\n' % (t, in_stepp)
+
+    return line
+
 
 def nc2ipw_mea(myawsm, runtype):
     '''
@@ -14,6 +80,10 @@ def nc2ipw_mea(myawsm, runtype):
     images in the 'input' and 'ppt_4b' directories. Also writes the  ppt_desc
     file.
 
+    The SMRF files are read in blocks of ``convert_block_size`` time steps
+    with one read per variable, which bounds the memory used. With more than
+    one ``convert_workers`` the images are written from a process pool.
+
     Args:
         myawsm: AWSM instance
         runtype: either 'smrf' for standard run or 'forecast' for gridded data run
@@ -32,131 +102,129 @@ def nc2ipw_mea(myawsm, runtype):
     tt = myawsm.start_date - myawsm.wy_start
     smrfpath = myawsm.paths
     datapath = myawsm.pathdd
-    f = open(myawsm.ppt_desc, 'w')
 
     offset = tt.days*24 + tt.seconds//3600  # start index for the input file
 
     # File paths
-    th = os.path.join(smrfpath, 'thermal.nc')
-    th_var = 'thermal'
-    ta = os.path.join(smrfpath, 'air_temp.nc')
-    ta_var = 'air_temp'
-    ea = os.path.join(smrfpath, 'vapor_pressure.nc')
-    ea_var = 'vapor_pressure'
-    wind = os.path.join(smrfpath, 'wind_speed.nc')
-    wind_var = 'wind_speed'
-    sn = os.path.join(smrfpath, 'net_solar.nc')
-    sn_var = 'net_solar'
-
     in_path = os.path.join(datapath, 'input/')
-
-    mp = os.path.join(smrfpath, 'precip.nc')
-    mp_var = 'precip'
-    ps = os.path.join(smrfpath, 'percent_snow.nc')
-    ps_var = 'percent_snow'
-    rho = os.path.join(smrfpath, 'snow_density.nc')
-    rho_var = 'snow_density'
-    tp = os.path.join(smrfpath, 'precip_temp.nc')
-    tp_var = 'precip_temp'
-
     in_pathp = os.path.join(datapath, 'ppt_4b')
 
-    th_file = nc.Dataset(th, 'r')
-    ta_file = nc.Dataset(ta, 'r')
-    ea_file = nc.Dataset(ea, 'r')
-    wind_file = nc.Dataset(wind, 'r')
-    sn_file = nc.Dataset(sn, 'r')
-    mp_file = nc.Dataset(mp, 'r')
-    ps_file = nc.Dataset(ps, 'r')
-    rho_file = nc.Dataset(rho, 'r')
-    tp_file = nc.Dataset(tp, 'r')
-
-    N = th_file.variables[th_var].shape[0]
-    # timeStep = np.arange(0,N)        # timesteps loop through
-    timeStep = np.arange(offset, N+offset)        # timesteps loop through
-    # pbar = progressbar.ProgressBar(max_value=len(timeStep)).start()
-    j = 0
-    for idxt, t in enumerate(timeStep):
-
-        if j == int(len(timeStep)/4):
-            myawsm._logger.info("25 percent finished with "
-                                "making IPW input files!")
-        if j == int(len(timeStep)/2):
-            myawsm._logger.info("50 percent finished with "
-                                "making IPW input files!")
-        if j == int(3*len(timeStep)/4):
-            myawsm._logger.info("75 percent finished with "
-                                "making IPW input files!")
-
-        # print('idxt: {} t: {}'.format(idxt, t))
-        trad_step = th_file.variables[th_var][idxt, :]
-        ta_step = ta_file.variables[ta_var][idxt, :]
-        ea_step = ea_file.variables[ea_var][idxt, :]
-        wind_step = wind_file.variables[wind_var][idxt, :]
-        sn_step = sn_file.variables[sn_var][idxt, :]
-        mp_step = mp_file.variables[mp_var][idxt, :]
-        tg_step = np.ones_like(mp_step)*(myawsm.soil_temp)  # ground temp
-
-        in_step = os.path.join(in_path, 'in.%04i' % (t))
+    nc_files = {}
+    for v in NC2IPW_INPUTS + NC2IPW_PPT:
+        nc_files[v] = nc.Dataset(os.path.join(smrfpath, '{}.nc'.format(v)),
+                                 'r')
+
+    geo = ([myawsm.topo.u, myawsm.topo.v],
+           [myawsm.topo.du, myawsm.topo.dv],
+           myawsm.topo.units, myawsm.csys)
+
+    executor = None
+    if myawsm.convert_workers > 1:
+        myawsm._logger.info('writing ipw files with {} processes'
+                            .format(myawsm.convert_workers))
+        executor = ProcessPoolExecutor(max_workers=myawsm.convert_workers)
+
+    N = nc_files['thermal'].variables['thermal'].shape[0]
+    block_size = max(myawsm.convert_block_size, 1)
+    ppt_lines = {}
+    futures = []
+    try:
+        for start in range(0, N, block_size):
+            end = min(start + block_size, N)
+
+            # read the block for each variable at once
+            in_block = [nc_files[v].variables[v][start:end, :]
+                        for v in NC2IPW_INPUTS]
+            mp_block = nc_files['precip'].variables['precip'][start:end, :]
+
+            # time steps with the sun up and with precip
+            sun_up = np.sum(in_block[-1], axis=(1, 2)) > 0
+            has_ppt = np.sum(mp_block, axis=(1, 2)) > 0
+
+            ppt_block = None
+            if np.any(has_ppt):
+                ppt_block = [mp_block] + \
+                    [nc_files[v].variables[v][start:end, :]
+                     for v in NC2IPW_PPT[1:]]
+
+            # wait for the previous block before queueing more images
+            for t, future in futures:
+                ppt_lines[t] = future.result()
+            futures = []
+
+            for idxt in range(end - start):
+                t = start + idxt + offset
+                in_bands = [b[idxt] for b in in_block]
+                ppt_bands = None
+                if has_ppt[idxt]:
+                    ppt_bands = [b[idxt] for b in ppt_block]
+
+                args = (t, in_bands, ppt_bands, sun_up[idxt], geo,
+                        myawsm.nbits, in_path, in_pathp, myawsm.soil_temp)
+                if executor is None:
+                    ppt_lines[t] = write_ipw_step(*args)
+                else:
+                    futures.append((t, executor.submit(write_ipw_step,
+                                                       *args)))
+
+            myawsm._logger.info('{:.0f} percent finished with making IPW '
+                                'input files'.format(100.0*end/N))
+
+        for t, future in futures:
+            ppt_lines[t] = future.result()
+
+    finally:
+        if executor is not None:
+            executor.shutdown(wait=True)
+
+        for v in nc_files.keys():
+            nc_files[v].close()
+
+    # write the ppt_desc file in time order
+    with open(myawsm.ppt_desc, 'w') as f:
+        for t in sorted(ppt_lines.keys()):
+            if ppt_lines[t] is not None:
+                f.write(ppt_lines[t])
 
-        i = ipw.IPW()
-        i.new_band(trad_step)
-        i.new_band(ta_step)
-        i.new_band(ea_step)
-        i.new_band(wind_step)
-        i.new_band(tg_step)
-
-        # add solar if the sun is up
-        if np.sum(sn_step) > 0:
-            i.new_band(sn_step)
-
-        i.add_geo_hdr([myawsm.topo.u, myawsm.topo.v],
-                      [myawsm.topo.du, myawsm.topo.dv],
-                      myawsm.topo.units, myawsm.csys)
-        i.write(in_step, myawsm.nbits)
-
-        # only output if precip
-        if np.sum(mp_step) > 0:
-            ps_step = ps_file.variables[ps_var][idxt, :]
-            rho_step = rho_file.variables[rho_var][idxt, :]
-            tp_step = tp_file.variables[tp_var][idxt, :]
-            in_stepp = os.path.join(os.path.abspath(in_pathp),
-                                    'ppt.4b_%04i' % (t))
-            i = ipw.IPW()
-            i.new_band(mp_step)
-            i.new_band(ps_step)
-            i.new_band(rho_step)
-            i.new_band(tp_step)
-            i.add_geo_hdr([myawsm.topo.u, myawsm.topo.v],
-                          [myawsm.topo.du, myawsm.topo.dv],
-                          myawsm.topo.units, myawsm.csys)
-            i.write(in_stepp, myawsm.nbits)
-            f.write('%i %s\n' % (t, in_stepp))
-
-        j += 1
-        # pbar.update(j)
-
-    th_file.close()
-    ta_file.close()
-    ea_file.close()
-    wind_file.close()
-    sn_file.close()
-    mp_file.close()
-    ps_file.close()
-    rho_file.close()
-    tp_file.close()
-    f.close()
-    # pbar.finish()
     myawsm._logger.info("finished making the ipw "
                         "input and ppt files from NetCDF files")
 
 
+def read_ipw_output(snow_file):
+    """
+    Read the snow file and the matching em file for a water year hour. This
+    is a module function so it can be run in another process.
+
+    Args:
+        snow_file:  path to the snow IPW file
+
+    Returns:
+        tuple of the water year hour, the snow bands and the em bands
+    """
+
+    nm = os.path.basename(snow_file)
+    head = os.path.dirname(snow_file)
+    hr = int(nm.split('.')[1])
+
+    i = ipw.IPW(snow_file)
+    snow_bands = [b.data for b in i.bands]
+
+    i_em = ipw.IPW(os.path.join(head, 'em.%04i' % (hr)))
+    em_bands = [b.data for b in i_em.bands]
+
+    return hr, snow_bands, em_bands
+
+
 def ipw2nc_mea(myawsm, runtype):
     '''
     Function to create netcdf files from iSnobal output. Reads the snow and em
     ouptuts in the 'output' folder and stores them in snow.nc and em.nc one
     directory up.
 
+    The files are decoded a block of time steps at a time, in a process pool
+    with more than one ``convert_workers``, and each block is written to the
+    netCDF files at once.
+
     Args:
         myawsm: AWSM instance
         runtype: either 'smrf' for standard run or 'forecast' for gridded data run
@@ -178,6 +246,17 @@ def ipw2nc_mea(myawsm, runtype):
     x = myawsm.topo.x
     y = myawsm.topo.y
 
+    # get all the files in the directory
+    d = sorted(glob.glob("%s/snow*" % myawsm.pathro),
+               key=os.path.getmtime)
+
+    d.sort(key=lambda f: os.path.splitext(f))
+    # find a drop any netcdfs in directory
+    d = [ddp for ddp in d if '.nc' not in ddp]
+
+    # storage for the output variables, chunked for the length of the run
+    profile = io_mod.get_storage_profile(myawsm)
+
     # ========================================================================
     # NetCDF EM image
     # ========================================================================
@@ -224,7 +303,7 @@ def ipw2nc_mea(myawsm, runtype):
 
     # em image
     for i, v in enumerate(m['name']):
-        em.createVariable(v, 'f', dimensions[:3], chunksizes=(24, 10, 10))
+        io_mod.create_output_variable(em, v, profile, len(d))
         setattr(em.variables[v], 'units', m['units'][i])
         setattr(em.variables[v], 'description', m['description'][i])
 
@@ -279,7 +358,7 @@ def ipw2nc_mea(myawsm, runtype):
     # snow image
     for i, v in enumerate(s['name']):
 
-        snow.createVariable(v, 'f', dimensions[:3], chunksizes=(6, 10, 10))
+        io_mod.create_output_variable(snow, v, profile, len(d))
         setattr(snow.variables[v], 'units', s['units'][i])
         setattr(snow.variables[v], 'description', s['description'][i])
 
@@ -291,67 +370,61 @@ def ipw2nc_mea(myawsm, runtype):
         snow.setncattr_string('SMRF version', myawsm.smrf_version)
 
     # =======================================================================
-    # Get all files in the directory, open ipw file, and add to netCDF
+    # Decode the ipw files and add to netCDF a block of time steps at a time
     # =======================================================================
 
-    # get all the files in the directory
-    d = sorted(glob.glob("%s/snow*" % myawsm.pathro),
-               key=os.path.getmtime)
-
-    d.sort(key=lambda f: os.path.splitext(f))
-    # find a drop any netcdfs in directory
-    d = [ddp for ddp in d if '.nc' not in ddp]
-    # pbar = progressbar.ProgressBar(max_value=len(d)).start()
-    j = 0
-
-    for idf, f in enumerate(d):
-        # print out counter at certain percentages. pbar doesn't play nice
-        # with logging
-        if j == int(len(d)/4):
-            myawsm._logger.info("25 percent finished with "
-                                "making NetCDF files!")
-        if j == int(len(d)/2):
-            myawsm._logger.info("50 percent finished with "
-                                "making NetCDF files!")
-        if j == int(3*len(d)/4):
-            myawsm._logger.info("75 percent finished with "
-                                "making NetCDF files!")
-
-        # get the hr
-        nm = os.path.basename(f)
-        head = os.path.dirname(f)
-        hr = int(nm.split('.')[1])
-        # hr = int(hr)
-        snow.variables['time'][j] = hr  # +1
-        em.variables['time'][j] = hr  # +1
-
-        # Read the IPW file
-        i = ipw.IPW(f)
-
-        # output to the snow netcdf file
-        for b, var in enumerate(s['name']):
-            snow.variables[var][j, :] = i.bands[b].data
-
-        # output to the em netcdf file
-        # emFile = "%s/%s.%04i" % (head, 'em', hr)
-        emFile = os.path.join(head, 'em.%04i' % (hr))
-        i_em = ipw.IPW(emFile)
-        for b, var in enumerate(m['name']):
-            em.variables[var][j, :] = i_em.bands[b].data
-
-        snow.setncattr_string('last modified', h)
-        snow.setncattr_string('AWSM version', myawsm.gitVersion)
-        if myawsm.do_smrf:
-            snow.setncattr_string('SMRF version', myawsm.smrf_version)
+    executor = None
+    if myawsm.convert_workers > 1:
+        myawsm._logger.info('reading ipw files with {} processes'
+                            .format(myawsm.convert_workers))
+        executor = ProcessPoolExecutor(max_workers=myawsm.convert_workers)
+
+    def read_block(files):
+        if executor is None:
+            return [read_ipw_output(f) for f in files]
+        return [executor.submit(read_ipw_output, f) for f in files]
+
+    # write a time chunk at a time
+    nb = snow.variables[s['name'][0]].chunking()[0]
+    blocks = [d[b:b + nb] for b in range(0, len(d), nb)]
+    try:
+        j = 0
+        pending = read_block(blocks[0]) if len(blocks) > 0 else []
+        for idb in range(len(blocks)):
+            if executor is None:
+                outputs = pending
+            else:
+                outputs = [future.result() for future in pending]
+
+            # start decoding the next block while this one is written
+            if idb + 1 < len(blocks):
+                pending = read_block(blocks[idb + 1])
+
+            nb = len(outputs)
+            hrs = [o[0] for o in outputs]
+            snow.variables['time'][j:j + nb] = hrs
+            em.variables['time'][j:j + nb] = hrs
+
+            for b, var in enumerate(s['name']):
+                snow.variables[var][j:j + nb, :] = io_mod.pack_values(
+                    snow.variables[var], np.array([o[1][b] for o in outputs]))
+
+            for b, var in enumerate(m['name']):
+                em.variables[var][j:j + nb, :] = io_mod.pack_values(
+                    em.variables[var], np.array([o[2][b] for o in outputs]))
+
+            j += nb
+            myawsm._logger.info('{:.0f} percent finished with making NetCDF '
+                                'files'.format(100.0*j/len(d)))
+
+    finally:
+        if executor is not None:
+            executor.shutdown(wait=True)
 
         em.sync()
         snow.sync()
-        j += 1
-
-        # pbar.update(j)
-    # pbar.finish()
-    snow.close()
-    em.close()
+        snow.close()
+        em.close()
 
     myawsm._logger.info("Finished making the NetCDF "
                         "files from iSnobal output!")
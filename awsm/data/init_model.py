@@ -7,7 +7,8 @@ from datetime import timedelta
 import pytz
 
 from spatialnc import ipw
-from smrf.utils import utils
+
+from awsm.utils import time_index
 
 C_TO_K = 273.16
 FREEZE = C_TO_K
@@ -44,7 +45,7 @@ class modelInit():
     """
 
     def __init__(self, logger, cfg, topo, start_wyhr, pathro, pathrr,
-                 pathinit, wy_start):
+                 pathinit, wy_start, state=None):
         """
         Args:
             logger:         AWSM logger
@@ -55,6 +56,8 @@ class modelInit():
             pathrr:         run<date> directory
             pathinit:       iSnobal init directory
             wy_start:       datetime of water year start date
+            state:          PySnobal state at the end of the previous run,
+                            from :func:`awsm.interface.ipysnobal.get_model_state`
 
         """
         # get logger
@@ -87,6 +90,10 @@ class modelInit():
         self.wy_start = wy_start
         self.tzinfo = pytz.timezone(cfg['time']['time_zone'])
 
+        # state kept in memory from the previous run
+        self.state = state
+        self.state_check = cfg['awsm system']['daily_state_check']
+
         # dictionary to store init data
         self.init = {}
         self.init['x'] = self.topo.x
@@ -127,6 +134,9 @@ class modelInit():
         # get crash restart if restart_crash
         if self.restart_crash:
             self.get_crash_init()
+        # use the state from the previous run if it is the start of this run
+        elif self.state is not None and self.check_state_init():
+            self.get_state_init()
         # if we have no init info, make zero init
         elif self.init_file is None:
             self.get_zero_init()
@@ -292,49 +302,113 @@ class modelInit():
         """
         Get init fields from output netcdf at correct time index
         """
-        i = nc.Dataset(self.init_file)
-
-        # find timestep indices to grab
-        time = i.variables['time'][:]
-        t_units = i.variables['time'].units
-        nc_calendar = i.variables['time'].calendar
-        nc_dates = nc.num2date(time, t_units, nc_calendar)
-
         if self.restart_crash:
             tmpwyhr = self.restart_hr
         else:
             # start date water year hour
             tmpwyhr = self.start_wyhr
 
-        # make sure we account for time zones
-        if hasattr(i.variables['time'], 'time_zone'):
-            tzn = pytz.timezone(i.variables['time'].time_zone)
-            nc_dates = [ndt.replace(tzinfo=tzn) for ndt in nc_dates]
-            nc_dates = [ndt.replace(tzinfo=self.tzinfo) for ndt in nc_dates]
-        else:
-            nc_dates = [ndt.replace(tzinfo=self.tzinfo) for ndt in nc_dates]
-
-        # find water year hours
-        nc_wyhr = np.array([utils.water_day(ndt)[0]*24.0 for ndt in nc_dates])
+        fields, nc_wyhr, diff = self.read_netcdf_out(tmpwyhr)
 
-        # find closest location that the water year hours equal the restart hr
-        idt = np.argmin(np.absolute(nc_wyhr - tmpwyhr))  # returns index
-
-        if np.min(np.absolute(nc_wyhr - tmpwyhr)) > 24.0:
+        if diff > 24.0:
             # raise ValueError('No time in resatrt file that is within a day of restart time')
             self.logger.error('No time in restart file that is within a day of restart time')
 
-        self.logger.warning('Initializing PySnobal with state from water year hour {}'.format(nc_wyhr[idt]))
+        self.logger.warning('Initializing PySnobal with state from water year hour {}'.format(nc_wyhr))
+
+        self.init.update(fields)
+
+    def read_netcdf_out(self, wyhr):
+        """
+        Read the state fields from the time step of an output netcdf closest
+        to a water year hour
+
+        Args:
+            wyhr:   water year hour to read
+
+        Returns:
+            tuple of the dictionary of init fields, the water year hour of
+            the time step that was read and the difference in hours
+        """
 
-        self.init['z_s'] = i.variables['thickness'][idt, :]
-        self.init['rho'] = i.variables['snow_density'][idt, :]
-        self.init['T_s_0'] = i.variables['temp_surf'][idt, :]
-        self.init['T_s'] = i.variables['temp_snowcover'][idt, :]
-        self.init['T_s_l'] = i.variables['temp_lower'][idt, :]
-        self.init['h2o_sat'] = i.variables['water_saturation'][idt, :]
+        # find closest location that the water year hours equal the restart
+        # hr, the hours are in the wall clock time of the file so the time
+        # zone does not change them
+        idt, nc_wyhr, diff = time_index.find_time_index(self.init_file, wyhr)
+
+        fields = {}
+        i = nc.Dataset(self.init_file)
+        fields['z_s'] = i.variables['thickness'][idt, :]
+        fields['rho'] = i.variables['snow_density'][idt, :]
+        fields['T_s_0'] = i.variables['temp_surf'][idt, :]
+        fields['T_s'] = i.variables['temp_snowcover'][idt, :]
+        fields['T_s_l'] = i.variables['temp_lower'][idt, :]
+        fields['h2o_sat'] = i.variables['water_saturation'][idt, :]
 
         i.close()
 
+        return fields, nc_wyhr, diff
+
+    def check_state_init(self):
+        """
+        Check the state kept in memory from the previous run can initialize
+        this run. The state must be from the start of the run and, if the
+        init file is the output of the previous run and daily_state_check is
+        set, match the last output in the file. Otherwise the init file is
+        used.
+
+        Returns:
+            True if the state can be used
+        """
+
+        if self.model_type not in ['ipysnobal', 'smrf_ipysnobal']:
+            return False
+
+        if abs(self.state['wyhr'] - self.start_wyhr) > 1e-6:
+            self.logger.warning('State in memory is from water year hour {} '
+                                'not the start of the run {}, using the init '
+                                'file'.format(self.state['wyhr'],
+                                              self.start_wyhr))
+            return False
+
+        if not self.state_check or self.init_type != 'netcdf_out' or \
+                self.init_file is None or not os.path.isfile(self.init_file):
+            return True
+
+        # outputs are written an hour before the time step, so the state at
+        # the start of the run is the output an hour before it
+        fields, nc_wyhr, diff = self.read_netcdf_out(self.start_wyhr - 1)
+        if diff > 0:
+            self.logger.warning('No output in {} an hour before the start of '
+                                'the run, not checking the state in memory'
+                                .format(self.init_file))
+            return True
+
+        for k, v in fields.items():
+            disk = np.ma.filled(v.astype(np.float64), np.nan)
+            mem = self.state['fields'][k]
+            # outputs are saved as float32 or packed to 16 bit integers
+            tol = 1e-4 * max(np.nanmax(np.absolute(disk)), 1.0)
+            valid = np.isfinite(disk)
+            err = np.max(np.absolute(disk[valid] - mem[valid]), initial=0.0)
+            if err > tol:
+                self.logger.warning('State in memory differs from {} by {} '
+                                    'for {}, using the init file'
+                                    .format(self.init_file, err, k))
+                return False
+
+        return True
+
+    def get_state_init(self):
+        """
+        Set init fields from the state kept in memory from the previous run
+        """
+        self.logger.info('Initializing PySnobal with the state in memory from '
+                         '{}'.format(self.state['time']))
+
+        for k, v in self.state['fields'].items():
+            self.init[k] = v.copy()
+
     def zero_crash_depths(self, depth_thresh, z_s, rho, T_s_0, T_s_l, T_s, h2o_sat):
         """
         Zero snow depth under certain threshold and deal with associated variables.
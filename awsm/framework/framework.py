@@ -35,6 +35,7 @@ from awsm.interface import interface as smin
 from awsm.interface import smrf_ipysnobal as smrf_ipy
 from awsm.interface import ingest_data
 from awsm.utils import utilities as awsm_utils
+from awsm.utils import static_fields
 from awsm.data.init_model import modelInit
 import awsm.reporting.reportingtools as retools
 
@@ -49,11 +50,14 @@ class AWSM():
     Attributes:
     """
 
-    def __init__(self, config):
+    def __init__(self, config, topo=None, state=None):
         """
         Initialize the model, read config file, start and end date, and logging
         Args:
             config: string path to the config file or inicheck UserConfig instance
+            topo:   topo instance to use instead of loading it again
+            state:  PySnobal state at the end of the previous run to
+                    initialize the model from
         """
         # read the config file and store
         awsm_mcfg = MasterConfig(modules = 'awsm')
@@ -218,6 +222,27 @@ class AWSM():
         # pysnobal output variables
         self.pysnobal_output_vars = self.config['awsm system']['variables']
         self.pysnobal_output_vars = [wrd.lower() for wrd in self.pysnobal_output_vars]
+        # number of output time steps to buffer before writing
+        self.output_buffer = self.config['awsm system']['output_buffer']
+        # write outputs in a background thread
+        self.output_thread = self.config['awsm system']['output_thread']
+        self.output_queue_size = \
+            self.config['awsm system']['output_queue_size']
+        # storage profile for the output netCDF files
+        self.output_chunks = self.config['awsm system']['output_chunks']
+        self.output_compression = \
+            self.config['awsm system']['output_compression']
+        self.output_shuffle = self.config['awsm system']['output_shuffle']
+        self.output_significant_digits = \
+            self.config['awsm system']['output_significant_digits']
+        self.output_dtype = self.config['awsm system']['output_dtype']
+        # processes for converting between netCDF and IPW
+        self.convert_workers = self.config['awsm system']['convert_workers']
+        self.convert_block_size = \
+            self.config['awsm system']['convert_block_size']
+        # processes running the hourly forecasts of a daily run
+        self.forecast_processes = \
+            self.config['awsm system']['forecast_processes']
         # snow and emname
         self.snow_name = self.config['awsm system']['snow_name']
         self.em_name = self.config['awsm system']['em_name']
@@ -242,6 +267,30 @@ class AWSM():
                 self.config['files']['init_type']
             self.forcing_data_type = \
                 self.config['ipysnobal']['forcing_data_type']
+            self.forcing_read_steps = \
+                self.config['ipysnobal']['forcing_read_steps']
+            self.forcing_cache_size = \
+                self.config['ipysnobal']['forcing_cache_size']
+            self.ipw_processes = self.config['ipysnobal']['ipw_processes']
+            self.active_cells_only = \
+                self.config['ipysnobal']['active_cells_only']
+            self.prefetch_depth = self.config['ipysnobal']['prefetch_depth']
+            self.prefetch_threads = \
+                self.config['ipysnobal']['prefetch_threads']
+            self.smrf_pipeline_depth = \
+                self.config['ipysnobal']['smrf_pipeline_depth']
+            self.solar_cache_dir = self.config['ipysnobal']['solar_cache_dir']
+            self.state_on_disk = self.config['ipysnobal']['state_on_disk']
+            self.checkpoint_frequency = \
+                self.config['ipysnobal']['checkpoint_frequency']
+            self.checkpoint_file = self.config['ipysnobal']['checkpoint_file']
+            self.restart_from_checkpoint = \
+                self.config['ipysnobal']['restart_from_checkpoint']
+            if self.restart_from_checkpoint and \
+                    self.model_type != 'ipysnobal':
+                raise ValueError('restart_from_checkpoint needs the '
+                                 'ipysnobal model_type, SMRF can not restart '
+                                 'from a checkpoint')
 
         # parameters needed for restart procedure
         self.restart_run = False
@@ -260,6 +309,11 @@ class AWSM():
         if self.update_depth:
             self.update_file = self.config['update depth']['update_file']
             self.update_buffer = self.config['update depth']['buffer']
+            self.update_interpolation = \
+                self.config['update depth']['interpolation']
+            self.update_neighbors = self.config['update depth']['neighbors']
+            self.update_tile_size = self.config['update depth']['tile_size']
+            self.update_processes = self.config['update depth']['processes']
             self.flight_numbers = self.config['update depth']['flight_numbers']
             # if flights to use is not list, make it a list
             if self.flight_numbers is not None:
@@ -274,6 +328,11 @@ class AWSM():
         # Make rigid directory structure
         self.mk_directories()
 
+        # checkpoints go in the run directory by default
+        if self.model_type in ['ipysnobal', 'smrf_ipysnobal'] and \
+                self.checkpoint_file is None:
+            self.checkpoint_file = os.path.join(self.pathrr, 'checkpoint.npz')
+
         # ################ Topo information ##################
         self.topotype = self.config['topo']['type']
 
@@ -283,8 +342,16 @@ class AWSM():
         self.nbits = int(self.config['grid']['nbits'])
         self.soil_temp = self.config['soil_temp']['temp']
         # get topo class
-        self.topo = mytopo(self.config['topo'], self.mask_isnobal,
-                           self.model_type, self.csys, self.pathdd)
+        if topo is None:
+            topo = mytopo(self.config['topo'], self.mask_isnobal,
+                          self.model_type, self.csys, self.pathdd)
+        self.topo = topo
+
+        # keep the static fields in read only memory mapped files
+        self.static_fields = None
+        if self.config['awsm system']['static_fields']:
+            self.static_fields = static_fields.StaticFields(self.pathrr)
+            static_fields.share_topo(self.static_fields, self.topo)
 
         # parse reporting section and make reporting folder
         # if self.do_report:
@@ -304,7 +371,14 @@ class AWSM():
         if self.model_type is not None:
             self.myinit = modelInit(self._logger, self.config, self.topo,
                                     self.start_wyhr, self.pathro, self.pathrr,
-                                    self.pathinit, self.wy_start)
+                                    self.pathinit, self.wy_start, state)
+            if self.static_fields is not None:
+                static_fields.share_init(self.static_fields, self.myinit.init)
+
+        # PySnobal state at the end of the run and the states kept for
+        # forecasts
+        self.model_state = None
+        self.forecast_states = None
 
     def parseReport(self):
         """
@@ -742,6 +816,9 @@ class AWSM():
         Provide some logging info about when AWSM was closed
         """
 
+        if self.static_fields is not None:
+            self.static_fields.close()
+
         self._logger.info('AWSM closed --> %s' % datetime.now())
 
 
@@ -811,6 +888,11 @@ def run_awsm_daily_ops(config_file):
     ndays = int((end_day-start_day).days) + 1
     date_list = [start_day + pd.to_timedelta(x, unit='D') for x in range(0, ndays)]
 
+    # topo and PySnobal state passed from one day to the next
+    in_memory = config.cfg['awsm system']['daily_state_in_memory']
+    topo = None
+    state = None
+
     # loop through daily runs and run awsm
     for idd, sd in enumerate(date_list):
         new_config = copy.deepcopy(config)
@@ -856,19 +938,29 @@ def run_awsm_daily_ops(config_file):
         new_config = cast_all_variables(new_config, new_config.mcfg)
 
         # run awsm for the day
-        run_awsm(new_config)
+        a = run_awsm(new_config, topo=topo, state=state)
+
+        if in_memory:
+            topo = a.topo
+            state = a.model_state
 
 
-def run_awsm(config):
+def run_awsm(config, topo=None, state=None):
     """
     Function that runs awsm how it should be operate for full runs.
 
     Args:
         config: string path to the config file or inicheck UserConfig instance
+        topo:   topo instance to use instead of loading it again
+        state:  PySnobal state at the end of the previous run to initialize
+                the model from
+
+    Returns:
+        AWSM instance that was run
     """
     start = datetime.now()
 
-    with AWSM(config) as a:
+    with AWSM(config, topo=topo, state=state) as a:
         if a.do_forecast:
             runtype = 'forecast'
         else:
@@ -927,6 +1019,7 @@ def run_awsm(config):
 
             a._logger.info('AWSM finished in: {}'.format(datetime.now() - start))
 
+    return a
 
 
 def can_i_run_awsm(config):
@@ -9,3 +9,5 @@ from . import smrf_ipysnobal
 from . import initialize_model
 from . import pysnobal_io
 from . import ingest_data
+from . import solar
+from . import forecast
@@ -0,0 +1,224 @@
+# -*- coding: utf-8 -*-
+"""
+Forecasts from each hour of a daily run
+
+The forecasts started from the hours of a day only depend on the state of
+the model at that hour, so they are set up from the state snapshots kept
+during the day's run and can run in separate processes. The processes are
+spawned, not forked, so they do not inherit the threads and locks of the
+day's run, and each forecast is passed to a process with the AWSM instance
+of the day. With static_fields the topo images are pickled as their files,
+so they stay shared however many processes run.
+"""
+
+import copy
+import logging
+import multiprocessing as mp
+
+import pandas as pd
+
+from smrf.utils import utils
+from awsm.data.init_model import modelInit
+from awsm.utils import static_fields
+
+
+def init_model(myawsm, state=None, share=True):
+    """
+    Initialize the model for the start date of an AWSM instance
+
+    Args:
+        myawsm: AWSM instance
+        state:  PySnobal state at the start date, the init file is used if
+                None
+        share:  put the init fields in the static fields of the run, if
+                any, replacing the init fields of the previous day
+    """
+
+    myawsm.myinit = modelInit(myawsm._logger, myawsm.config, myawsm.topo,
+                              myawsm.start_wyhr, myawsm.pathro, myawsm.pathrr,
+                              myawsm.pathinit, myawsm.wy_start, state)
+
+    if share and myawsm.static_fields is not None:
+        static_fields.share_init(myawsm.static_fields, myawsm.myinit.init)
+
+
+def forecast_awsm(myawsm, t, day_start, state):
+    """
+    Copy of the AWSM instance set up to run the forecast from a time step
+
+    Args:
+        myawsm:     AWSM instance of the day's run
+        t:          start of the forecast
+        day_start:  start of the day, for naming the outputs
+        state:      PySnobal state at t
+
+    Returns:
+        AWSM instance for the forecast
+    """
+
+    f = copy.copy(myawsm)
+
+    # each forecast has its own options and topo instance, the topo images
+    # are not changed by a run and are shared
+    f.ucfg = copy.deepcopy(myawsm.ucfg)
+    f.config = f.ucfg.cfg
+    f.topo = copy.copy(myawsm.topo)
+
+    # find hour from start of day
+    day_hour = int((t - day_start) / pd.to_timedelta(1, unit='h'))
+
+    # reset output names
+    f.snow_name = 'snow_{:02d}'.format(day_hour)
+    f.em_name = 'em_{:02d}'.format(day_hour)
+
+    # reset start and end days
+    f.start_date = t
+    f.end_date = t + pd.to_timedelta(f.n_forecast_hours, unit='h')
+
+    # recalculate start and end water year hour
+    tmp_date = f.start_date.replace(tzinfo=f.tzinfo)
+    tmp_end_date = f.end_date.replace(tzinfo=f.tzinfo)
+    f.start_wyhr = int(utils.water_day(tmp_date)[0]*24)
+    f.end_wyhr = int(utils.water_day(tmp_end_date)[0]*24)
+
+    # forecasts do not save their own snapshots or share the files of the
+    # day's run
+    f.forecast_states = None
+    f.checkpoint_frequency = 0
+    f.state_on_disk = False
+    f.model_state = None
+
+    # only the worker running the forecast uses its init fields
+    init_model(f, state, share=False)
+
+    return f
+
+
+def run_forecast(task):
+    """
+    Set up and run the forecast from a time step, in a worker process or
+    the AWSM process
+
+    Args:
+        task:   tuple of the AWSM instance of the day's run, the start of the
+                forecast, the start of the day and the state snapshots of the
+                day's run or None
+
+    Returns:
+        tuple of the output name and the start of the forecast
+    """
+
+    myawsm, t, day_start, states = task
+
+    state = None
+    if states is not None:
+        state = states.get(t)
+    if state is None:
+        myawsm._logger.warning('No state in memory at {}, initializing the '
+                               'forecast from the init file'.format(t))
+
+    f = forecast_awsm(myawsm, t, day_start, state)
+    f.run_smrf_ipysnobal()
+
+    return f.snow_name, f.start_date
+
+
+def log_config():
+    """
+    Level and log file of the root logger, for the worker processes
+
+    Returns:
+        tuple of the log level and the log file, None if logging to the
+        console
+    """
+
+    root = logging.getLogger()
+    logfile = None
+    for h in root.handlers:
+        if isinstance(h, logging.FileHandler):
+            logfile = h.baseFilename
+
+    return root.level, logfile
+
+
+def init_worker(level, logfile):
+    """
+    Log from a worker process to the log of the run
+
+    Args:
+        level:      log level
+        logfile:    log file, None to log to the console
+    """
+
+    if logfile is None:
+        logging.basicConfig(level=level)
+    else:
+        logging.basicConfig(filename=logfile, level=level)
+
+
+class ForecastScheduler():
+    """
+    Run the forecasts from each hour of a day, one after the other or in a
+    pool of spawned processes. Each forecast writes its own snow_HH and em_HH
+    files and is started from the state at its hour, so the results do not
+    depend on the number of processes.
+
+    Args:
+        myawsm:     AWSM instance of the day's run
+        processes:  number of forecasts to run at once
+        states:     :class:`~awsm.interface.pysnobal_io.StateSnapshots` of
+                    the day's run, the init file is used if None
+    """
+
+    def __init__(self, myawsm, processes=1, states=None):
+
+        self.myawsm = myawsm
+        self.processes = max(int(processes), 1)
+        self.states = states
+        self.forecasts = []
+
+    def add(self, t, day_start):
+        """
+        Add the forecast from a time step
+
+        Args:
+            t:          start of the forecast
+            day_start:  start of the day, for naming the outputs
+        """
+
+        self.forecasts.append((t, day_start))
+
+    def run(self):
+        """
+        Run all of the forecasts
+        """
+
+        # the forecasts are initialized from the snapshots, not the init or
+        # state of the day's run
+        day = copy.copy(self.myawsm)
+        day.myinit = None
+        day.model_state = None
+        day.forecast_states = None
+        tasks = [(day, t, day_start, self.states)
+                 for t, day_start in self.forecasts]
+
+        if self.processes == 1 or len(tasks) < 2:
+            for task in tasks:
+                run_forecast(task)
+
+        else:
+            self.myawsm._logger.info('Running {} forecasts in {} processes'
+                                     .format(len(tasks), self.processes))
+            ctx = mp.get_context('spawn')
+            pool = ctx.Pool(min(self.processes, len(tasks)),
+                            initializer=init_worker, initargs=log_config())
+            try:
+                for name, t in pool.imap(run_forecast, tasks):
+                    self.myawsm._logger.info('Finished forecast {} from {}'
+                                             .format(name, t))
+                pool.close()
+            finally:
+                pool.terminate()
+                pool.join()
+
+        self.forecasts = []
@@ -8,12 +8,382 @@ import netCDF4 as nc
 from collections import OrderedDict
 import glob
 from datetime import datetime
+from scipy.spatial import cKDTree
+from concurrent.futures import ProcessPoolExecutor
 
-from smrf.utils import utils
+from awsm.interface import pysnobal_io as io_mod
+from awsm.utils import time_index
+from awsm.utils.static_fields import StaticFields
 
 C_TO_K = 273.16
 FREEZE = C_TO_K
 
+
+def summed_area_table(data):
+    """
+    Summed area tables of the finite values of an image and of the number of
+    finite values. The tables have an extra row and column of zeros so the
+    sum over rows [r0, r1) and columns [c0, c1) is
+    ``t[r1, c1] - t[r0, c1] - t[r1, c0] + t[r0, c0]``.
+
+    Args:
+        data:   numpy array image with NaN for missing values
+
+    Returns:
+        tuple of the table of values and the table of counts
+    """
+
+    finite = np.isfinite(data)
+    ny, nx = data.shape
+
+    values = np.zeros((ny + 1, nx + 1))
+    values[1:, 1:] = np.where(finite, data, 0.0).cumsum(0).cumsum(1)
+
+    count = np.zeros((ny + 1, nx + 1), dtype=np.int64)
+    count[1:, 1:] = finite.cumsum(0).cumsum(1)
+
+    return values, count
+
+
+def window_sum(table, r0, r1, c0, c1):
+    """
+    Sum over the windows [r0, r1) and [c0, c1) from a summed area table
+    """
+
+    return table[r1, c1] - table[r0, c1] - table[r1, c0] + table[r0, c0]
+
+
+def windowed_mean_fill(rows, cols, buf, reference, fields, min_count=0):
+    """
+    Windowed means of images around a set of pixels. Windows grow from 11
+    cells in steps of 10 up to the buffer size and the first window with
+    more than ``min_count`` finite values in the reference image is used for
+    each pixel. The means ignore NaN values and are found for all of the
+    pixels at once from summed area tables.
+
+    A window of n cells covers ``(n - 1)/2`` cells before the pixel and
+    ``(n - 1)/2 - 1`` cells after the pixel in each direction, the same
+    slice as used by the original pixel by pixel search.
+
+    Args:
+        rows:       row of each pixel to fill
+        cols:       column of each pixel to fill
+        buf:        buffer size in cells, the largest window
+        reference:  image used to find the window for each pixel
+        fields:     dictionary of images to average
+        min_count:  number of finite reference values a window must exceed
+
+    Returns:
+        tuple of a boolean array of the pixels where a window was found and
+        a dictionary of the windowed means, NaN where no window was found
+    """
+
+    rows = np.asarray(rows)
+    cols = np.asarray(cols)
+    ny, nx = reference.shape
+
+    # window half width for each pixel
+    half = np.zeros(len(rows), dtype=int)
+    found = np.zeros(len(rows), dtype=bool)
+
+    ref_values, ref_count = summed_area_table(reference)
+    del ref_values
+
+    for n in range(11, buf + 2, 10):
+        pending = np.where(~found)[0]
+        if pending.size == 0:
+            break
+
+        h = int((n - 1) / 2)
+        r = rows[pending]
+        c = cols[pending]
+        count = window_sum(ref_count,
+                           np.clip(r - h, 0, ny), np.clip(r + h, 0, ny),
+                           np.clip(c - h, 0, nx), np.clip(c + h, 0, nx))
+
+        ok = count > min_count
+        found[pending[ok]] = True
+        half[pending[ok]] = h
+
+    r = rows[found]
+    c = cols[found]
+    h = half[found]
+    r0 = np.clip(r - h, 0, ny)
+    r1 = np.clip(r + h, 0, ny)
+    c0 = np.clip(c - h, 0, nx)
+    c1 = np.clip(c + h, 0, nx)
+
+    means = {}
+    for key, data in fields.items():
+        values, count = summed_area_table(data)
+        total = window_sum(values, r0, r1, c0, c1)
+        n = window_sum(count, r0, r1, c0, c1)
+
+        means[key] = np.full(len(rows), np.nan)
+        with np.errstate(invalid='ignore', divide='ignore'):
+            means[key][found] = np.where(n > 0, total / n, np.nan)
+
+    return found, means
+
+
+def nearest_neighbor_fill(rows, cols, valid, fields, k=10,
+                          max_distance=np.inf):
+    """
+    Inverse distance weighted means of images around a set of pixels from
+    the k nearest pixels that are valid. A KD-tree of the valid pixels is
+    built once and all of the pixels are found in a single query, so the
+    time depends on the number of pixels to fill and not on the search
+    distance. NaN values in a field are left out of the mean for that field,
+    and a pixel that is valid itself keeps its own value. Valid pixels at the
+    same distance are used in row and column order.
+
+    Args:
+        rows:           row of each pixel to fill
+        cols:           column of each pixel to fill
+        valid:          boolean image of the pixels to take values from
+        fields:         dictionary of images to interpolate
+        k:              number of neighbors
+        max_distance:   largest distance in cells to look for neighbors
+
+    Returns:
+        tuple of a boolean array of the pixels where a neighbor was found and
+        a dictionary of the interpolated values, NaN where no neighbor was
+        found
+    """
+
+    rows = np.asarray(rows)
+    cols = np.asarray(cols)
+    vr, vc = np.where(valid)
+
+    means = {key: np.full(len(rows), np.nan) for key in fields.keys()}
+    if len(rows) == 0 or len(vr) == 0:
+        return np.zeros(len(rows), dtype=bool), means
+
+    k = min(k, len(vr))
+    tree = cKDTree(np.column_stack((vr, vc)))
+    points = np.column_stack((rows, cols))
+
+    # cells the same distance away are taken in row and column order so the
+    # neighbors do not depend on how the tree was built. Query more than k
+    # neighbors until the ties at the k-th neighbor are all included
+    nq = min(2 * k, len(vr))
+    while True:
+        dist, idx = tree.query(points, k=nq,
+                               distance_upper_bound=max_distance)
+        dist = dist.reshape(len(rows), nq)
+        idx = idx.reshape(len(rows), nq)
+        ties = np.isfinite(dist[:, -1]) & (dist[:, -1] == dist[:, k - 1])
+        if nq == len(vr) or not np.any(ties):
+            break
+        nq = min(2 * nq, len(vr))
+
+    order = np.lexsort((idx, dist), axis=1)[:, :k]
+    dist = np.take_along_axis(dist, order, axis=1)
+    idx = np.take_along_axis(idx, order, axis=1)
+
+    # missing neighbors have an index past the end of the valid pixels
+    has = idx < len(vr)
+    found = np.any(has, axis=1)
+    idx = np.where(has, idx, 0)
+
+    # a valid pixel at the location itself is its value, not a weighted mean
+    exact = has & (dist == 0)
+
+    with np.errstate(divide='ignore', invalid='ignore'):
+        weights = np.where(has & ~exact, 1.0 / dist, 0.0)
+
+        for key, data in fields.items():
+            values = data[vr[idx], vc[idx]]
+            w = np.where(np.isfinite(values), weights, 0.0)
+            at = exact & np.isfinite(values)
+            w = np.where(np.any(at, axis=1)[:, None], at, w)
+            total = np.sum(w * np.where(np.isfinite(values), values, 0.0),
+                           axis=1)
+            wsum = np.sum(w, axis=1)
+            means[key] = np.where(wsum > 0, total / wsum, np.nan)
+
+    return found, means
+
+
+UPDATE_FILL_FIELDS = ['rho', 'T_s_0', 'T_s', 'h2o_sat', 'T_s_l']
+
+
+def fill_update_gaps(fields, holes, holes_25, buf, interpolation='window',
+                     neighbors=10):
+    """
+    Fill the cells where lidar measured snow but the model has none, and the
+    lower layer temperature of cells where the lidar depth is deeper than the
+    active layer. The fields are changed in place. Only cells within half of
+    the buffer of a hole are used to fill it, which lets the domain be split
+    into tiles with a halo of the buffer.
+
+    Args:
+        fields:         dictionary of the rho, T_s_0, T_s, h2o_sat and T_s_l
+                        images
+        holes:          boolean image of the cells to fill from the cells with
+                        a density
+        holes_25:       boolean image of the cells to fill the lower layer
+                        temperature
+        buf:            buffer size in cells
+        interpolation:  window or kdtree
+        neighbors:      number of neighbors for kdtree
+
+    Returns:
+        number of cells in holes that could not be filled
+    """
+
+    rho = fields['rho']
+    T_s_l = fields['T_s_l']
+    I = np.where(holes)
+    I_25 = np.where(holes_25)
+    has_windows = len(range(11, buf + 2, 10)) > 0
+
+    # the means use the fields before any cells are filled
+    fill = {k: fields[k] for k in ['rho', 'T_s_0', 'T_s', 'h2o_sat']}
+    if interpolation == 'kdtree':
+        found, means = nearest_neighbor_fill(I[0], I[1], np.isfinite(rho),
+                                             fill, neighbors, buf / 2.0)
+    else:
+        found, means = windowed_mean_fill(I[0], I[1], buf, rho, fill,
+                                          min_count=10)
+
+    # cells without enough neighbors keep their values
+    for key, field in fill.items():
+        field[I[0][found], I[1][found]] = means[key][found]
+
+    missing = 0
+    if has_windows:
+        missing = int(np.sum(~found))
+
+    if interpolation == 'kdtree':
+        found, means = nearest_neighbor_fill(I_25[0], I_25[1],
+                                             np.isfinite(T_s_l),
+                                             {'T_s_l': T_s_l}, neighbors,
+                                             buf / 2.0)
+        T_s_l[I_25] = means['T_s_l']
+
+    elif has_windows:
+        found, means = windowed_mean_fill(I_25[0], I_25[1], buf, T_s_l,
+                                          {'T_s_l': T_s_l})
+        T_s_l[I_25] = means['T_s_l']
+
+    return missing
+
+
+def fill_update_tile(registry, bounds, halo, buf, interpolation, neighbors):
+    """
+    Fill the holes in the interior of one tile. The images are memory mapped
+    from the registry and only the tile and its halo are read.
+
+    Args:
+        registry:       StaticFields with each field and the holes and
+                        holes_25 masks
+        bounds:         rows [r0, r1) and columns [c0, c1) of the interior
+        halo:           number of cells around the interior to read
+        buf:            buffer size in cells
+        interpolation:  window or kdtree
+        neighbors:      number of neighbors for kdtree
+
+    Returns:
+        tuple of the bounds, dictionary of the filled interior of each field
+        and the number of cells that could not be filled
+    """
+
+    r0, r1, c0, c1 = bounds
+    images = {k: registry.get(k)
+              for k in UPDATE_FILL_FIELDS + ['holes', 'holes_25']}
+    ny, nx = images['holes'].shape
+    h0 = max(r0 - halo, 0)
+    h1 = min(r1 + halo, ny)
+    w0 = max(c0 - halo, 0)
+    w1 = min(c1 + halo, nx)
+
+    fields = {k: np.array(images[k][h0:h1, w0:w1])
+              for k in UPDATE_FILL_FIELDS}
+
+    # only fill the interior, the halo is filled by the neighboring tiles
+    interior = np.zeros((h1 - h0, w1 - w0), dtype=bool)
+    interior[r0 - h0:r1 - h0, c0 - w0:c1 - w0] = True
+    holes = np.array(images['holes'][h0:h1, w0:w1]) & interior
+    holes_25 = np.array(images['holes_25'][h0:h1, w0:w1]) & interior
+
+    missing = fill_update_gaps(fields, holes, holes_25, buf, interpolation,
+                               neighbors)
+
+    fields = {k: v[r0 - h0:r1 - h0, c0 - w0:c1 - w0]
+              for k, v in fields.items()}
+
+    return bounds, fields, missing
+
+
+def tiled_fill_update_gaps(fields, holes, holes_25, buf,
+                           interpolation='window', neighbors=10,
+                           tile_size=1000, processes=1):
+    """
+    Same as fill_update_gaps but splits the domain into square tiles with a
+    halo of the buffer size. The images are saved to a temporary registry of
+    memory mapped files that the tiles are read from, so a pool of processes
+    can fill the tiles without copying the full images to each process. The filled interiors
+    are stitched back into the fields in place.
+
+    Args:
+        fields:         dictionary of the rho, T_s_0, T_s, h2o_sat and T_s_l
+                        images
+        holes:          boolean image of the cells to fill from the cells with
+                        a density
+        holes_25:       boolean image of the cells to fill the lower layer
+                        temperature
+        buf:            buffer size in cells
+        interpolation:  window or kdtree
+        neighbors:      number of neighbors for kdtree
+        tile_size:      number of cells on each side of a tile interior
+        processes:      number of processes filling tiles
+
+    Returns:
+        number of cells in holes that could not be filled
+    """
+
+    ny, nx = holes.shape
+    holes = np.ma.filled(holes, False)
+    holes_25 = np.ma.filled(holes_25, False)
+
+    # tiles without holes do not need to be filled
+    tiles = []
+    for r0 in range(0, ny, tile_size):
+        for c0 in range(0, nx, tile_size):
+            r1 = min(r0 + tile_size, ny)
+            c1 = min(c0 + tile_size, nx)
+            if np.any(holes[r0:r1, c0:c1]) or np.any(holes_25[r0:r1, c0:c1]):
+                tiles.append((r0, r1, c0, c1))
+
+    if len(tiles) == 0:
+        return 0
+
+    with StaticFields() as registry:
+        for k in UPDATE_FILL_FIELDS:
+            registry.add(k, fields[k])
+        registry.add('holes', holes)
+        registry.add('holes_25', holes_25)
+
+        n = len(tiles)
+        args = ([registry] * n, tiles, [buf] * n, [buf] * n,
+                [interpolation] * n, [neighbors] * n)
+
+        missing = 0
+        if processes > 1 and n > 1:
+            with ProcessPoolExecutor(min(processes, n)) as executor:
+                results = list(executor.map(fill_update_tile, *args))
+        else:
+            results = map(fill_update_tile, *args)
+
+        for (r0, r1, c0, c1), tile, m in results:
+            for k, v in tile.items():
+                fields[k][r0:r1, c0:c1] = v
+            missing += m
+
+    return missing
+
+
 class StateUpdater():
     """
     Class to initialize the updates, perform the updates, and store the needed
@@ -34,6 +404,10 @@ class StateUpdater():
         self.tzinfo = myawsm.tzinfo
         # check to see if we're outputting the changes resulting from each update
         self.update_change_file = myawsm.config['update depth']['update_change_file']
+        self.storage_profile = io_mod.get_storage_profile(myawsm)
+        # changes are kept until the last update or the end of the run
+        self.update_changes = OrderedDict()
+        self.delta_ds = None
         if self.update_change_file is not None:
             start_date = myawsm.config['time']['start_date']
             time_zone = myawsm.config['time']['time_zone']
@@ -48,22 +422,31 @@ class StateUpdater():
         # self.offsets = offsets
         # self.firststeps = firststeps
 
-        # save the dates of each update if there are any updates in the time frame
-        self.update_dates = []
-        if len(self.update_info) > 0:
-            self.update_dates = [self.update_info[k]['date_time'] for k in self.update_info.keys()]
+        # map the date of each update to the update number
+        self.update_dates = {}
+        for k in self.update_info.keys():
+            dt = self.update_info[k]['date_time']
+            if dt in self.update_dates:
+                raise ValueError('Something wrong in pysnobal updating date compare')
+            self.update_dates[dt] = k
 
         # get necessary variables from awsm class
         self.active_layer = myawsm.active_layer
         # Buffer size (in cells) for the interpolation to search overself.
         self.update_buffer = myawsm.update_buffer
+        # fill cells with windowed means or nearest neighbors
+        self.update_interpolation = myawsm.update_interpolation
+        self.update_neighbors = myawsm.update_neighbors
+        # split large domains into tiles filled by a pool of processes
+        self.update_tile_size = myawsm.update_tile_size
+        self.update_processes = myawsm.update_processes
 
         self.ny = myawsm.topo.ny
         self.nx = myawsm.topo.nx
         self.topo = myawsm.topo
         self.pathinit = myawsm.pathinit
 
-    def do_update_pysnobal(self, output_rec, dt):
+    def do_update_pysnobal(self, output_rec, dt, domain=None):
         """
         Function to update a time step of a pysnobal run by updating the
         output_rec
@@ -71,24 +454,28 @@ class StateUpdater():
         Args:
             output_rec:     iPySnobal state variables
             dt:             iPySnobal datetime of timestep
+            domain:         MaskedDomain if the state only has the active
+                            cells, the update is done on the full grid
         """
         self._logger.debug('Preparing to update pysnobal')
         # find the correct update number
-        ks = self.update_info.keys()
-        update_num = [k for k in ks if self.update_info[k]['date_time'] == dt]
-        if len(update_num) > 1:
-            raise ValueError('Something wrong in pysnobal updating date compare')
+        un = self.update_dates[dt]
 
-        un = update_num[0]
+        # the update works on the full grid
+        fields = ['m_s', 'T_s_0', 'T_s_l', 'T_s', 'h2o_sat', 'z_s', 'rho']
+        if domain is not None:
+            state = {k: domain.unpack(output_rec[k], k) for k in fields}
+        else:
+            state = output_rec
 
         # get parameters from PySnobal
-        m_s = output_rec['m_s']
-        T_s_0 = output_rec['T_s_0'] - FREEZE
-        T_s_l = output_rec['T_s_l'] - FREEZE
-        T_s = output_rec['T_s'] - FREEZE
-        h2o_sat = output_rec['h2o_sat']
-        z_s = output_rec['z_s']
-        density = output_rec['rho']
+        m_s = state['m_s']
+        T_s_0 = state['T_s_0'] - FREEZE
+        T_s_l = state['T_s_l'] - FREEZE
+        T_s = state['T_s'] - FREEZE
+        h2o_sat = state['h2o_sat']
+        z_s = state['z_s']
+        density = state['rho']
 
         # do the updating
         updated_fields = self.hedrick_updating_procedure(m_s, T_s_0, T_s_l, T_s,
@@ -99,12 +486,12 @@ class StateUpdater():
         # calculate the change from the update
         idsnow = ~np.isnan(updated_fields['D'])
         # difference in depth
-        diff_z = updated_fields['D'] - output_rec['z_s']
+        diff_z = updated_fields['D'] - state['z_s']
         # difference in density
-        diff_rho = updated_fields['rho'] - output_rec['rho']
+        diff_rho = updated_fields['rho'] - state['rho']
         diff_rho[~idsnow] = np.nan
         # difference in SWE
-        diff_swe = updated_fields['D'] * updated_fields['rho'] - output_rec['m_s']
+        diff_swe = updated_fields['D'] * updated_fields['rho'] - state['m_s']
         diff_swe[~idsnow] = np.nan
 
         # check to see if last update for the time period
@@ -114,7 +501,8 @@ class StateUpdater():
         if update_numbers[-1] == un:
             islast = True
         else:
-            next_un_date = self.update_info[un+1]['date_time']
+            next_un = update_numbers[update_numbers.index(un) + 1]
+            next_un_date = self.update_info[next_un]['date_time']
             if next_un_date > self.end_date.replace(tzinfo=self.tzinfo):
                 islast = True
 
@@ -123,13 +511,21 @@ class StateUpdater():
             self.output_update_changes(diff_z, diff_rho, diff_swe, dt, islast)
 
         # save the fields
-        output_rec['m_s'] = updated_fields['D'] * updated_fields['rho']
-        output_rec['T_s_0'] = updated_fields['T_s_0'] + FREEZE
-        output_rec['T_s_l'] = updated_fields['T_s_l'] + FREEZE
-        output_rec['T_s'] = updated_fields['T_s'] + FREEZE
-        output_rec['h2o_sat'] = updated_fields['h2o_sat']
-        output_rec['z_s'] = updated_fields['D']
-        output_rec['rho'] = updated_fields['rho']
+        state = {}
+        state['m_s'] = updated_fields['D'] * updated_fields['rho']
+        state['T_s_0'] = updated_fields['T_s_0'] + FREEZE
+        state['T_s_l'] = updated_fields['T_s_l'] + FREEZE
+        state['T_s'] = updated_fields['T_s'] + FREEZE
+        state['h2o_sat'] = updated_fields['h2o_sat']
+        state['z_s'] = updated_fields['D']
+        state['rho'] = updated_fields['rho']
+
+        # change the state in place, the output_rec may be views of the
+        # state block
+        for k, v in state.items():
+            if domain is not None:
+                v = domain.pack(v)
+            output_rec[k][:] = v
 
         return output_rec
 
@@ -174,7 +570,10 @@ class StateUpdater():
 
     def initialize_aso_updates(self, myawsm, update_fp):
         """
-        Read in the ASO update file and parse images by date
+        Read in the dates of the flights in the ASO update file. Only the
+        flights in ``flight_numbers`` are kept and the depth images are read
+        when the update is done with :meth:`read_depth`.
+
         Argument:
                 myawsm: instantiated awsm class
                 update_fp: file pointer to netCDF with all flights in it
@@ -182,52 +581,61 @@ class StateUpdater():
                 update_info: dictionary of updates
         """
 
-        # last_snow_image = ipw.IPW('/home/micahsandusky/Code/awsfTesting/newupdatetest/snow.2879')
-
         ##  Update the snow depths in the initialization file using ASO lidar:
         fp = update_fp
         # read in update files
         ds = Dataset(fp, 'r')
-        # get all depths, x, y, time
-        D_all = ds.variables['depth'][:]
-        D_all[np.isinf(D_all)] = np.nan
-        D_all[D_all > 200.0] = np.nan
-        if np.any(D_all) > 100:
-            print('Check D_all')
-            D_all[D_all > 100.0] = np.nan
-
+        # get x, y, time
         x = ds.variables['x'][:]
         y = ds.variables['y'][:]
-        times = ds.variables['time']
-        ts = times[:]
-        # convert time index to dates
-        t = nc.num2date(ts, times.units, times.calendar)
-        # find wyhr of dates
-
-        t_wyhr = []
-        for t1 in t:
-            tmp_date = t1.replace(tzinfo=myawsm.tzinfo)
-            # get wyhr
-            tmpwyhr = int(utils.water_day(tmp_date)[0]*24)
-            t_wyhr.append(tmpwyhr)
-
-        t_wyhr = np.array(t_wyhr)
+        ds.close()
+        # dates and water year hours of the time index
+        t, wyhr = time_index.read_time_index(fp)
 
         # make dictionary of updates
         update_info = OrderedDict()
-        keys = range(1,len(t_wyhr)+1)
+        keys = range(1, len(t)+1)
         for idk, k in enumerate(keys):
+            # filter to desired flights if user input
+            if myawsm.flight_numbers is not None and \
+                    k not in myawsm.flight_numbers:
+                continue
+
             # make dictionary for each update
             update_info[k] = {}
             # set update number
             update_info[k]['number'] = k
-            update_info[k]['date_time'] = t[idk].replace(tzinfo=myawsm.tzinfo)
-            update_info[k]['wyhr'] = t_wyhr[idk]
-            # set depth
-            update_info[k]['depth'] = D_all[idk,:]
+            update_info[k]['date_time'] = \
+                pd.Timestamp(t[idk]).to_pydatetime().replace(
+                    tzinfo=myawsm.tzinfo)
+            update_info[k]['wyhr'] = int(wyhr[idk])
+            # index of the depth image in the file
+            update_info[k]['index'] = idk
 
         return update_info, x, y
 
+    def read_depth(self, update_info):
+        """
+        Read the depth image for an update from the ASO update file
+
+        Args:
+            update_info: update info for a single update
+
+        Returns:
+            depth image with bad values set to NaN
+        """
+
+        # read during the run, with the forcing and output files open in
+        # other threads
+        with io_mod.NC_LOCK:
+            ds = Dataset(self.update_fp, 'r')
+            D = ds.variables['depth'][update_info['index'], :]
+            ds.close()
+
+        D[np.isinf(D)] = np.nan
+        D[D > 200.0] = np.nan
+
+        return D
 
     def calc_offsets_nsteps(self, myawsm, update_info):
         """
@@ -446,8 +854,8 @@ class StateUpdater():
         dem = self.topo.dem
         z0 = self.topo.roughness
 
-        # New depth field
-        D = update_info['depth']
+        # New depth field, only read when it is needed
+        D = self.read_depth(update_info)
 
         # make mask
         # D[self.topo.mask == 0.0] = np.nan
@@ -533,8 +941,8 @@ class StateUpdater():
                               Number of lidar cells measuring snow: {2}'.format(modelDepth, modelDensity, lidarDepth ) )
 
         ##  Now find cells where lidar measured snow, but Isnobal simulated no snow:
-        I = np.where( (np.isnan(rho)) & (D > 0.0) )
-        I_25 = np.where( (z_s <= (activeLayer * 1.20)) & (D >= activeLayer) ) # find cells with lidar
+        holes = (np.isnan(rho)) & (D > 0.0)
+        holes_25 = (z_s <= (activeLayer * 1.20)) & (D >= activeLayer) # find cells with lidar
             # depth greater than, and iSnobal depths less than, the active layer
             # depth. Lower layer temperatures of these cells will need to be
             # interpolated from surrounding cells with lower layer temperatures.
@@ -544,82 +952,30 @@ class StateUpdater():
             # from surrounding cells with lower layer temps and depths greater than
             # 120% of active layer.
 
-        # Interpolate over these cells to come up with values for them.
-        X , Y = np.meshgrid(range(ncols),range(nrows))
-
-        # make matrices to use in following commands
-        tmp1 = np.ones((nrows+2*Buf, Buf))
-        tmp1[:] = np.nan
-        tmp2 = np.ones((Buf, ncols))
-        tmp2[:] = np.nan
-        # create buffer
-        rho_buf = np.concatenate( (tmp1,np.concatenate( (tmp2,rho,tmp2) ,axis=0),tmp1 ),axis=1)
-        T_s_0_buf = np.concatenate( (tmp1,np.concatenate( (tmp2,T_s_0,tmp2) ,axis=0),tmp1 ),axis=1)
-        T_s_l_buf = np.concatenate( (tmp1,np.concatenate( (tmp2,T_s_l,tmp2) ,axis=0),tmp1 ),axis=1)
-        T_s_buf = np.concatenate( (tmp1,np.concatenate( (tmp2,T_s,tmp2) ,axis=0),tmp1 ),axis=1)
-        h2o_buf = np.concatenate( (tmp1,np.concatenate( (tmp2,h2o_sat,tmp2) ,axis=0),tmp1 ),axis=1)
-
-        ###################### hopefully fixed for loop logic below
-
-        for idx, (ix, iy) in enumerate(zip(I[0], I[1])): # Loop through cells with D > 0 and no iSnobal density,
-                          # active layer temp, snow temp, and h2o saturation.
-            xt = X[ix,iy]+Buf # Add the buffer to the x coords.
-            yt = Y[ix,iy]+Buf # Add the buffer to the y coords.
-            n = range(11,Buf+2,10) # Number of cells in averaging window
-            for n1 in n: # Loop through changing buffer windows until enough
-                              # cells are found to calculate an average.
-                xl = xt - int((n1 - 1) / 2)
-                xh = xt + int((n1 - 1) / 2)
-                yl = yt - int((n1 - 1) / 2)
-                yh = yt + int((n1 - 1) / 2)
-                window = rho_buf[yl:yh,xl:xh]
-                qq = np.where(np.isfinite(window)) # find number of pixels with a value.
-                if (len(qq[0]) > 10):
-                    val = np.nanmean(window[:])
-                    rho[ix,iy] = val  # Interpolate for density (just a windowed mean)
-                    window = T_s_0_buf[yl:yh,xl:xh]
-                    val = np.nanmean(window[:])
-                    T_s_0[ix,iy] = val # Interpolate for active snow layer temp
-                    # Handle the lower layer temp in the following for-loop.
-                    window = T_s_buf[yl:yh,xl:xh]
-                    val = np.nanmean(window[:])
-                    T_s[ix,iy] = val # Interpolate for avg snow temp
-                    window = h2o_buf[yl:yh,xl:xh]
-                    val = np.nanmean(window[:])
-                    h2o_sat[ix,iy] = val # Interpolate for liquid water saturation
-
-                # check to see if you found a value
-                if n1 == n[-1] and np.isnan(rho[ix,iy]):
-                    self._logger.error('Failed to find desnity wihtin buffer')
-                # if we found a value, move on
-                if np.isfinite( rho[ix,iy] ):
-                    break
-
-        # ##################### hopefully fixed for loop logic below
-        self._logger.debug('Done with loop 1')
-        # Now loop over cells with D > activelayer > z_s.  These cells were being
-        # assigned no temperature in their lower layer (-75) when they needed to
-        # have a real temperature.  Solution is to interpolate from nearby cells
-        # using an expanding moving window search.
-        for ix, iy in zip(I_25[0], I_25[1]):
-            xt = X[ix,iy] + Buf # Add the buffer to the x coords.
-            yt = Y[ix,iy] + Buf # Add the buffer to the y coords.
-            n = range(11,Buf+2,10)
-            for jj in n: # Loop through changing buffer windows until enough
-                              # cells are found to calculate an average.
-                xl = xt - int((jj-1)/2)
-                xh = xt + int((jj-1)/2)
-                yl = yt - int((jj-1)/2)
-                yh = yt + int((jj-1)/2)
-                window = T_s_l_buf[yl:yh,xl:xh]
-                val = np.nanmean(window[:])
-                T_s_l[ix,iy] = val # Interpolate for lower layer temp
-                ################ fix this to be pyton logic
-                #if np.isnan(T_s_l[ii]) == False:
-                if not np.any(np.isnan(T_s_l[ix,iy])):
-                    break
-
-        self._logger.debug('Done with loop 2')
+        # Interpolate over these cells to come up with values for them. The
+        # windowed means grow the window around each cell until enough cells
+        # with a density are found, using the fields before any cells are
+        # filled. Then loop over cells with D > activelayer > z_s.  These cells
+        # were being assigned no temperature in their lower layer (-75) when
+        # they needed to have a real temperature.  Solution is to interpolate
+        # from nearby cells using an expanding moving window search.
+        fields = {'rho': rho, 'T_s_0': T_s_0, 'T_s': T_s, 'h2o_sat': h2o_sat,
+                  'T_s_l': T_s_l}
+        if self.update_tile_size > 0:
+            missing = tiled_fill_update_gaps(fields, holes, holes_25, Buf,
+                                             self.update_interpolation,
+                                             self.update_neighbors,
+                                             self.update_tile_size,
+                                             self.update_processes)
+        else:
+            missing = fill_update_gaps(fields, holes, holes_25, Buf,
+                                       self.update_interpolation,
+                                       self.update_neighbors)
+        if missing > 0:
+            self._logger.error('Failed to find desnity wihtin buffer for {} '
+                               'cells'.format(missing))
+
+        self._logger.debug('Done with interpolation')
 
         iq = (np.isnan(D)) & (np.isfinite(rho))
         rho[iq] = np.nan # Once more, change cells with no lidar snow to have np.nan density.
@@ -687,8 +1043,11 @@ class StateUpdater():
 
     def output_update_changes(self, diff_z, diff_rho, diff_swe, dt, islast):
         """
-        Output the effect of the depth update each time that the state is
-        updated.
+        Save the effect of the depth update each time that the state is
+        updated. The changes are kept in memory with the basin mean change
+        in SWE and the number of cells where the SWE changed, and are written
+        to the change file after the last update or when the updater is
+        closed.
 
         Args:
             diff_z: numpy array of change in depth
@@ -697,33 +1056,72 @@ class StateUpdater():
             dt: PySnobal time step
             islast: boolean describing if it is the last update to process
         """
-        variable_list = ['depth_change', 'rho_change', 'swe_change']
-        # now find the correct index
-        # the current time integer
-        times = self.delta_ds.variables['time']
-        # convert to index
-        t = nc.date2num(dt.replace(tzinfo=None), times.units, times.calendar)
-        # find index in context of file
-        if len(times) != 0:
-            index = np.where(times[:] == t)[0]
-            if index.size == 0:
-                index = len(times)
-            else:
-                index = index[0]
-        else:
-            index = len(times)
 
-        # insert the time and data
-        self.delta_ds.variables['time'][index] = t
-        self.delta_ds.variables['depth_change'][index, :] = diff_z
-        self.delta_ds.variables['rho_change'][index, :] = diff_rho
-        self.delta_ds.variables['swe_change'][index, :] = diff_swe
+        with io_mod.NC_LOCK:
+            times = self.delta_ds.variables['time']
+            units, calendar = times.units, times.calendar
+        t = nc.date2num(dt.replace(tzinfo=None), units, calendar)
 
-        self.delta_ds.sync()
+        mask = self.topo.mask.astype(bool)
+        swe = np.where(np.isfinite(diff_swe) & mask, diff_swe, 0.0)
+
+        self.update_changes[t] = {
+            'depth_change': np.array(diff_z, dtype=np.float32),
+            'rho_change': np.array(diff_rho, dtype=np.float32),
+            'swe_change': np.array(diff_swe, dtype=np.float32),
+            'basin_swe_change': np.sum(swe) / max(np.sum(mask), 1),
+            'pixels_changed': np.sum(swe != 0.0)
+            }
 
         # close file if we're done
         if islast:
-            self.delta_ds.close()
+            self.close()
+
+    def write_update_changes(self):
+        """
+        Write the changes from the updates held in memory to the change file.
+        Updates already in the file are overwritten.
+        """
+
+        if self.delta_ds is None or len(self.update_changes) == 0:
+            return
+
+        with io_mod.NC_LOCK:
+            times = self.delta_ds.variables['time']
+            index = {}
+            if len(times) != 0:
+                index = {t: i for i, t in enumerate(times[:])}
+
+            n = len(times)
+            for t, changes in self.update_changes.items():
+                if t in index:
+                    i = index[t]
+                else:
+                    i = n
+                    n += 1
+
+                # insert the time and data
+                times[i] = t
+                for v, data in changes.items():
+                    var = self.delta_ds.variables[v]
+                    if var.ndim == 1:
+                        var[i] = data
+                    else:
+                        var[i, :] = io_mod.pack_values(var, data)
+
+            self.update_changes.clear()
+            self.delta_ds.sync()
+
+    def close(self):
+        """
+        Write any changes held in memory and close the change file
+        """
+
+        if self.delta_ds is not None:
+            self.write_update_changes()
+            with io_mod.NC_LOCK:
+                self.delta_ds.close()
+            self.delta_ds = None
 
     def initialize_update_output(self, start_date, time_zone, awsm_version,
                                  smrf_version):
@@ -739,8 +1137,6 @@ class StateUpdater():
 
         """
         fmt = '%Y-%m-%d %H:%M:%S'
-        # chunk size
-        cs = (6, 10, 10)
 
         variable_dict = {
                         'depth_change' : {
@@ -794,9 +1190,16 @@ class StateUpdater():
             ds.variables['y'][:] = y
             ds.variables['x'][:] = x
 
-            # em image
+            # em image, one chunk for each update and always compressed as
+            # most of the image does not change
+            profile = dict(self.storage_profile)
+            profile['chunks'] = [1, len(y), len(x)]
+            if profile['complevel'] == 0:
+                profile['complevel'] = 4
+
             for v, f in variable_dict.items():
-                ds.createVariable(v, 'f', dimensions[:3], chunksizes=cs)
+                io_mod.create_output_variable(ds, v, profile,
+                                              len(self.update_info))
                 setattr(ds.variables[v], 'units', f['units'])
                 setattr(ds.variables[v], 'description', f['description'])
 
@@ -810,6 +1213,26 @@ class StateUpdater():
             ds.setncattr_string('institution',
                     'USDA Agricultural Research Service, Northwest Watershed Research Center')
 
+        # summary of each update, files from before the summaries were
+        # added get them as well
+        summary_dict = {
+                        'basin_swe_change': {
+                                             'datatype': 'f8',
+                                             'units': 'mm',
+                                             'description': 'mean change in SWE over the basin mask from update'
+                                            },
+                        'pixels_changed': {
+                                           'datatype': 'i4',
+                                           'units': 'count',
+                                           'description': 'number of cells in the basin mask where SWE changed from update'
+                                          }
+                        }
+        for v, f in summary_dict.items():
+            if v not in ds.variables:
+                ds.createVariable(v, f['datatype'], ('time',))
+                setattr(ds.variables[v], 'units', f['units'])
+                setattr(ds.variables[v], 'description', f['description'])
+
         # save the open dataset so we can write to it
         ds.sync()
 
@@ -448,3 +448,177 @@ def initialize(params, tstep_info, init):
             s[key] = val
 
     return s
+
+
+class SnobalState():
+    """
+    PySnobal state held in one contiguous (nfields, ny, nx) float64 block.
+    ``fields`` is a dictionary of views of the block for each state variable
+    that is passed to PySnobal as the output_rec, so the values must be
+    changed in place. A snapshot of the state is a single copy of the block.
+    The block can be a memory mapped file so the state of large basins is
+    kept in disk backed pages.
+
+    Args:
+        data:   dictionary of the state images, all with the same shape
+        path:   optional .npy file to memory map the block to
+    """
+
+    def __init__(self, data, path=None):
+
+        self.names = list(data.keys())
+        self.path = path
+        shape = (len(self.names),) + np.shape(data[self.names[0]])
+
+        if path is None:
+            self.block = np.empty(shape)
+        else:
+            self.block = np.lib.format.open_memmap(path, mode='w+',
+                                                   dtype=np.float64,
+                                                   shape=shape)
+
+        self.views = [self.block[i] for i in range(len(self.names))]
+        self.fields = {}
+        for i, name in enumerate(self.names):
+            self.views[i][:] = data[name]
+            self.fields[name] = self.views[i]
+
+    def sync(self):
+        """
+        Copy any entries of ``fields`` that were replaced with new arrays
+        into the block and point them back to the block
+        """
+
+        for i, name in enumerate(self.names):
+            if self.fields[name] is not self.views[i]:
+                self.views[i][:] = self.fields[name]
+                self.fields[name] = self.views[i]
+
+    def snapshot(self):
+        """
+        Copy of the state
+
+        Returns:
+            (nfields, ny, nx) array of the state in the order of ``names``
+        """
+
+        self.sync()
+        return self.block.copy()
+
+    def restore(self, snapshot):
+        """
+        Set the state from a snapshot
+
+        Args:
+            snapshot:   array from :func:`snapshot`
+        """
+
+        self.sync()
+        self.block[:] = snapshot
+
+    def as_dict(self, snapshot):
+        """
+        Dictionary of the state variables in a snapshot
+
+        Args:
+            snapshot:   array from :func:`snapshot`
+
+        Returns:
+            dictionary of views of the snapshot
+        """
+
+        return {name: snapshot[i] for i, name in enumerate(self.names)}
+
+    def flush(self):
+        """
+        Write the state to the memory mapped file, if any
+        """
+
+        if self.path is not None:
+            self.block.flush()
+
+
+class MaskedDomain():
+    """
+    Gather the active cells of the grid into packed arrays so PySnobal only
+    runs over the cells inside the mask. Packed arrays have the shape (1, n)
+    for the n active cells so they can be passed to the model as a grid.
+    The values of the state outside the mask are kept when the state is
+    packed so the full grid can be rebuilt for the outputs and updates.
+
+    Args:
+        mask:   numpy array of the model domain, active cells are non-zero
+    """
+
+    def __init__(self, mask):
+
+        self.shape = mask.shape
+        self.index = np.flatnonzero(mask)
+        self.inactive = np.flatnonzero(mask == 0)
+        self.n = len(self.index)
+
+        # state values outside the mask, a scalar if they are all the same
+        self.background = {}
+
+    def pack(self, data):
+        """
+        Gather the active cells of an image
+
+        Args:
+            data:   numpy array with the shape of the grid or a scalar
+
+        Returns:
+            (1, n) array of the active cells
+        """
+
+        if np.ndim(data) == 0:
+            return data * np.ones((1, self.n))
+
+        return np.asarray(data).reshape(-1)[self.index].reshape(1, self.n)
+
+    def pack_dict(self, data, keep_background=False):
+        """
+        Gather the active cells of every image in a dictionary
+
+        Args:
+            data:               dictionary of images
+            keep_background:    store the values outside the mask to use
+                                when unpacking
+
+        Returns:
+            dictionary of packed arrays
+        """
+
+        packed = {}
+        for key, value in data.items():
+            if keep_background:
+                outside = np.asarray(value).reshape(-1)[self.inactive]
+                if outside.size > 0 and np.all(outside == outside[0]):
+                    outside = outside[0]
+                self.background[key] = outside
+            packed[key] = self.pack(value)
+
+        return packed
+
+    def unpack(self, data, key=None, out=None):
+        """
+        Scatter packed values back to the full grid
+
+        Args:
+            data:   packed array of the active cells
+            key:    state field to fill the cells outside the mask with,
+                    zero if not given
+            out:    optional array with the shape of the grid to fill
+
+        Returns:
+            array with the shape of the grid
+        """
+
+        if out is None:
+            out = np.empty(self.shape)
+
+        flat = out.reshape(-1)
+        flat[self.inactive] = self.background.get(key, 0.0)
+        flat[self.index] = np.asarray(data).reshape(-1)
+
+        return out
@@ -11,6 +11,9 @@ import subprocess
 import copy
 from inicheck.output import generate_config
 
+from awsm.interface import forecast
+from awsm.interface import pysnobal_io as io_mod
+
 def create_smrf_config(myawsm):
     """
     Create a smrf config for running standard :mod: `smr` run. Use the
@@ -261,12 +264,24 @@ def run_awsm_daily(myawsm):
         # turn off forecast for daily run (will be turned on later if it was true)
         myawsm.config['gridded']['forecast_flag'] = False
 
+        # start from the state at the end of the previous day
+        if day > 0:
+            forecast.init_model(myawsm, myawsm.model_state)
+
+        # keep the state at each hour to start the forecasts in the
+        # process pool from
+        myawsm.forecast_states = None
+        if myawsm.do_forecast and myawsm.forecast_processes > 1:
+            myawsm.forecast_states = io_mod.StateSnapshots(myawsm.tzinfo,
+                                                           myawsm.pathrr)
+
         # ################# run_model for day ###############################
         myawsm.run_smrf_ipysnobal()
 
         # reset restart to be last output for next time step
         myawsm.ipy_init_type = 'netcdf_out'
-        myawsm.config['ipysnobal initial conditions']['init_file'] = \
+        myawsm.config['files']['init_type'] = 'netcdf_out'
+        myawsm.config['files']['init_file'] = \
             os.path.join(myawsm.pathro, myawsm.snow_name + '.nc')
 
         # do the 18hr forecast on each hour if forecast is true
@@ -279,25 +294,50 @@ def run_awsm_daily(myawsm):
                                                   myawsm.end_date,
                                                   pd.to_timedelta(myawsm.time_step,
                                                   unit='m'))
-            for t in d_inner:
-                # find hour from start of day
-                day_hour = t - pd.to_datetime(d_inner[0].strftime("%Y%m%d"))
-                day_hour = int(day_hour / np.timedelta64(1, 'h'))
-
-                # reset output names
-                myawsm.snow_name = 'snow_{:02d}'.format(day_hour)
-                myawsm.em_name = 'em_{:02d}'.format(day_hour)
-
-                # reset start and end days
-                myawsm.start_date = t
-                myawsm.end_date = t + pd.to_timedelta(myawsm.n_forecast_hours,
-                                                      unit='h')
-
-                # recalculate start and end water year hour
-                tmp_date = myawsm.start_date.replace(tzinfo=myawsm.tzinfo)
-                tmp_end_date = myawsm.end_date.replace(tzinfo=myawsm.tzinfo)
-                myawsm.start_wyhr = int(utils.water_day(tmp_date)[0]*24)
-                myawsm.end_wyhr = int(utils.water_day(tmp_end_date)[0]*24)
+            if myawsm.forecast_processes > 1:
+                day_start = pd.to_datetime(d_inner[0].strftime("%Y%m%d"))
+
+                # the forecasts only depend on the state at their hour
+                scheduler = \
+                    forecast.ForecastScheduler(myawsm,
+                                               myawsm.forecast_processes,
+                                               myawsm.forecast_states)
+                for t in d_inner:
+                    scheduler.add(t, day_start)
 
                 # run the model for the forecast times
-                myawsm.run_smrf_ipysnobal()
+                try:
+                    scheduler.run()
+                finally:
+                    myawsm.forecast_states.close()
+                    myawsm.forecast_states = None
+
+            else:
+                # the next day starts from the state at the end of this day
+                day_state = myawsm.model_state
+
+                for t in d_inner:
+                    # find hour from start of day
+                    day_hour = t - pd.to_datetime(d_inner[0].strftime("%Y%m%d"))
+                    day_hour = int(day_hour / np.timedelta64(1, 'h'))
+
+                    # reset output names
+                    myawsm.snow_name = 'snow_{:02d}'.format(day_hour)
+                    myawsm.em_name = 'em_{:02d}'.format(day_hour)
+
+                    # reset start and end days
+                    myawsm.start_date = t
+                    myawsm.end_date = \
+                        t + pd.to_timedelta(myawsm.n_forecast_hours, unit='h')
+
+                    # recalculate start and end water year hour
+                    tmp_date = myawsm.start_date.replace(tzinfo=myawsm.tzinfo)
+                    tmp_end_date = \
+                        myawsm.end_date.replace(tzinfo=myawsm.tzinfo)
+                    myawsm.start_wyhr = int(utils.water_day(tmp_date)[0]*24)
+                    myawsm.end_wyhr = int(utils.water_day(tmp_end_date)[0]*24)
+
+                    # run the model for the forecast times
+                    myawsm.run_smrf_ipysnobal()
+
+                myawsm.model_state = day_state
@@ -15,6 +15,7 @@ except Exception as e:
     print(e)
     print('pysnobal not installed, ignoring')
 
+import os
 import pandas as pd
 import sys
 import numpy as np
@@ -26,6 +27,8 @@ except:
     from queue import Queue  # , Empty, Full
 
 import threading
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
 from awsm.interface import initialize_model as initmodel
 from awsm.interface import pysnobal_io as io_mod
 
@@ -35,6 +38,9 @@ FREEZE = C_TO_K
 # Kelvin to Celcius
 K_TO_C = lambda x: x - FREEZE
 
+# forcing variables converted to Kelvin
+TEMP_FORCE = ['T_a', 'T_pp']
+
 # ###############################################################
 # ########## Functions for interfacing with smrf run ############
 # ###############################################################
@@ -66,12 +72,146 @@ def init_from_smrf(myawsm, mysmrf=None, dem=None):
 
     output_rec = initmodel.initialize(params, tstep_info, init)
 
+    # only run the cells inside the mask
+    options['domain'] = None
+    if myawsm.active_cells_only:
+        options['domain'] = initmodel.MaskedDomain(myawsm.topo.mask)
+        myawsm._logger.info('Running PySnobal on {} of {} cells'
+                            .format(options['domain'].n,
+                                    myawsm.topo.mask.size))
+
     # create the output files
     io_mod.output_files(options, init, myawsm.start_date, myawsm)
 
+    if options['domain'] is not None:
+        output_rec = options['domain'].pack_dict(output_rec,
+                                                 keep_background=True)
+
+    # keep the state in one block, the output_rec is views of the block
+    path = None
+    if myawsm.state_on_disk:
+        path = os.path.join(myawsm.pathrr, 'snobal_state.npy')
+        myawsm._logger.info('Keeping the PySnobal state in {}'.format(path))
+    options['state'] = initmodel.SnobalState(output_rec, path)
+    output_rec = options['state'].fields
+
+    # keep the state at the start and each output to start forecasts from
+    options['output']['states'] = myawsm.forecast_states
+    if myawsm.forecast_states is not None:
+        myawsm.forecast_states.add(output_rec, options['time']['date_time'][0],
+                                   options['domain'])
+
     return options, params, tstep_info, init, output_rec
 
 
+def get_model_state(myawsm, options, tstep):
+    """
+    PySnobal state at the end of a run, kept in memory to initialize the next
+    run. See :func:`awsm.interface.pysnobal_io.model_state`
+
+    Args:
+        myawsm:     AWSM instance
+        options:    dictionary of Snobal options with the state
+        tstep:      datetime of the last time step that was run
+
+    Returns:
+        dictionary of the time, the water year hour and the state fields
+    """
+
+    options['state'].sync()
+
+    return io_mod.model_state(options['state'].fields, tstep,
+                              options['domain'], myawsm.tzinfo)
+
+
+class ForcingBuffer():
+    """
+    Two preallocated sets of forcing arrays for PySnobal that are swapped each
+    time step, one for the previous time step and one for the current. The
+    SMRF images are copied into the arrays with the temperatures converted
+    to Kelvin in the same pass, so the SMRF images are never changed and no
+    arrays are allocated after the first time steps. The ground temperature
+    is filled once.
+    """
+
+    def __init__(self, ny, nx, soil_temp, domain=None):
+        """
+        Args:
+            ny:         number of points in y direction
+            nx:         number of points in X direction
+            soil_temp:  uniform soil temperature (float)
+            domain:     MaskedDomain to pack the images to, or None
+        """
+
+        self.domain = domain
+        self.shape = (ny, nx)
+        if domain is not None:
+            self.shape = (1, domain.n)
+        self.soil_temp = soil_temp
+
+        self.buffers = [self.allocate(), self.allocate()]
+        self.current = 0
+
+    def allocate(self):
+        """
+        New set of forcing arrays with the ground temperature
+
+        Returns:
+            dictionary of the forcing arrays
+        """
+
+        out = {'T_g': np.empty(self.shape)}
+        out['T_g'][:] = self.soil_temp
+        out['T_g'] += FREEZE
+
+        return out
+
+    def fill(self, data, out=None):
+        """
+        Copy the forcing data into the next set of arrays
+
+        Args:
+            data:   dictionary of the SMRF images for the PySnobal inputs,
+                    None for a variable without data
+            out:    dictionary from :func:`allocate` to fill instead of the
+                    next buffer
+
+        Returns:
+            dictionary of the forcing arrays
+        """
+
+        if out is None:
+            self.current = 1 - self.current
+            out = self.buffers[self.current]
+
+        for key, value in data.items():
+            # the ground temperature is the uniform soil temperature
+            if key == 'T_g':
+                continue
+
+            if key not in out:
+                out[key] = np.empty(self.shape)
+            arr = out[key]
+
+            # no data is zero, which is 0 C for the temperatures
+            if value is None:
+                arr[:] = 0.0
+                if key in TEMP_FORCE:
+                    arr += FREEZE
+                continue
+
+            if self.domain is not None:
+                np.take(np.ravel(value), self.domain.index, out=arr[0])
+                if key in TEMP_FORCE:
+                    arr += FREEZE
+            elif key in TEMP_FORCE:
+                np.add(value, FREEZE, out=arr)
+            else:
+                np.copyto(arr, value)
+
+        return out
+
+
 class QueueIsnobal(threading.Thread):
     """
     Takes values from the queue and uses them to run iPySnobal
@@ -80,7 +220,7 @@ class QueueIsnobal(threading.Thread):
     def __init__(self, queue, date_time, thread_variables, awsm_output_vars,
                  options, params, tstep_info, init,
                  output_rec, nx, ny, soil_temp, logger, tzi,
-                 updater=None):
+                 updater=None, checkpoint=None):
         """
         Args:
             queue:      dictionary of the queue
@@ -98,6 +238,7 @@ class QueueIsnobal(threading.Thread):
             logger:     initialized AWSM logger
             tzi:        time zone information
             updater:    depth updater
+            checkpoint: CheckpointWriter to save the state
         """
 
         threading.Thread.__init__(self, name='isnobal')
@@ -116,21 +257,53 @@ class QueueIsnobal(threading.Thread):
         self.nthreads = self.options['output']['nthreads']
         self.tzinfo = tzi
         self.updater = updater
+        self.checkpoint = checkpoint
+        self.domain = self.options.get('domain')
+        self.forcing = ForcingBuffer(ny, nx, soil_temp, self.domain)
+        # last time step that was run
+        self.last_tstep = None
 
         # get AWSM logger
         self._logger = logger
         self._logger.debug('Initialized iPySnobal thread')
 
-    def run(self):
+    def get_queue_forcing(self, tstep, map_val):
         """
-        mimic the main.c from the Snobal model. Runs Pysnobal while recieving
-        forcing data from SMRF queue.
+        Get the forcing data for a time step from the SMRF queue
+
+        Args:
+            tstep:      datetime time step
+            map_val:    map of the SMRF variables to the PySnobal inputs
 
+        Returns:
+            dictionary of the SMRF images for the PySnobal inputs
         """
+
         force_variables = ['thermal', 'air_temp', 'vapor_pressure', 'wind_speed',
                            'net_solar', 'soil_temp', 'precip', 'percent_snow',
                            'snow_density', 'precip_temp']
 
+        data = {}
+        for v in force_variables:
+            if v in self.queue.keys():
+                # get variable from smrf queue
+                data[map_val[v]] = self.queue[v].get(tstep, block=True,
+                                                     timeout=None)
+                if data[map_val[v]] is None:
+                    self._logger.info('No data from smrf to iSnobal for {} in {}'
+                                      .format(v, tstep))
+            elif v != 'soil_temp':
+                self._logger.error('Value not in keys: {}'.format(v))
+
+        return data
+
+    def run(self):
+        """
+        mimic the main.c from the Snobal model. Runs Pysnobal while recieving
+        forcing data from SMRF queue.
+
+        """
+
         # loop through the input
         # do_data_tstep needs two input records so only go
         # to the last record-1
@@ -144,8 +317,8 @@ class QueueIsnobal(threading.Thread):
         step_time = start_step * data_tstep
         # step_time = start_step * 60.0
 
-        self.output_rec['current_time'] = step_time * np.ones(self.output_rec['elevation'].shape)
-        self.output_rec['time_since_out'] = timeSinceOut * np.ones(self.output_rec['elevation'].shape)
+        self.output_rec['current_time'][:] = step_time
+        self.output_rec['time_since_out'][:] = timeSinceOut
 
         # map function from these values to the ones requried by snobal
         map_val = {'air_temp': 'T_a', 'net_solar': 'S_n', 'thermal': 'I_lw',
@@ -155,27 +328,10 @@ class QueueIsnobal(threading.Thread):
                    'precip_temp': 'T_pp'}
 
         # get first timestep
-        input1 = {}
-        for v in force_variables:
-            if v in self.queue.keys():
+        input1 = self.forcing.fill(self.get_queue_forcing(self.date_time[0],
+                                                          map_val))
 
-                data = self.queue[v].get(self.date_time[0], block=True, timeout=None)
-                if data is None:
-                    data = np.zeros((self.ny, self.nx))
-                    self._logger.info('No data from smrf to iSnobal for {} in {}'
-                                      .format(v, self.date_time[0]))
-                    input1[map_val[v]] = data
-                else:
-                    input1[map_val[v]] = data
-            elif v != 'soil_temp':
-                self._logger.error('Value not in keys: {}'.format(v))
-
-        # set ground temp
-        input1['T_g'] = self.soil_temp*np.ones((self.ny, self.nx))
-
-        input1['T_a'] += FREEZE
-        input1['T_pp'] += FREEZE
-        input1['T_g'] += FREEZE
+        self.last_tstep = self.date_time[0]
 
         # tell queue we assigned all the variables
         self.queue['isnobal'].put([self.date_time[0], True])
@@ -186,25 +342,8 @@ class QueueIsnobal(threading.Thread):
         for tstep in self.date_time[1:]:
             # get the output variables then pass to the function
             # this avoids zeroing of the energetics every timestep
-            first_step = j
-            input2 = {}
-            for v in force_variables:
-                if v in self.queue.keys():
-                    # get variable from smrf queue
-                    data = self.queue[v].get(tstep, block=True, timeout=None)
-                    if data is None:
-
-                        data = np.zeros((self.ny, self.nx))
-                        self._logger.info('No data from smrf to iSnobal for {} in {}'.format(v, tstep))
-                        input2[map_val[v]] = data
-                    else:
-                        input2[map_val[v]] = data
-            # set ground temp
-            input2['T_g'] = self.soil_temp*np.ones((self.ny, self.nx))
-            # convert variables to Kelvin
-            input2['T_a'] += FREEZE
-            input2['T_pp'] += FREEZE
-            input2['T_g'] += FREEZE
+            input2 = self.forcing.fill(self.get_queue_forcing(tstep,
+                                                              map_val))
 
             first_step = j
             if self.updater is not None:
@@ -215,7 +354,7 @@ class QueueIsnobal(threading.Thread):
                     #                                     tstep.tz_localize(None))
                     self.output_rec = \
                         self.updater.do_update_pysnobal(self.output_rec,
-                                                        tstep)
+                                                        tstep, self.domain)
                     first_step = 1
 
             self._logger.info('running PySnobal for timestep: {}'.format(tstep))
@@ -233,17 +372,22 @@ class QueueIsnobal(threading.Thread):
                 break
 
             self._logger.info('Finished timestep: {}'.format(tstep))
-            input1 = input2.copy()
+            # the next time step is filled into the other buffer
+            input1 = input2
 
             # output at the frequency and the last time step
             if ((j)*(data_tstep/3600.0) % self.options['output']['frequency'] == 0)\
                     or (j == len(self.options['time']['date_time']) - 1):
                 io_mod.output_timestep(self.output_rec, tstep, self.options,
                                        self.awsm_output_vars)
-                self.output_rec['time_since_out'] = \
-                    np.zeros(self.output_rec['elevation'].shape)
+                self.output_rec['time_since_out'][:] = 0.0
 
             j += 1
+            self.last_tstep = tstep
+
+            if self.checkpoint is not None:
+                self.checkpoint.save(j, tstep, input1,
+                                     self.options['output'].get('writer'))
 
             # put the value into the output queue so clean knows it's done
             self.queue['isnobal'].put([tstep, True])
@@ -259,7 +403,8 @@ class PySnobal():
 
     def __init__(self, date_time, variable_list, awsm_output_vars,
                  options, params, tstep_info, init,
-                 output_rec, nx, ny, soil_temp, logger, tzi):
+                 output_rec, nx, ny, soil_temp, logger, tzi,
+                 checkpoint=None):
         """
         Args:
             date_time:  array of date_time
@@ -275,6 +420,7 @@ class PySnobal():
             soil_temp:  uniform soil temperature (float)
             logger:     initialized AWSM logger
             tzi:        time zone information
+            checkpoint: CheckpointWriter to save the state
         """
 
         self.date_time = date_time
@@ -290,6 +436,9 @@ class PySnobal():
         self.soil_temp = soil_temp
         self.nthreads = self.options['output']['nthreads']
         self.tzinfo = tzi
+        self.checkpoint = checkpoint
+        self.domain = self.options.get('domain')
+        self.forcing = ForcingBuffer(ny, nx, soil_temp, self.domain)
 
         # map function from these values to the ones requried by snobal
         self.map_val = {'air_temp': 'T_a', 'net_solar': 'S_n', 'thermal': 'I_lw',
@@ -303,13 +452,47 @@ class PySnobal():
         self._logger = logger
         self._logger.debug('Initialized iPySnobal thread')
 
-    def run_single_fist_step(self, s):
+    def get_smrf_forcing(self, s, tstep, copy=False):
+        """
+        Get the forcing data for PySnobal from the SMRF distribution classes
+        for the time step that was just distributed. The images are copied
+        into the forcing buffer with the temperatures converted to Kelvin.
+
+        Args:
+            s:      smrf class instance
+            tstep:  datetime time step
+            copy:   copy the SMRF images into new arrays instead of the
+                    forcing buffer, so SMRF can distribute the next time
+                    steps while PySnobal runs
+
+        Returns:
+            dictionary of the forcing data for PySnobal
+        """
+
+        data = {}
+        for var, v in self.variable_list.items():
+            # get the data desired
+            data[self.map_val[var]] = getattr(s.distribute[v['module']],
+                                              v['variable'])
+            if data[self.map_val[var]] is None:
+                self._logger.info('No data from smrf to iSnobal for {} in {}'
+                                  .format(v, tstep))
+
+        out = None
+        if copy:
+            out = self.forcing.allocate()
+
+        return self.forcing.fill(data, out)
+
+    def run_single_fist_step(self, s, forcing=None):
         """
         mimic the main.c from the Snobal model. Recieves forcing data from SMRF
         in non-threaded application and initializes very first step.
 
         Args:
             s:  smrf class instance
+            forcing: forcing data from :func:`get_smrf_forcing`, read from
+                SMRF if None
 
         """
 
@@ -326,35 +509,20 @@ class PySnobal():
         step_time = start_step * self.data_tstep
         # step_time = start_step * 60.0
 
-        self.output_rec['current_time'] = step_time * np.ones(self.output_rec['elevation'].shape)
-        self.output_rec['time_since_out'] = self.timeSinceOut * np.ones(self.output_rec['elevation'].shape)
+        self.output_rec['current_time'][:] = step_time
+        self.output_rec['time_since_out'][:] = self.timeSinceOut
 
         # get first timestep
-        self.input1 = {}
-        for var, v in self.variable_list.items():
-                # get the data desired
-                data = getattr(s.distribute[v['module']], v['variable'])
-
-                if data is None:
-                    data = np.zeros((self.ny, self.nx))
-                    self._logger.info('No data from smrf to iSnobal for {} in {}'.format(v, self.date_time[0]))
-                    self.input1[self.map_val[var]] = data
-                else:
-                    self.input1[self.map_val[var]] = data
-
-        # set ground temp
-        self.input1['T_g'] = self.soil_temp*np.ones((self.ny, self.nx))
-
-        self.input1['T_a'] += FREEZE
-        self.input1['T_pp'] += FREEZE
-        self.input1['T_g'] += FREEZE
+        if forcing is None:
+            forcing = self.get_smrf_forcing(s, self.date_time[0])
+        self.input1 = forcing
 
         # for counting how many steps since the start of the run
         self.j = 1
 
         self._logger.info('Finished initializing first timestep for iPySnobal')
 
-    def run_single(self, tstep, s, updater=None):
+    def run_single(self, tstep, s, updater=None, forcing=None):
         """
         Runs each timestep of Pysnobal when running with SMRF in non-threaded
         application.
@@ -363,28 +531,15 @@ class PySnobal():
             tstep: datetime timestep
             s:     smrf class instance
             updater: depth updater class
+            forcing: forcing data from :func:`get_smrf_forcing`, read from
+                SMRF if None
 
         """
         # pbar = progressbar.ProgressBar(max_value=len(options['time']['date_time']))
 
-        self.input2 = {}
-        for var, v in self.variable_list.items():
-            # get the data desired
-            data = getattr(s.distribute[v['module']], v['variable'])
-            if data is None:
-
-                data = np.zeros((self.ny, self.nx))
-                self._logger.info('No data from smrf to iSnobal for {} in {}'
-                                  .format(v, tstep))
-                self.input2[self.map_val[var]] = data
-            else:
-                self.input2[self.map_val[var]] = data
-        # set ground temp
-        self.input2['T_g'] = self.soil_temp*np.ones((self.ny, self.nx))
-        # convert variables to Kelvin
-        self.input2['T_a'] += FREEZE
-        self.input2['T_pp'] += FREEZE
-        self.input2['T_g'] += FREEZE
+        if forcing is None:
+            forcing = self.get_smrf_forcing(s, tstep)
+        self.input2 = forcing
 
         first_step = self.j
 
@@ -396,7 +551,8 @@ class PySnobal():
                 # self.output_rec = \
                 #     updater.do_update_pysnobal(self.output_rec, tstep.tz_localize(None))
                 self.output_rec = \
-                    updater.do_update_pysnobal(self.output_rec, tstep)
+                    updater.do_update_pysnobal(self.output_rec, tstep,
+                                               self.domain)
                 first_step = 1
 
 
@@ -412,13 +568,83 @@ class PySnobal():
             sys.exit()
 
         self._logger.info('Finished timestep: {}'.format(tstep))
-        self.input1 = self.input2.copy()
+        # the next time step is filled into the other buffer
+        self.input1 = self.input2
 
         # output at the frequency and the last time step
         if ((self.j)*(self.data_tstep/3600.0) % self.options['output']['frequency'] == 0)\
                 or (self.j == len(self.options['time']['date_time']) - 1):
             io_mod.output_timestep(self.output_rec, tstep, self.options,
                                    self.awsm_output_vars)
-            self.output_rec['time_since_out'] = np.zeros(self.output_rec['elevation'].shape)
+            self.output_rec['time_since_out'][:] = 0.0
 
         self.j += 1
+
+        if self.checkpoint is not None:
+            self.checkpoint.save(self.j, tstep, self.input1,
+                                 self.options['output'].get('writer'))
+
+
+class PySnobalPipeline():
+    """
+    Run the PySnobal time steps in another thread up to depth time steps
+    behind SMRF. The forcing data is copied out of SMRF for each time step,
+    so SMRF can distribute the next time steps while PySnobal runs. The time
+    steps are run one at a time in the order they are submitted.
+
+    Args:
+        my_pysnobal:    :class:`PySnobal` instance
+        depth:          number of time steps PySnobal can fall behind SMRF
+    """
+
+    def __init__(self, my_pysnobal, depth):
+
+        self.my_pysnobal = my_pysnobal
+        self.depth = max(int(depth), 1)
+        self.pending = deque()
+        self.executor = ThreadPoolExecutor(max_workers=1)
+
+    def submit(self, output_count, tstep, s, updater=None):
+        """
+        Run PySnobal for the time step SMRF just distributed, waiting for
+        PySnobal to catch up if it is more than depth time steps behind
+
+        Args:
+            output_count:   index of the time step in the run
+            tstep:          datetime time step
+            s:              smrf class instance
+            updater:        depth updater class
+        """
+
+        pysnobal = self.my_pysnobal
+        forcing = pysnobal.get_smrf_forcing(s, tstep, copy=True)
+        if output_count == 0:
+            future = self.executor.submit(pysnobal.run_single_fist_step, s,
+                                          forcing)
+        else:
+            future = self.executor.submit(pysnobal.run_single, tstep, s,
+                                          updater, forcing)
+        self.pending.append(future)
+
+        # limit the number of time steps waiting for PySnobal, this also
+        # raises any PySnobal errors
+        while len(self.pending) > self.depth:
+            self.pending.popleft().result()
+
+    def wait(self):
+        """
+        Wait for PySnobal to finish all of the time steps submitted
+        """
+
+        while len(self.pending) > 0:
+            self.pending.popleft().result()
+
+    def close(self):
+        """
+        Cancel the time steps PySnobal has not started and stop the thread
+        """
+
+        for future in self.pending:
+            future.cancel()
+        self.pending.clear()
+        self.executor.shutdown(wait=True)
@@ -1,17 +1,77 @@
 import os
+import shutil
+import tempfile
 import numpy as np
 import pandas as pd
 from datetime import datetime
 import netCDF4 as nc
 import glob
-from copy import copy
+import threading
+from queue import Queue
+from collections import deque, OrderedDict
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+from spatialnc import ipw
 from spatialnc.proj import add_proj
+from smrf.utils import utils
 
 C_TO_K = 273.16
 FREEZE = C_TO_K
 # Kelvin to Celcius
 K_TO_C = lambda x: x - FREEZE
 
+# map the output file variables to the output_rec fields
+EM_OUT = {'net_rad': 'R_n_bar', 'sensible_heat': 'H_bar',
+          'latent_heat': 'L_v_E_bar',
+          'snow_soil': 'G_bar', 'precip_advected': 'M_bar',
+          'sum_EB': 'delta_Q_bar', 'evaporation': 'E_s_sum',
+          'snowmelt': 'melt_sum', 'SWI': 'ro_pred_sum',
+          'cold_content': 'cc_s'}
+SNOW_OUT = {'thickness': 'z_s', 'snow_density': 'rho',
+            'specific_mass': 'm_s', 'liquid_water': 'h2o',
+            'temp_surf': 'T_s_0', 'temp_lower': 'T_s_l',
+            'temp_snowcover': 'T_s', 'thickness_lower': 'z_s_l',
+            'water_saturation': 'h2o_sat'}
+# the netCDF library is not thread safe, every read, write, sync and close
+# of the forcing and output files from the model, prefetch and output
+# writer threads holds this lock
+NC_LOCK = threading.RLock()
+
+# output variables that are converted from K to C
+TEMP_OUT = ['temp_surf', 'temp_lower', 'temp_snowcover']
+
+# state variables a run is initialized from, and those in Kelvin
+INIT_STATE = ['z_s', 'rho', 'T_s_0', 'T_s_l', 'T_s', 'h2o_sat']
+TEMP_STATE = ['T_s_0', 'T_s_l', 'T_s']
+
+# map the forcing files to the inputs requried by snobal
+FORCE_MAP = {'air_temp': 'T_a', 'net_solar': 'S_n', 'thermal': 'I_lw',
+             'vapor_pressure': 'e_a', 'wind_speed': 'u',
+             'soil_temp': 'T_g', 'precip_mass': 'm_pp',
+             'percent_snow': 'percent_snow', 'snow_density': 'rho_snow',
+             'precip_temp': 'T_pp'}
+# forcing inputs that are converted from C to K
+TEMP_FORCE = ['T_a', 'T_pp', 'T_g']
+
+# value ranges for output variables stored as packed 16 bit integers,
+# variables without a range are always stored as float32
+PACK_RANGE = {'thickness': (0.0, 30.0), 'snow_density': (0.0, 1000.0),
+              'specific_mass': (0.0, 15000.0), 'liquid_water': (0.0, 500.0),
+              'temp_surf': (-75.0, 5.0), 'temp_lower': (-75.0, 5.0),
+              'temp_snowcover': (-75.0, 5.0), 'thickness_lower': (0.0, 30.0),
+              'water_saturation': (0.0, 100.0),
+              'net_rad': (-1000.0, 1500.0), 'sensible_heat': (-1000.0, 1000.0),
+              'latent_heat': (-1000.0, 1000.0), 'snow_soil': (-500.0, 500.0),
+              'precip_advected': (-500.0, 500.0), 'sum_EB': (-2000.0, 2000.0),
+              'evaporation': (-100.0, 100.0), 'snowmelt': (0.0, 500.0),
+              'SWI': (0.0, 500.0),
+              'depth_change': (-30.0, 30.0), 'rho_change': (-1000.0, 1000.0),
+              'swe_change': (-15000.0, 15000.0)}
+PACK_FILL = -32768
+
+# map the bands of the IPW input and precip files to the snobal inputs
+IPW_IN_MAP = {1: 'T_a', 5: 'S_n', 0: 'I_lw', 2: 'e_a', 3: 'u'}
+IPW_PPT_MAP = {0: 'm_pp', 1: 'percent_snow', 2: 'rho_snow', 3: 'T_pp'}
+
 
 def open_files_nc(myawsm):
     """
@@ -90,14 +150,617 @@ def open_files_ipw(myawsm):
     return input_list, ppt_list
 
 
+class ForcingReader():
+    """
+    Read the PySnobal forcing data from the netCDF files opened with
+    :func:`open_files_nc`. The data variable in each file and the index of
+    every time step in the run are found once when the reader is created,
+    so reading a time step does not search the time axis.
+
+    The forcing files are read in blocks of time steps that line up with
+    the time chunks of each variable, so every chunk is decompressed once.
+    Blocks are kept in a cache shared by all the variables and the least
+    recently used blocks are dropped when the cache is larger than
+    ``cache_size``.
+
+    Args:
+        force:      dictionary of opened netCDF forcing data files
+        date_time:  list of datetime time steps in the run
+        block_size: number of time steps to read from a file at once, 0
+                    uses the time chunk size of each variable
+        point:      optional [row, column] to read a single point
+        cache_size: maximum size of the cached blocks in MB
+        domain:     optional :class:`~awsm.interface.initialize_model.MaskedDomain`
+                    to return only the active cells
+    """
+
+    def __init__(self, force, date_time, block_size=0, point=None,
+                 cache_size=1024, domain=None):
+
+        self.force = force
+        self.point = point
+        self.domain = domain
+        self.cache_size = cache_size * 1024**2
+        self.cache = OrderedDict()
+        self.nbytes = 0
+        # one thread reads at a time and updates the cache
+        self.lock = threading.Lock()
+
+        dates = [dt.replace(tzinfo=None) for dt in date_time]
+
+        self.variable = {}
+        self.index = {}
+        self.block_size = {}
+        for f in force.keys():
+            if isinstance(force[f], np.ndarray):
+                continue
+
+            # compare the dimensions and variables to get the variable name
+            v = list(set(force[f].variables.keys()) -
+                     set(force[f].dimensions.keys()))
+            self.variable[f] = [fv for fv in v if fv != 'projection'][0]
+
+            # read the time chunks of the variable unless told otherwise
+            self.block_size[f] = int(block_size)
+            if self.block_size[f] < 1:
+                chunks = force[f].variables[self.variable[f]].chunking()
+                if chunks == 'contiguous' or chunks is None:
+                    self.block_size[f] = 1
+                else:
+                    self.block_size[f] = chunks[0]
+
+            # map each time step in the run to the index in the file
+            times = force[f].variables['time']
+            lookup = {}
+            for idx, tv in enumerate(times[:]):
+                lookup[float(tv)] = idx
+
+            t = nc.date2num(dates, times.units, calendar=times.calendar)
+            self.index[f] = {}
+            for dt, tv in zip(dates, np.atleast_1d(t)):
+                if float(tv) in lookup:
+                    self.index[f][dt] = lookup[float(tv)]
+
+    def get_index(self, f, tstep):
+        """
+        Find the index of a time step in a forcing file
+
+        Args:
+            f:      forcing variable
+            tstep:  datetime time step
+
+        Returns:
+            index of the time step in the file
+        """
+
+        try:
+            return self.index[f][tstep.replace(tzinfo=None)]
+        except KeyError:
+            raise ValueError('{} not found in the {} forcing file'
+                             .format(tstep, f))
+
+    def read(self, f, t):
+        """
+        Read the image at index t, reading the block that holds the index
+        from the file if it is not in the cache
+
+        Args:
+            f:  forcing variable
+            t:  index in the file
+
+        Returns:
+            image at the index
+        """
+
+        bs = self.block_size[f]
+        start = (t // bs) * bs
+        key = (f, start)
+
+        with self.lock:
+            if key in self.cache:
+                self.cache.move_to_end(key)
+                data = self.cache[key]
+
+            else:
+                with NC_LOCK:
+                    var = self.force[f].variables[self.variable[f]]
+                    end = min(start + bs, var.shape[0])
+                    if self.point is None:
+                        data = var[start:end, :]
+                    else:
+                        data = var[start:end, self.point[0], self.point[1]]
+
+                self.cache[key] = data
+                self.nbytes += data.nbytes
+
+                # drop the least recently used blocks, keeping this one
+                while self.nbytes > self.cache_size and len(self.cache) > 1:
+                    k, d = self.cache.popitem(last=False)
+                    self.nbytes -= d.nbytes
+
+        if self.point is None:
+            return data[t - start]
+        else:
+            return np.atleast_2d(data[t - start])
+
+    def get(self, tstep):
+        """
+        Get all of the forcing data for a time step
+
+        Args:
+            tstep:  datetime time step
+
+        Returns:
+            inpt:   dictionary of forcing variable images
+        """
+
+        inpt = {}
+        for f in self.force.keys():
+            if isinstance(self.force[f], np.ndarray):
+                # constant value
+                if self.point is None:
+                    data = self.force[f]
+                else:
+                    data = np.atleast_2d(self.force[f][self.point[0],
+                                                       self.point[1]])
+            else:
+                data = self.read(f, self.get_index(f, tstep))
+
+            # copy so the cached data is not changed, packing the active
+            # cells already makes a copy
+            if self.domain is not None:
+                data = self.domain.pack(data)
+                inpt[FORCE_MAP[f]] = data.astype(np.float64, copy=False)
+            else:
+                inpt[FORCE_MAP[f]] = data.astype(np.float64)
+
+            # convert from C to K
+            if FORCE_MAP[f] in TEMP_FORCE:
+                inpt[FORCE_MAP[f]] += FREEZE
+
+        return inpt
+
+
+def read_ipw_bands(fp):
+    """
+    Decode all of the bands in an IPW file. This is a module function so it
+    can be run in another process.
+
+    Args:
+        fp:     path to the IPW file
+
+    Returns:
+        list of band images
+    """
+
+    i = ipw.IPW(fp)
+    return [b.data for b in i.bands]
+
+
+class IPWForcingReader():
+    """
+    Read the PySnobal forcing data from the IPW input and precip files
+    listed by :func:`open_files_ipw`. The same inputs are returned as
+    :func:`~awsm.interface.initialize_model.get_timestep_ipw`.
+
+    With ``nprocesses`` the files for the next time steps are decoded in a
+    process pool while the model runs. Decoded files are kept in a cache
+    and the least recently used files are dropped when the cache is larger
+    than ``cache_size``.
+
+    Args:
+        myawsm:     AWSM instance for current run
+        input_list: water year hours of the input files
+        ppt_list:   water year hours of the precip files
+        date_time:  list of datetime time steps in the run
+        nprocesses: number of processes decoding files ahead, 0 decodes
+                    each file when it is needed
+        cache_size: maximum size of the decoded files in MB
+        domain:     optional :class:`~awsm.interface.initialize_model.MaskedDomain`
+                    to return only the active cells
+    """
+
+    def __init__(self, myawsm, input_list, ppt_list, date_time,
+                 nprocesses=0, cache_size=1024, domain=None):
+
+        self.pathi = myawsm.pathi
+        self.path_ppt = myawsm.path_ppt
+        self.shape = (myawsm.topo.ny, myawsm.topo.nx)
+        self.T_g = myawsm.soil_temp * np.ones(self.shape)
+        self.domain = domain
+
+        self.inputs = set(int(h) for h in input_list)
+        self.ppt = set(int(h) for h in ppt_list)
+
+        # water year hour and position of each time step in the run
+        self.dates = [dt.replace(tzinfo=None) for dt in date_time]
+        self.wyhr = {}
+        self.position = {}
+        for idx, (dt, tstep) in enumerate(zip(self.dates, date_time)):
+            self.wyhr[dt] = int(utils.water_day(tstep)[0]*24)
+            self.position[dt] = idx
+
+        self.cache_size = cache_size * 1024**2
+        self.cache = OrderedDict()
+        self.nbytes = 0
+        self.lock = threading.Lock()
+
+        self.pending = {}
+        self.depth = 2 * nprocesses
+        self.executor = None
+        if nprocesses > 0:
+            self.executor = ProcessPoolExecutor(max_workers=nprocesses)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def files(self, wyhr):
+        """
+        Get the input and precip files for a water year hour
+
+        Args:
+            wyhr:   water year hour
+
+        Returns:
+            tuple of the input file and the precip file, None if there is
+            no precip for the hour
+        """
+
+        if wyhr not in self.inputs:
+            raise ValueError('No input timesteps for water year hour {}'
+                             .format(wyhr))
+
+        fp_in = os.path.join(self.pathi, 'in.%04i' % (wyhr))
+        fp_ppt = None
+        if wyhr in self.ppt:
+            fp_ppt = os.path.join(self.path_ppt, 'ppt.4b_%04i' % (wyhr))
+
+        return fp_in, fp_ppt
+
+    def decode_ahead(self, dt):
+        """
+        Start decoding the files for the time steps after dt
+
+        Args:
+            dt:     datetime time step without a time zone
+        """
+
+        p = self.position[dt]
+        for d in self.dates[p + 1:p + 1 + self.depth]:
+            if self.wyhr[d] not in self.inputs:
+                continue
+            for fp in self.files(self.wyhr[d]):
+                if fp is not None and fp not in self.cache and \
+                        fp not in self.pending:
+                    self.pending[fp] = self.executor.submit(read_ipw_bands,
+                                                            fp)
+
+    def bands(self, fp):
+        """
+        Get the decoded bands of a file from the cache, the process pool
+        or by reading the file
+
+        Args:
+            fp:     path to the IPW file
+
+        Returns:
+            list of band images
+        """
+
+        if fp in self.cache:
+            self.cache.move_to_end(fp)
+            return self.cache[fp]
+
+        if fp in self.pending:
+            data = self.pending.pop(fp).result()
+        else:
+            data = read_ipw_bands(fp)
+
+        self.cache[fp] = data
+        self.nbytes += sum(d.nbytes for d in data)
+
+        # drop the least recently used files, keeping this one
+        while self.nbytes > self.cache_size and len(self.cache) > 1:
+            k, d = self.cache.popitem(last=False)
+            self.nbytes -= sum(b.nbytes for b in d)
+
+        return data
+
+    def get(self, tstep):
+        """
+        Get all of the forcing data for a time step
+
+        Args:
+            tstep:  datetime time step
+
+        Returns:
+            inpt:   dictionary of forcing variable images
+        """
+
+        dt = tstep.replace(tzinfo=None)
+        if dt in self.wyhr:
+            wyhr = self.wyhr[dt]
+        else:
+            wyhr = int(utils.water_day(tstep)[0]*24)
+
+        if wyhr not in self.inputs:
+            raise ValueError('No input timesteps for {}'.format(tstep))
+
+        with self.lock:
+            if self.executor is not None and dt in self.position:
+                self.decode_ahead(dt)
+
+            fp_in, fp_ppt = self.files(wyhr)
+            i_in = self.bands(fp_in)
+            i_ppt = None
+            if fp_ppt is not None:
+                i_ppt = self.bands(fp_ppt)
+
+        # copy so the cached data is not changed
+        inpt = {}
+        inpt['T_g'] = self.T_g.copy()
+        for f, v in IPW_IN_MAP.items():
+            # if no solar data, give it zero
+            if f == 5 and len(i_in) < 6:
+                inpt[v] = np.zeros(self.shape)
+            else:
+                inpt[v] = i_in[f].astype(np.float64)
+
+        for f, v in IPW_PPT_MAP.items():
+            if i_ppt is None:
+                inpt[v] = np.zeros(self.shape)
+            else:
+                inpt[v] = i_ppt[f].astype(np.float64)
+
+        # convert from C to K
+        for v in TEMP_FORCE:
+            inpt[v] += FREEZE
+
+        if self.domain is not None:
+            inpt = self.domain.pack_dict(inpt)
+
+        return inpt
+
+    def close(self):
+        """
+        Stop decoding files and shut down the process pool
+        """
+
+        if self.executor is not None:
+            for future in self.pending.values():
+                future.cancel()
+            self.pending.clear()
+            self.executor.shutdown(wait=True)
+            self.executor = None
+
+
+class ForcingPrefetcher():
+    """
+    Read the forcing data ahead of the model in background threads. The
+    forcing for the next ``depth`` time steps is read while the model runs
+    and the time steps must be requested in the order given.
+
+    Args:
+        get_forcing: function that returns the dictionary of forcing
+                     images for a time step
+        date_time:   list of datetime time steps in the order they will
+                     be requested
+        depth:       number of time steps to read ahead
+        nthreads:    number of threads reading the forcing data
+    """
+
+    def __init__(self, get_forcing, date_time, depth, nthreads=1):
+
+        self.get_forcing = get_forcing
+        self.depth = max(int(depth), 1)
+        self.dates = iter(date_time)
+        self.pending = deque()
+        self.executor = ThreadPoolExecutor(max_workers=max(int(nthreads), 1))
+
+        self.fill()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def fill(self):
+        """
+        Start reading time steps until ``depth`` time steps are queued
+        """
+
+        while len(self.pending) < self.depth:
+            try:
+                tstep = next(self.dates)
+            except StopIteration:
+                break
+            self.pending.append((tstep,
+                                 self.executor.submit(self.get_forcing,
+                                                      tstep)))
+
+    def get(self, tstep):
+        """
+        Get the forcing data for the next time step, waiting for it to be
+        read if needed. Errors from reading are raised here.
+
+        Args:
+            tstep:  datetime time step
+
+        Returns:
+            dictionary of forcing variable images
+        """
+
+        if len(self.pending) == 0:
+            raise ValueError('No forcing data read ahead for {}'.format(tstep))
+
+        dt, future = self.pending.popleft()
+        if dt != tstep:
+            raise ValueError('Forcing data read ahead for {} but {} was '
+                             'requested'.format(dt, tstep))
+
+        inpt = future.result()
+        self.fill()
+
+        return inpt
+
+    def close(self):
+        """
+        Stop reading ahead and wait for the threads to finish
+        """
+
+        for dt, future in self.pending:
+            future.cancel()
+        self.pending.clear()
+        self.executor.shutdown(wait=True)
+
+
+def get_chunk_shape(nt, ny, nx, chunk_mb=1.0, itemsize=4):
+    """
+    Chunk shape for a (time, y, x) output variable sized to the run. The
+    time chunk is a day of hours, or the whole run if it is shorter, and the
+    spatial tiles are square and fill about ``chunk_mb`` per chunk.
+
+    Args:
+        nt:         number of time steps in the file
+        ny:         number of rows
+        nx:         number of columns
+        chunk_mb:   target size of a chunk in MB
+        itemsize:   bytes per value
+
+    Returns:
+        tuple of the chunk sizes
+    """
+
+    ct = int(max(min(nt, 24), 1))
+    cells = chunk_mb * 1024**2 / itemsize / ct
+    side = int(max(np.sqrt(cells), 1))
+
+    return (ct, min(ny, side), min(nx, side))
+
+
+def get_storage_profile(myawsm):
+    """
+    Collect the storage settings for the output netCDF files from the
+    ``[awsm system]`` section
+
+    Args:
+        myawsm:     awsm class
+
+    Returns:
+        dictionary of the chunk shape, compression, significant digits for
+        each variable and the storage type
+    """
+
+    digits = {}
+    if myawsm.output_significant_digits is not None:
+        for value in myawsm.output_significant_digits:
+            v, d = value.split(':')
+            digits[v.lower()] = int(d)
+
+    profile = {'chunks': myawsm.output_chunks,
+               'complevel': myawsm.output_compression,
+               'shuffle': myawsm.output_shuffle,
+               'significant_digits': digits,
+               'dtype': myawsm.output_dtype}
+
+    return profile
+
+
+def create_output_variable(ds, name, profile, nt):
+    """
+    Create a (time, y, x) output variable using the storage profile. The
+    chunk shape is derived from the expected number of time steps if it is
+    not set. Variables in ``PACK_RANGE`` are stored as 16 bit integers with
+    a scale and offset when the profile type is float16.
+
+    Args:
+        ds:         netCDF dataset with time, y and x dimensions
+        name:       variable name
+        profile:    storage profile from :func:`get_storage_profile`
+        nt:         expected number of time steps in the file
+
+    Returns:
+        the netCDF variable
+    """
+
+    ny = len(ds.dimensions['y'])
+    nx = len(ds.dimensions['x'])
+
+    if profile is None:
+        profile = {'chunks': None, 'complevel': 0, 'shuffle': True,
+                   'significant_digits': {}, 'dtype': 'float32'}
+
+    if profile['chunks'] is None:
+        cs = get_chunk_shape(nt, ny, nx)
+    else:
+        cs = (max(int(profile['chunks'][0]), 1),
+              min(int(profile['chunks'][1]), ny),
+              min(int(profile['chunks'][2]), nx))
+
+    kwargs = {'chunksizes': cs}
+    if profile['complevel'] > 0:
+        kwargs['zlib'] = True
+        kwargs['complevel'] = profile['complevel']
+        kwargs['shuffle'] = profile['shuffle']
+
+    if name.lower() in profile['significant_digits']:
+        kwargs['least_significant_digit'] = \
+            profile['significant_digits'][name.lower()]
+
+    datatype = 'f'
+    packed = profile['dtype'] == 'float16' and name in PACK_RANGE
+    if packed:
+        datatype = 'i2'
+        kwargs['fill_value'] = PACK_FILL
+
+    var = ds.createVariable(name, datatype, ('time', 'y', 'x'), **kwargs)
+
+    if packed:
+        lo, hi = PACK_RANGE[name]
+        var.scale_factor = np.float32((hi - lo) / 65534.0)
+        var.add_offset = np.float32((hi + lo) / 2.0)
+
+    return var
+
+
+def pack_values(var, data):
+    """
+    Prepare values to write to a variable. Packed variables are clipped to
+    the range that can be stored and missing values are masked, other
+    variables are returned unchanged.
+
+    Args:
+        var:    netCDF variable
+        data:   numpy array to write
+
+    Returns:
+        array to write to the variable
+    """
+
+    if 'scale_factor' not in var.ncattrs():
+        return data
+
+    limit = 32767 * var.scale_factor
+    mask = ~np.isfinite(data)
+    data = np.clip(np.where(mask, var.add_offset, data),
+                   var.add_offset - limit, var.add_offset + limit)
+
+    return np.ma.masked_array(data, mask=mask)
+
+
 def close_files(force):
     """
     Close input netCDF forcing files
     """
 
-    for f in force.keys():
-        if not isinstance(force[f], np.ndarray):
-            force[f].close()
+    with NC_LOCK:
+        for f in force.keys():
+            if not isinstance(force[f], np.ndarray):
+                force[f].close()
 
 
 def output_files(options, init, start_date, myawsm):
@@ -112,10 +775,11 @@ def output_files(options, init, start_date, myawsm):
 
     """
     fmt = '%Y-%m-%d %H:%M:%S'
-    # chunk size
-    cs = (6, 10, 10)
-    if myawsm.topo.nx < 10:
-        cs = (3, 3, 3)
+    # storage for the output variables, chunked for the expected outputs
+    profile = get_storage_profile(myawsm)
+    nt = int(np.ceil(len(options['time']['date_time']) *
+                     options['time']['time_step'] / 60.0 /
+                     options['output']['frequency']))
 
     # ------------------------------------------------------------------------
     # EM netCDF
@@ -181,8 +845,7 @@ def output_files(options, init, start_date, myawsm):
         for i, v in enumerate(m['name']):
             # check to see if in output variables
             if v.lower() in myawsm.pysnobal_output_vars:
-                # em.createVariable(v, 'f', dimensions[:3], chunksizes=(6,10,10))
-                em.createVariable(v, 'f', dimensions[:3], chunksizes=cs)
+                create_output_variable(em, v, profile, nt)
                 setattr(em.variables[v], 'units', m['units'][i])
                 setattr(em.variables[v], 'description', m['description'][i])
 
@@ -253,8 +916,7 @@ def output_files(options, init, start_date, myawsm):
         for i, v in enumerate(s['name']):
             # check to see if in output variables
             if v.lower() in myawsm.pysnobal_output_vars:
-                snow.createVariable(v, 'f', dimensions[:3], chunksizes=cs)
-                # snow.createVariable(v, 'f', dimensions[:3])
+                create_output_variable(snow, v, profile, nt)
                 setattr(snow.variables[v], 'units', s['units'][i])
                 setattr(snow.variables[v], 'description', s['description'][i])
 
@@ -263,74 +925,606 @@ def output_files(options, init, start_date, myawsm):
 
     options['output']['snow'] = snow
 
+    # buffered writer for the output time steps
+    writer = OutputWriter(options, myawsm.pysnobal_output_vars,
+                          myawsm.output_buffer)
+
+    # write the outputs in a background thread
+    if myawsm.output_thread:
+        writer = AsyncOutputWriter(writer, myawsm.output_queue_size,
+                                   myawsm._logger)
+        writer.start()
+
+    options['output']['writer'] = writer
+
 
 def output_timestep(s, tstep, options, output_vars):
     """
-    Output the model results for the current time step
+    Output the model results for the current time step. The time step is
+    passed to the :class:`OutputWriter` stored in the options, which will
+    write it to the snow and em files once its buffer is full. The state is
+    also kept in the :class:`StateSnapshots` of the options, if any.
 
     Args:
         s:       dictionary of output variable numpy arrays
         tstep:   datetime time step
         options: dictionary of Snobal options
+        output_vars: list of variables to output
+
+    """
+
+    if 'writer' not in options['output']:
+        options['output']['writer'] = OutputWriter(options, output_vars)
+
+    options['output']['writer'].write(s, tstep)
+
+    if options['output'].get('states') is not None:
+        options['output']['states'].add(s, tstep, options.get('domain'))
 
+
+def model_state(s, tstep, domain, tzinfo):
     """
+    Copy of the PySnobal state to initialize another run from. These are the
+    same fields, on the full grid and in Celcius, that would be read from the
+    snow file at the time step.
 
-    em_out = {'net_rad': 'R_n_bar', 'sensible_heat': 'H_bar',
-              'latent_heat': 'L_v_E_bar',
-              'snow_soil': 'G_bar', 'precip_advected': 'M_bar',
-              'sum_EB': 'delta_Q_bar', 'evaporation': 'E_s_sum',
-              'snowmelt': 'melt_sum', 'SWI': 'ro_pred_sum',
-              'cold_content': 'cc_s'}
-    snow_out = {'thickness': 'z_s', 'snow_density': 'rho',
-                'specific_mass': 'm_s', 'liquid_water': 'h2o',
-                'temp_surf': 'T_s_0', 'temp_lower': 'T_s_l',
-                'temp_snowcover': 'T_s', 'thickness_lower': 'z_s_l',
-                'water_saturation': 'h2o_sat'}
-
-    # preallocate
-    em = {}
-    snow = {}
-
-    # gather all the data together
-    for key, value in em_out.items():
-        em[key] = copy(s[value])
-
-    for key, value in snow_out.items():
-        snow[key] = copy(s[value])
-
-    # convert from K to C
-    snow['temp_snowcover'] -= FREEZE
-    snow['temp_surf'] -= FREEZE
-    snow['temp_lower'] -= FREEZE
-
-    # now find the correct index
-    # the current time integer
-    times = options['output']['snow'].variables['time']
-    # offset to match same convention as iSnobal
-    tstep -= pd.to_timedelta(1, unit='h')
-    t = nc.date2num(tstep.replace(tzinfo=None), times.units, times.calendar)
-
-    if len(times) != 0:
-        index = np.where(times[:] == t)[0]
-        if index.size == 0:
-            index = len(times)
+    Args:
+        s:       dictionary of output variable numpy arrays
+        tstep:   datetime time step of the state
+        domain:  MaskedDomain if running only the active cells, or None
+        tzinfo:  time zone of the run
+
+    Returns:
+        dictionary of the time, the water year hour and the state fields
+    """
+
+    fields = {}
+    for k in INIT_STATE:
+        if domain is not None:
+            v = domain.unpack(s[k], key=k)
         else:
-            index = index[0]
+            v = np.array(s[k])
+        if k in TEMP_STATE:
+            v = K_TO_C(v)
+        fields[k] = v
+
+    tmp_date = tstep.replace(tzinfo=tzinfo)
+
+    return {'time': tstep,
+            'wyhr': utils.water_day(tmp_date)[0] * 24.0,
+            'fields': fields}
+
+
+class StateSnapshots():
+    """
+    Copies of the PySnobal state at the start of a run and each output time
+    step, so forecasts can start from any hour of the run. Each snapshot is
+    saved to a file in a temporary directory and read when it is needed, so
+    the memory used does not depend on the number of snapshots. The
+    snapshots are found by the wall clock time of the time step, and only
+    the directory and the index of the files are pickled.
+
+    Args:
+        tzinfo:  time zone of the run
+        path:    directory to make the temporary directory in, the system
+                 temporary directory if None
+    """
+
+    def __init__(self, tzinfo, path=None):
+        self.tzinfo = tzinfo
+        self.path = tempfile.mkdtemp(prefix='awsm_states_', dir=path)
+        self.owner = True
+        self.states = OrderedDict()
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state['owner'] = False
+        return state
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    @staticmethod
+    def key(tstep):
+        t = pd.Timestamp(tstep)
+        if t.tzinfo is not None:
+            t = t.tz_localize(None)
+        return t
+
+    def add(self, s, tstep, domain=None):
+        """
+        Save a copy of the state at a time step
+
+        Args:
+            s:       dictionary of output variable numpy arrays
+            tstep:   datetime time step
+            domain:  MaskedDomain if running only the active cells
+        """
+
+        key = self.key(tstep)
+        state = model_state(s, tstep, domain, self.tzinfo)
+
+        filename = os.path.join(self.path,
+                                'state_{}.npy'.format(
+                                    key.strftime('%Y%m%d%H%M')))
+        np.save(filename, np.stack([state['fields'][k] for k in INIT_STATE]))
+
+        self.states[key] = {'time': state['time'], 'wyhr': state['wyhr'],
+                            'file': filename}
+
+    def get(self, tstep):
+        """
+        State at a time step
+
+        Args:
+            tstep:  datetime time step
+
+        Returns:
+            state from :func:`model_state`, None if there is no snapshot
+        """
+
+        snap = self.states.get(self.key(tstep))
+        if snap is None:
+            return None
+
+        block = np.load(snap['file'])
+
+        return {'time': snap['time'],
+                'wyhr': snap['wyhr'],
+                'fields': {k: block[i] for i, k in enumerate(INIT_STATE)}}
+
+    def close(self):
+        """
+        Remove the snapshot files if this is the instance that saved them
+        """
+
+        self.states = OrderedDict()
+        if self.owner:
+            shutil.rmtree(self.path, ignore_errors=True)
+
+
+def close_output_files(options):
+    """
+    Flush any buffered output time steps and close the snow and em
+    output files
+
+    Args:
+        options: dictionary of Snobal options
+
+    """
+
+    if 'writer' in options['output']:
+        options['output']['writer'].close()
     else:
-        index = len(times)
-
-    # insert the time
-    options['output']['snow'].variables['time'][index] = t
-    options['output']['em'].variables['time'][index] = t
-
-    # insert the data
-    for key in em_out:
-        if key.lower() in output_vars:
-            options['output']['em'].variables[key][index, :] = em[key]
-    for key in snow_out:
-        if key.lower() in output_vars:
-            options['output']['snow'].variables[key][index, :] = snow[key]
-
-    # sync to disk
-    options['output']['snow'].sync()
-    options['output']['em'].sync()
+        with NC_LOCK:
+            options['output']['snow'].close()
+            options['output']['em'].close()
+
+
+class OutputWriter():
+    """
+    Buffer the PySnobal output time steps and write them to the snow and em
+    netCDF files. Time steps are held in a preallocated float32 buffer and
+    written as one hyperslab per variable once ``buffer_size`` time steps
+    have been collected. The files are only synced when the buffer is
+    flushed.
+
+    When running only the active cells, the packed output fields are
+    scattered back to the full grid before they are buffered.
+
+    Args:
+        options:     dictionary of Snobal options with the open snow and em
+                     datasets and the optional masked domain
+        output_vars: list of variables to output
+        buffer_size: number of output time steps to hold before writing
+    """
+
+    def __init__(self, options, output_vars, buffer_size=1):
+
+        self.snow = options['output']['snow']
+        self.em = options['output']['em']
+        self.buffer_size = max(int(buffer_size), 1)
+        self.domain = options.get('domain')
+
+        # dataset, file variable and output_rec key for each output
+        self.variables = []
+        for key, value in EM_OUT.items():
+            if key.lower() in output_vars:
+                self.variables.append((self.em, key, value))
+        for key, value in SNOW_OUT.items():
+            if key.lower() in output_vars:
+                self.variables.append((self.snow, key, value))
+
+        # map the times already in the file to their index
+        with NC_LOCK:
+            times = self.snow.variables['time']
+            self.units = times.units
+            self.calendar = times.calendar
+            self.time_index = {}
+            for idx, tv in enumerate(times[:]):
+                self.time_index[float(tv)] = idx
+            self.ntimes = len(times)
+
+        # preallocate the buffer
+        shape = (self.buffer_size,
+                 len(self.snow.dimensions['y']),
+                 len(self.snow.dimensions['x']))
+        self.buffer = {}
+        for ds, key, value in self.variables:
+            self.buffer[key] = np.zeros(shape, dtype=np.float32)
+        self.buffer_time = np.zeros(self.buffer_size)
+        if self.domain is not None:
+            # full grid of a packed output field
+            self.grid = np.zeros(shape[1:])
+        self.buffer_index = np.zeros(self.buffer_size, dtype=int)
+        self.count = 0
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def write(self, s, tstep):
+        """
+        Add a time step to the buffer and flush the buffer if it is full
+
+        Args:
+            s:       dictionary of output variable numpy arrays
+            tstep:   datetime time step
+        """
+
+        # offset to match same convention as iSnobal
+        tstep -= pd.to_timedelta(1, unit='h')
+        t = float(nc.date2num(tstep.replace(tzinfo=None), self.units,
+                              self.calendar))
+
+        # find the index in the file, new times are appended
+        index = self.time_index.get(t)
+        if index is None:
+            index = self.ntimes
+            self.time_index[t] = index
+            self.ntimes += 1
+
+        # overwrite the slot if the time is already buffered
+        slot = np.where(self.buffer_index[:self.count] == index)[0]
+        if slot.size > 0:
+            slot = slot[0]
+        else:
+            slot = self.count
+            self.count += 1
+
+        self.buffer_time[slot] = t
+        self.buffer_index[slot] = index
+        for ds, key, value in self.variables:
+            data = s[value]
+            if self.domain is not None:
+                data = self.domain.unpack(data, value, out=self.grid)
+
+            if key in TEMP_OUT:
+                # convert from K to C
+                np.subtract(data, FREEZE, out=self.buffer[key][slot])
+            else:
+                self.buffer[key][slot] = data
+
+        if self.count == self.buffer_size:
+            self.flush()
+
+    def flush(self):
+        """
+        Write the buffered time steps to the files. Consecutive time indices
+        are written with a single hyperslab per variable.
+        """
+
+        if self.count == 0:
+            return
+
+        # split the buffer into runs of consecutive indices
+        index = self.buffer_index[:self.count]
+        breaks = np.where(np.diff(index) != 1)[0] + 1
+        with NC_LOCK:
+            for run in np.split(np.arange(self.count), breaks):
+                slots = slice(run[0], run[-1] + 1)
+                tidx = slice(index[run[0]], index[run[0]] + len(run))
+
+                self.snow.variables['time'][tidx] = self.buffer_time[slots]
+                self.em.variables['time'][tidx] = self.buffer_time[slots]
+
+                for ds, key, value in self.variables:
+                    ds.variables[key][tidx, :] = \
+                        pack_values(ds.variables[key],
+                                    self.buffer[key][slots])
+
+            # sync to disk
+            self.snow.sync()
+            self.em.sync()
+
+        self.count = 0
+
+    def close(self):
+        """
+        Flush the buffer and close the snow and em files
+        """
+
+        with NC_LOCK:
+            if self.snow.isopen():
+                self.flush()
+                self.snow.close()
+                self.em.close()
+
+
+class AsyncOutputWriter(threading.Thread):
+    """
+    Write the PySnobal outputs in a background thread so the model can
+    continue to the next time step while the outputs are written. Each time
+    step is a copy of the output fields placed in a bounded queue, the model
+    will wait when the queue is full. Errors in the writer are raised in the
+    model thread on the next write or when closing.
+
+    Args:
+        writer:     :class:`OutputWriter` that writes to the files
+        queue_size: maximum number of time steps waiting to be written
+        logger:     AWSM logger
+    """
+
+    def __init__(self, writer, queue_size, logger):
+
+        threading.Thread.__init__(self, name='output')
+        self.daemon = True
+        self.writer = writer
+        self.queue = Queue(maxsize=max(int(queue_size), 1))
+        self.error = None
+        self.closed = False
+
+        self._logger = logger
+        self._logger.debug('Initialized output thread')
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def run(self):
+        """
+        Take time steps off the queue and write them until the end of the run
+        """
+
+        while True:
+            item = self.queue.get()
+
+            try:
+                # signal to write what is left and stop
+                if item is None:
+                    if self.error is None:
+                        self.writer.flush()
+                    break
+
+                # drain the queue after an error so the model isn't blocked
+                if self.error is None:
+                    s, tstep = item
+                    self.writer.write(s, tstep)
+
+            except Exception as e:
+                self._logger.error('Error writing outputs: {}'.format(e))
+                self.error = e
+
+            finally:
+                self.queue.task_done()
+
+    def write(self, s, tstep):
+        """
+        Copy the output fields and place them in the queue
+
+        Args:
+            s:       dictionary of output variable numpy arrays
+            tstep:   datetime time step
+        """
+
+        self.check_error()
+
+        snapshot = {}
+        for ds, key, value in self.writer.variables:
+            snapshot[value] = s[value].copy()
+
+        self.queue.put((snapshot, tstep))
+
+    def flush(self):
+        """
+        Wait for all the queued time steps to be written and write any
+        buffered time steps to the files
+        """
+
+        self.queue.join()
+        self.check_error()
+
+        # the thread is waiting for the next time step
+        self.writer.flush()
+
+    def check_error(self):
+        """
+        Raise any error from the writer thread
+        """
+
+        if self.error is not None:
+            raise self.error
+
+    def close(self):
+        """
+        Write all the queued time steps, stop the thread and close the files
+        """
+
+        if self.closed:
+            return
+        self.closed = True
+
+        if self.is_alive():
+            self.queue.put(None)
+            self.join()
+
+        try:
+            self.writer.close()
+        finally:
+            self.check_error()
+
+
+def write_checkpoint(path, data):
+    """
+    Write a checkpoint to a temporary file and move it over the checkpoint
+    file, so a crash while writing leaves the previous checkpoint. This is
+    a module function so it can be run in a background thread.
+
+    Args:
+        path:   checkpoint file
+        data:   dictionary of arrays to save
+    """
+
+    tmp = path + '.tmp'
+    with open(tmp, 'wb') as f:
+        np.savez(f, **data)
+    os.replace(tmp, path)
+
+
+def read_checkpoint(path):
+    """
+    Read a checkpoint written by :class:`CheckpointWriter`
+
+    Args:
+        path:   checkpoint file
+
+    Returns:
+        dictionary with the state ``names`` and ``block``, the loop counter
+        ``j``, the last time step ``time`` and the forcing ``input1``
+    """
+
+    with np.load(path) as f:
+        ckpt = {'names': [str(n) for n in f['names']],
+                'block': f['state'],
+                'j': int(f['j']),
+                'time': pd.to_datetime(str(f['time'])),
+                'input1': {}}
+        for key in f.files:
+            if key.startswith('input_'):
+                ckpt['input1'][key[len('input_'):]] = f[key]
+
+    return ckpt
+
+
+def restore_checkpoint(path, state, date_time):
+    """
+    Restore the PySnobal state from a checkpoint
+
+    Args:
+        path:       checkpoint file
+        state:      :class:`~awsm.interface.initialize_model.SnobalState`
+        date_time:  time steps of the run
+
+    Returns:
+        tuple of the loop counter, the index in date_time of the first time
+        step to run and the forcing for the previous time step. The index is
+        len(date_time) if the checkpoint is at the last time step.
+    """
+
+    ckpt = read_checkpoint(path)
+
+    if ckpt['names'] != state.names or \
+            ckpt['block'].shape != state.block.shape:
+        raise ValueError('Checkpoint {} does not match the PySnobal state'
+                         .format(path))
+
+    try:
+        index = list(date_time).index(ckpt['time'])
+    except ValueError:
+        raise ValueError('Checkpoint time {} is not in the run from {} to {}'
+                         .format(ckpt['time'], date_time[0], date_time[-1]))
+
+    state.restore(ckpt['block'])
+
+    return ckpt['j'], index + 1, ckpt['input1']
+
+
+class CheckpointWriter():
+    """
+    Save the full PySnobal state, the loop counter and the forcing for the
+    last time step so a run can be restarted exactly where it was. The
+    state is copied in the model thread and written in a background thread
+    while the model continues, one checkpoint at a time.
+
+    Args:
+        path:       checkpoint file
+        state:      :class:`~awsm.interface.initialize_model.SnobalState`
+        frequency:  number of time steps between checkpoints
+        logger:     AWSM logger
+    """
+
+    def __init__(self, path, state, frequency, logger):
+
+        self.path = path
+        self.state = state
+        self.frequency = frequency
+        self.executor = ThreadPoolExecutor(max_workers=1)
+        self.future = None
+
+        self._logger = logger
+        self._logger.info('Saving a checkpoint every {} time steps to {}'
+                          .format(frequency, path))
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def save(self, j, tstep, input1, writer=None):
+        """
+        Save a checkpoint if j is at the checkpoint frequency
+
+        Args:
+            j:          loop counter for the next time step
+            tstep:      last time step that was run
+            input1:     forcing for the last time step
+            writer:     output writer to flush before the checkpoint so the
+                        outputs up to tstep are in the files
+        """
+
+        if (j - 1) % self.frequency != 0:
+            return
+
+        if writer is not None:
+            writer.flush()
+
+        # wait for the previous checkpoint and raise any errors
+        self.wait()
+
+        data = {'names': np.array(self.state.names),
+                'state': self.state.snapshot(),
+                'j': j,
+                'time': pd.Timestamp(tstep).isoformat()}
+        for key, value in input1.items():
+            data['input_{}'.format(key)] = np.array(value, copy=True)
+
+        self.future = self.executor.submit(write_checkpoint, self.path, data)
+        self._logger.debug('Saving checkpoint for {}'.format(tstep))
+
+    def wait(self):
+        """
+        Wait for the checkpoint being written
+        """
+
+        if self.future is not None:
+            future = self.future
+            self.future = None
+            future.result()
+
+    def close(self):
+        """
+        Wait for the last checkpoint and stop the thread
+        """
+
+        try:
+            self.wait()
+        finally:
+            self.executor.shutdown(wait=True)
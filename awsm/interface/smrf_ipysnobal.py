@@ -6,20 +6,17 @@ threaded together
 """
 
 import sys
-import numpy as np
 import pandas as pd
 from datetime import datetime
-import pytz
 import netCDF4 as nc
 
 import smrf
 from smrf.utils import queue
 from spatialnc import ipw
-from smrf.envphys import radiation
 from awsm.interface import ipysnobal
 from awsm.interface import interface
-from awsm.interface import initialize_model as initmodel
 from awsm.interface import pysnobal_io as io_mod
+from awsm.interface import solar
 from awsm.interface.ingest_data import StateUpdater
 
 try:
@@ -51,17 +48,63 @@ def run_ipysnobal(myawsm):
     start_step = 0  # if restart then it would be higher if this were iSnobal
     step_time = start_step * data_tstep
 
-    output_rec['current_time'] = step_time * np.ones(output_rec['elevation'].shape)
-    output_rec['time_since_out'] = timeSinceOut * np.ones(output_rec['elevation'].shape)
+    output_rec['current_time'][:] = step_time
+    output_rec['time_since_out'][:] = timeSinceOut
 
     myawsm._logger.info('getting inputs for first timestep')
     if myawsm.forcing_data_type == 'netcdf':
         force = io_mod.open_files_nc(myawsm)
-        input1 = initmodel.get_timestep_netcdf(force, options['time']['date_time'][0])
+        reader = io_mod.ForcingReader(force, options['time']['date_time'],
+                                      myawsm.forcing_read_steps,
+                                      cache_size=myawsm.forcing_cache_size,
+                                      domain=options['domain'])
+        get_forcing = reader.get
     else:
         input_list, ppt_list = io_mod.open_files_ipw(myawsm)
-        input1 = initmodel.get_timestep_ipw(options['time']['date_time'][0],
-                                            input_list, ppt_list, myawsm)
+        reader = io_mod.IPWForcingReader(myawsm, input_list, ppt_list,
+                                         options['time']['date_time'],
+                                         myawsm.ipw_processes,
+                                         myawsm.forcing_cache_size,
+                                         options['domain'])
+        get_forcing = reader.get
+
+    # start from the first time step or where the checkpoint left off
+    j = 1
+    start = 1
+    if myawsm.restart_from_checkpoint:
+        j, start, input1 = \
+            io_mod.restore_checkpoint(myawsm.checkpoint_file,
+                                      options['state'],
+                                      options['time']['date_time'])
+        if start >= len(options['time']['date_time']):
+            myawsm._logger.info('Checkpoint {} is at the end of the run, '
+                                'no time steps left to run'
+                                .format(myawsm.checkpoint_file))
+        else:
+            myawsm._logger.info('Restarting from checkpoint {} at {}'
+                                .format(myawsm.checkpoint_file,
+                                        options['time']['date_time'][start]))
+    else:
+        input1 = get_forcing(options['time']['date_time'][0])
+
+    # read the forcing data ahead of the model in background threads
+    prefetcher = None
+    if myawsm.prefetch_depth > 0:
+        myawsm._logger.info('Reading forcing data {} time steps ahead'
+                            .format(myawsm.prefetch_depth))
+        prefetcher = io_mod.ForcingPrefetcher(get_forcing,
+                                              options['time']['date_time'][start:],
+                                              myawsm.prefetch_depth,
+                                              myawsm.prefetch_threads)
+        get_forcing = prefetcher.get
+
+    # save the state every checkpoint_frequency time steps
+    checkpoint = None
+    if myawsm.checkpoint_frequency > 0:
+        checkpoint = io_mod.CheckpointWriter(myawsm.checkpoint_file,
+                                             options['state'],
+                                             myawsm.checkpoint_frequency,
+                                             myawsm._logger)
 
     # initialize updater if required
     if myawsm.update_depth:
@@ -69,56 +112,84 @@ def run_ipysnobal(myawsm):
     else:
         updater = None
 
+    # the state is at the time step before the first one to run
+    last_tstep = options['time']['date_time'][start - 1]
+
     myawsm._logger.info('starting PySnobal time series loop')
-    j = 1
     # run PySnobal
-    for tstep in options['time']['date_time'][1:]:
-        # for tstep in options['time']['date_time'][953:958]:
-        myawsm._logger.info('running PySnobal for timestep: {}'.format(tstep))
-        if myawsm.forcing_data_type == 'netcdf':
-            input2 = initmodel.get_timestep_netcdf(force, tstep)
-        else:
-            input2 = initmodel.get_timestep_ipw(tstep, input_list, ppt_list, myawsm)
-
-        first_step = j
-        # update depth if necessary
+    try:
+        for tstep in options['time']['date_time'][start:]:
+            # for tstep in options['time']['date_time'][953:958]:
+            myawsm._logger.info('running PySnobal for timestep: {}'.format(tstep))
+            input2 = get_forcing(tstep)
+
+            first_step = j
+            # update depth if necessary
+            if updater is not None:
+                if tstep in updater.update_dates:
+                    start_z = output_rec['z_s'].copy()
+                    output_rec = \
+                        updater.do_update_pysnobal(output_rec, tstep,
+                                                   options['domain'])
+                    first_step = 1
+
+            rt = snobal.do_tstep_grid(input1, input2, output_rec, tstep_info,
+                                      options['constants'], params, first_step=first_step,
+                                      nthreads=myawsm.ipy_threads)
+
+            if rt != -1:
+                raise ValueError('ipysnobal error on time step %s, pixel %i' % (tstep, rt))
+                # break
+
+            input1 = input2.copy()
+
+            # output at the frequency and the last time step
+            if ((j)*(data_tstep/3600.0) % options['output']['frequency'] == 0) \
+                    or (j == len(options['time']['date_time']) - 1):
+                myawsm._logger.info('Outputting {}'.format(tstep))
+                io_mod.output_timestep(output_rec, tstep, options,
+                                       myawsm.pysnobal_output_vars)
+                output_rec['time_since_out'][:] = 0.0
+
+            myawsm._logger.info('Finished timestep: {}'.format(tstep))
+
+            j += 1
+            last_tstep = tstep
+
+            if checkpoint is not None:
+                checkpoint.save(j, tstep, input1,
+                                options['output'].get('writer'))
+
+            # if input has run_for_nsteps, make sure not to go past it
+            if myawsm.run_for_nsteps is not None:
+                if j > myawsm.run_for_nsteps:
+                    break
+
+    finally:
+        # stop reading ahead before closing the input files
+        if prefetcher is not None:
+            prefetcher.close()
+
+        # finish writing the last checkpoint
+        if checkpoint is not None:
+            checkpoint.close()
+
+        # write any buffered outputs, even if the run failed
+        io_mod.close_output_files(options)
+
+        # write the changes from any depth updates
         if updater is not None:
-            if tstep in updater.update_dates:
-                start_z = output_rec['z_s'].copy()
-                output_rec = \
-                    updater.do_update_pysnobal(output_rec, tstep)
-                first_step = 1
-
-        rt = snobal.do_tstep_grid(input1, input2, output_rec, tstep_info,
-                                  options['constants'], params, first_step=first_step,
-                                  nthreads=myawsm.ipy_threads)
-
-        if rt != -1:
-            raise ValueError('ipysnobal error on time step %s, pixel %i' % (tstep, rt))
-            # break
-
-        input1 = input2.copy()
+            updater.close()
 
-        # output at the frequency and the last time step
-        if ((j)*(data_tstep/3600.0) % options['output']['frequency'] == 0) \
-                or (j == len(options['time']['date_time']) - 1):
-            myawsm._logger.info('Outputting {}'.format(tstep))
-            io_mod.output_timestep(output_rec, tstep, options,
-                                   myawsm.pysnobal_output_vars)
-            output_rec['time_since_out'] = np.zeros(output_rec['elevation'].shape)
-
-        myawsm._logger.info('Finished timestep: {}'.format(tstep))
-
-        j += 1
-
-        # if input has run_for_nsteps, make sure not to go past it
-        if myawsm.run_for_nsteps is not None:
-            if j > myawsm.run_for_nsteps:
-                break
+        # close input files
+        if myawsm.forcing_data_type == 'netcdf':
+            io_mod.close_files(force)
+        else:
+            reader.close()
 
-    # close input files
-    if myawsm.forcing_data_type == 'netcdf':
-        io_mod.close_files(force)
+    # keep the state to initialize the next run from
+    myawsm.model_state = ipysnobal.get_model_state(myawsm, options,
+                                                   last_tstep)
 
 
 def run_smrf_ipysnobal(myawsm):
@@ -215,6 +286,14 @@ def run_smrf_ipysnobal_single(myawsm, s):
         updater = StateUpdater(myawsm)
     else:
         updater = None
+    # save the state every checkpoint_frequency time steps
+    checkpoint = None
+    if myawsm.checkpoint_frequency > 0:
+        checkpoint = io_mod.CheckpointWriter(myawsm.checkpoint_file,
+                                             options['state'],
+                                             myawsm.checkpoint_frequency,
+                                             myawsm._logger)
+
     # initialize pysnobal run class
     my_pysnobal = ipysnobal.PySnobal(s.date_time,
                                      variable_list,
@@ -228,97 +307,139 @@ def run_smrf_ipysnobal_single(myawsm, s):
                                      s.topo.ny,
                                      myawsm.soil_temp,
                                      myawsm._logger,
-                                     myawsm.tzinfo)
+                                     myawsm.tzinfo,
+                                     checkpoint)
+
+    # -------------------------------------
+    # solar geometry from the cache for the basin and dates, if any
+    solar_cache = None
+    if myawsm.solar_cache_dir is not None:
+        solar_cache = solar.SolarGeometry(s.topo.slope, s.topo.aspect,
+                                          s.topo.topoConfig['basin_lat'],
+                                          s.topo.topoConfig['basin_lon'],
+                                          s.date_time,
+                                          myawsm.solar_cache_dir,
+                                          myawsm._logger)
+
+    # -------------------------------------
+    # PySnobal can run a time step in another thread while SMRF distributes
+    # the next time steps, with copies of the forcing data
+    pipeline = None
+    if myawsm.smrf_pipeline_depth > 0:
+        myawsm._logger.info('running PySnobal up to {} time steps behind SMRF'
+                            .format(myawsm.smrf_pipeline_depth))
+        pipeline = ipysnobal.PySnobalPipeline(my_pysnobal,
+                                              myawsm.smrf_pipeline_depth)
 
     # -------------------------------------
     # Distribute the data
-    for output_count, t in enumerate(s.date_time):
-        # wait here for the model to catch up if needed
+    try:
+        for output_count, t in enumerate(s.date_time):
+            # wait here for the model to catch up if needed
 
-        startTime = datetime.now()
+            startTime = datetime.now()
 
-        s._logger.info('Distributing time step %s' % t)
-        # 0.1 sun angle for time step
-        cosz, azimuth = radiation.sunang(t.astimezone(pytz.utc),
-                                         s.topo.topoConfig['basin_lat'],
+            s._logger.info('Distributing time step %s' % t)
+            # 0.1 sun angle and 0.2 illumination angle for time step
+            if solar_cache is not None:
+                cosz, azimuth, illum_ang = solar_cache.get(t)
+            else:
+                cosz, azimuth, illum_ang = \
+                    solar.solar_geometry(t, s.topo.topoConfig['basin_lat'],
                                          s.topo.topoConfig['basin_lon'],
-                                         zone=0,
-                                         slope=0,
-                                         aspect=0)
-
-        # 0.2 illumination angle
-        illum_ang = None
-        if cosz > 0:
-            illum_ang = radiation.shade(s.topo.slope,
-                                        s.topo.aspect,
-                                        azimuth,
-                                        cosz)
-
-        # 1. Air temperature
-        s.distribute['air_temp'].distribute(s.data.air_temp.loc[t])
-
-        # 2. Vapor pressure
-        s.distribute['vapor_pressure'].distribute(s.data.vapor_pressure.loc[t],
-                                                    s.distribute['air_temp'].air_temp)
-
-        # 3. Wind_speed and wind_direction
-        s.distribute['wind'].distribute(s.data.wind_speed.loc[t],
-                                        s.data.wind_direction.loc[t],
-                                        t)
-
-        # 4. Precipitation
-        s.distribute['precip'].distribute(s.data.precip.loc[t],
-                                            s.distribute['vapor_pressure'].dew_point,
-                                            s.distribute['vapor_pressure'].precip_temp,
-                                            s.distribute['air_temp'].air_temp,
-                                            t,
-                                            s.data.wind_speed.loc[t],
-                                            s.data.air_temp.loc[t],
-                                            s.distribute['wind'].wind_direction,
-                                            s.distribute['wind'].dir_round_cell,
-                                            s.distribute['wind'].wind_speed,
-                                            s.distribute['wind'].cellmaxus)
-
-        # 5. Albedo
-        s.distribute['albedo'].distribute(t,
-                                             illum_ang,
-                                             s.distribute['precip'].storm_days)
-
-        # 6. Solar
-        s.distribute['solar'].distribute(s.data.cloud_factor.loc[t],
-                                            illum_ang,
-                                            cosz,
-                                            azimuth,
-                                            s.distribute['precip'].last_storm_day_basin,
-                                            s.distribute['albedo'].albedo_vis,
-                                            s.distribute['albedo'].albedo_ir)
-
-        # 7. thermal radiation
-        if s.distribute['thermal'].gridded and \
-           s.config['gridded']['data_type'] != 'hrrr':
-            s.distribute['thermal'].distribute_thermal(s.data.thermal.loc[t],
-                                                          s.distribute['air_temp'].air_temp)
-        else:
-            s.distribute['thermal'].distribute(t,
-                                               s.distribute['air_temp'].air_temp,
-                                               s.distribute['vapor_pressure'].vapor_pressure,
-                                               s.distribute['vapor_pressure'].dew_point,
-                                               s.distribute['solar'].cloud_factor)
-
-        # 8. Soil temperature
-        s.distribute['soil_temp'].distribute()
-
-        # 9. pass info to PySnobal
-        if output_count == 0:
-            my_pysnobal.run_single_fist_step(s)
-        elif output_count > 0:
-            my_pysnobal.run_single(t, s, updater)
-        else:
-            raise ValueError('Problem with times in run ipysnobal single')
+                                         s.topo.slope, s.topo.aspect)
+
+            # 1. Air temperature
+            s.distribute['air_temp'].distribute(s.data.air_temp.loc[t])
+
+            # 2. Vapor pressure
+            s.distribute['vapor_pressure'].distribute(s.data.vapor_pressure.loc[t],
+                                                        s.distribute['air_temp'].air_temp)
+
+            # 3. Wind_speed and wind_direction
+            s.distribute['wind'].distribute(s.data.wind_speed.loc[t],
+                                            s.data.wind_direction.loc[t],
+                                            t)
+
+            # 4. Precipitation
+            s.distribute['precip'].distribute(s.data.precip.loc[t],
+                                                s.distribute['vapor_pressure'].dew_point,
+                                                s.distribute['vapor_pressure'].precip_temp,
+                                                s.distribute['air_temp'].air_temp,
+                                                t,
+                                                s.data.wind_speed.loc[t],
+                                                s.data.air_temp.loc[t],
+                                                s.distribute['wind'].wind_direction,
+                                                s.distribute['wind'].dir_round_cell,
+                                                s.distribute['wind'].wind_speed,
+                                                s.distribute['wind'].cellmaxus)
+
+            # 5. Albedo
+            s.distribute['albedo'].distribute(t,
+                                                 illum_ang,
+                                                 s.distribute['precip'].storm_days)
+
+            # 6. Solar
+            s.distribute['solar'].distribute(s.data.cloud_factor.loc[t],
+                                                illum_ang,
+                                                cosz,
+                                                azimuth,
+                                                s.distribute['precip'].last_storm_day_basin,
+                                                s.distribute['albedo'].albedo_vis,
+                                                s.distribute['albedo'].albedo_ir)
+
+            # 7. thermal radiation
+            if s.distribute['thermal'].gridded and \
+               s.config['gridded']['data_type'] != 'hrrr':
+                s.distribute['thermal'].distribute_thermal(s.data.thermal.loc[t],
+                                                              s.distribute['air_temp'].air_temp)
+            else:
+                s.distribute['thermal'].distribute(t,
+                                                   s.distribute['air_temp'].air_temp,
+                                                   s.distribute['vapor_pressure'].vapor_pressure,
+                                                   s.distribute['vapor_pressure'].dew_point,
+                                                   s.distribute['solar'].cloud_factor)
+
+            # 8. Soil temperature
+            s.distribute['soil_temp'].distribute()
+
+            # 9. pass info to PySnobal
+            if pipeline is not None:
+                pipeline.submit(output_count, t, s, updater)
+            elif output_count == 0:
+                my_pysnobal.run_single_fist_step(s)
+            elif output_count > 0:
+                my_pysnobal.run_single(t, s, updater)
+            else:
+                raise ValueError('Problem with times in run ipysnobal single')
+
+            telapsed = datetime.now() - startTime
+            s._logger.debug('{0:.2f} seconds for time step'
+                            .format(telapsed.total_seconds()))
+
+        # wait for PySnobal to finish the last time steps
+        if pipeline is not None:
+            pipeline.wait()
 
-        telapsed = datetime.now() - startTime
-        s._logger.debug('{0:.2f} seconds for time step'
-                        .format(telapsed.total_seconds()))
+    finally:
+        # stop PySnobal before writing the outputs
+        if pipeline is not None:
+            pipeline.close()
+
+        # finish writing the last checkpoint
+        if checkpoint is not None:
+            checkpoint.close()
+
+        # write any buffered outputs, even if the run failed
+        io_mod.close_output_files(options)
+
+        # write the changes from any depth updates
+        if updater is not None:
+            updater.close()
+
+    # keep the state to initialize the next run from
+    myawsm.model_state = ipysnobal.get_model_state(myawsm, options,
+                                                   s.date_time[-1])
 
     s.forcing_data = 1
 
@@ -353,28 +474,58 @@ def run_smrf_ipysnobal_threaded(myawsm, s):
     else:
         updater = None
 
+    # save the state every checkpoint_frequency time steps
+    checkpoint = None
+    if myawsm.checkpoint_frequency > 0:
+        checkpoint = io_mod.CheckpointWriter(myawsm.checkpoint_file,
+                                             options['state'],
+                                             myawsm.checkpoint_frequency,
+                                             myawsm._logger)
+
     # isnobal thread
-    t.append(ipysnobal.QueueIsnobal(q, s.date_time,
-                                    s.thread_variables,
-                                    myawsm.pysnobal_output_vars,
-                                    options,
-                                    params,
-                                    tstep_info,
-                                    init,
-                                    output_rec,
-                                    s.topo.nx,
-                                    s.topo.ny,
-                                    myawsm.soil_temp,
-                                    myawsm._logger,
-                                    myawsm.tzinfo,
-                                    updater))
+    isnobal_thread = ipysnobal.QueueIsnobal(q, s.date_time,
+                                            s.thread_variables,
+                                            myawsm.pysnobal_output_vars,
+                                            options,
+                                            params,
+                                            tstep_info,
+                                            init,
+                                            output_rec,
+                                            s.topo.nx,
+                                            s.topo.ny,
+                                            myawsm.soil_temp,
+                                            myawsm._logger,
+                                            myawsm.tzinfo,
+                                            updater,
+                                            checkpoint)
+    t.append(isnobal_thread)
 
     # the cleaner
     t.append(queue.QueueCleaner(s.date_time, q))
 
     # start all the threads
-    for i in range(len(t)):
-        t[i].start()
+    try:
+        for i in range(len(t)):
+            t[i].start()
+
+        for i in range(len(t)):
+            t[i].join()
+
+    finally:
+        # finish writing the last checkpoint
+        if checkpoint is not None:
+            checkpoint.close()
 
-    for i in range(len(t)):
-        t[i].join()
+        # write any buffered outputs, even if the run failed
+        io_mod.close_output_files(options)
+
+        # write the changes from any depth updates
+        if updater is not None:
+            updater.close()
+
+    # keep the state to initialize the next run from, if PySnobal did not
+    # stop early
+    if isnobal_thread.last_tstep == s.date_time[-1]:
+        myawsm.model_state = \
+            ipysnobal.get_model_state(myawsm, options,
+                                      isnobal_thread.last_tstep)
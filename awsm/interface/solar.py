@@ -0,0 +1,196 @@
+# -*- coding: utf-8 -*-
+"""
+Cache of the solar geometry for running SMRF and PySnobal together
+
+The sun angles and the illumination angle of the terrain only depend on the
+time and the topography, so they are computed once for a basin and a date
+range and saved to memory mapped files that later runs read from.
+"""
+
+import os
+import shutil
+import hashlib
+import tempfile
+import numpy as np
+import pytz
+
+from smrf.envphys import radiation
+
+
+def solar_geometry(t, lat, lon, slope, aspect):
+    """
+    Sun angle and illumination angle for a time step, the same as computed
+    for each time step by SMRF
+
+    Args:
+        t:          timezone aware datetime
+        lat:        basin latitude
+        lon:        basin longitude
+        slope:      topo slope image
+        aspect:     topo aspect image
+
+    Returns:
+        tuple of cosz, azimuth and the illumination angle image, which is
+        None when the sun is down
+    """
+
+    cosz, azimuth = radiation.sunang(t.astimezone(pytz.utc), lat, lon,
+                                     zone=0, slope=0, aspect=0)
+
+    illum_ang = None
+    if cosz > 0:
+        illum_ang = radiation.shade(slope, aspect, azimuth, cosz)
+
+    return cosz, azimuth, illum_ang
+
+
+def solar_cache_key(slope, aspect, lat, lon, date_time):
+    """
+    Key for the cache of a basin and date range, from a hash of the topo
+    and the dates
+
+    Args:
+        slope:      topo slope image
+        aspect:     topo aspect image
+        lat:        basin latitude
+        lon:        basin longitude
+        date_time:  list of timezone aware datetimes
+
+    Returns:
+        hex digest
+    """
+
+    h = hashlib.sha1()
+    for data in [slope, aspect]:
+        data = np.ascontiguousarray(data, dtype=np.float64)
+        h.update(str(data.shape).encode())
+        h.update(data.tobytes())
+    h.update('{!r} {!r}'.format(float(lat), float(lon)).encode())
+    for t in date_time:
+        h.update(t.astimezone(pytz.utc).isoformat().encode())
+
+    return h.hexdigest()
+
+
+class SolarGeometry():
+    """
+    Solar geometry for every time step of a run, read from memory mapped
+    files in the cache directory. The cache is created the first time a basin
+    and date range is run and the images are flushed to the file every few
+    time steps so the memory used does not depend on the length of the run.
+    Only the time steps with the sun up have an illumination angle image.
+    """
+
+    def __init__(self, slope, aspect, lat, lon, date_time, cache_dir,
+                 logger, flush_every=24):
+        """
+        Args:
+            slope:      topo slope image
+            aspect:     topo aspect image
+            lat:        basin latitude
+            lon:        basin longitude
+            date_time:  list of timezone aware datetimes
+            cache_dir:  directory for the cached solar geometry
+            logger:     AWSM logger
+            flush_every: number of illumination images computed before
+                         they are flushed to the cache
+        """
+
+        self._logger = logger
+        self.index = {t: k for k, t in enumerate(date_time)}
+
+        key = solar_cache_key(slope, aspect, lat, lon, date_time)
+        self.path = os.path.join(cache_dir, 'solar_{}'.format(key[:16]))
+
+        if os.path.isdir(self.path):
+            self._logger.info('Reading solar geometry from {}'
+                              .format(self.path))
+        else:
+            self._logger.info('Saving solar geometry to {}'.format(self.path))
+            self.create(slope, aspect, lat, lon, date_time, cache_dir,
+                        flush_every)
+
+        # copy on write so the images can be changed without changing the
+        # cache
+        self.sun = np.load(os.path.join(self.path, 'sun.npy'))
+        self.illum_index = np.load(os.path.join(self.path, 'illum_index.npy'))
+        self.illum_ang = np.load(os.path.join(self.path, 'illum_ang.npy'),
+                                 mmap_mode='c')
+
+    def create(self, slope, aspect, lat, lon, date_time, cache_dir,
+               flush_every):
+        """
+        Compute the solar geometry for all of the time steps and save it to
+        the cache. The files are written to a temporary directory that is
+        renamed when done, so runs sharing the cache never see part of it.
+
+        radiation.shade takes a single sun azimuth and cosine of the zenith,
+        so the illumination images are computed one time step at a time and
+        only the flushes to the file are done every flush_every images.
+        """
+
+        nt = len(date_time)
+        sun = np.zeros((nt, 2))
+        for k, t in enumerate(date_time):
+            sun[k] = radiation.sunang(t.astimezone(pytz.utc), lat, lon,
+                                      zone=0, slope=0, aspect=0)
+
+        # position of each time step in the illumination images
+        day = sun[:, 0] > 0
+        illum_index = np.full(nt, -1, dtype=np.int64)
+        illum_index[day] = np.arange(np.sum(day))
+
+        if not os.path.isdir(cache_dir):
+            os.makedirs(cache_dir)
+        tmp_dir = tempfile.mkdtemp(prefix='.solar_', dir=cache_dir)
+        try:
+            np.save(os.path.join(tmp_dir, 'sun.npy'), sun)
+            np.save(os.path.join(tmp_dir, 'illum_index.npy'), illum_index)
+
+            illum_ang = np.lib.format.open_memmap(
+                os.path.join(tmp_dir, 'illum_ang.npy'), mode='w+',
+                dtype=np.float64,
+                shape=(max(int(np.sum(day)), 1),) + tuple(slope.shape))
+
+            for n, k in enumerate(np.flatnonzero(day)):
+                illum_ang[illum_index[k]] = radiation.shade(slope, aspect,
+                                                            sun[k, 1],
+                                                            sun[k, 0])
+                if (n + 1) % flush_every == 0:
+                    illum_ang.flush()
+
+            illum_ang.flush()
+            del illum_ang
+
+            try:
+                os.rename(tmp_dir, self.path)
+            except OSError:
+                # another run saved the same cache first
+                if not os.path.isdir(self.path):
+                    raise
+                shutil.rmtree(tmp_dir)
+
+        except Exception:
+            shutil.rmtree(tmp_dir, ignore_errors=True)
+            raise
+
+    def get(self, t):
+        """
+        Solar geometry for a time step
+
+        Args:
+            t:  datetime in the date range of the cache
+
+        Returns:
+            tuple of cosz, azimuth and the illumination angle image, which is
+            None when the sun is down
+        """
+
+        k = self.index[t]
+        cosz, azimuth = self.sun[k]
+
+        illum_ang = None
+        if self.illum_index[k] >= 0:
+            illum_ang = self.illum_ang[self.illum_index[k]]
+
+        return cosz, azimuth, illum_ang
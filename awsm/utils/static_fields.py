@@ -0,0 +1,193 @@
+# -*- coding: utf-8 -*-
+"""
+Registry of the static fields of a run
+
+The topo images and init fields do not change during a run, so they are
+saved once to .npy files and read back as read only memory maps. Processes
+that attach to the fields by name share the same pages of the files, so the
+fields are in memory once no matter how many processes use them. The
+fields are pickled as their files, so a field passed to a process that was
+not forked attaches to the file instead of copying the data.
+"""
+
+import os
+import shutil
+import tempfile
+
+import numpy as np
+
+# topo images and coordinates shared by the registry
+TOPO_FIELDS = ['dem', 'mask', 'roughness', 'slope', 'aspect', 'x', 'y']
+
+
+class StaticFields():
+    """
+    Read only fields saved to memory mapped .npy files in a temporary
+    directory that is removed by :func:`close`. A registry passed to another
+    process only pickles the directory, and the fields are attached again by
+    name.
+
+    Args:
+        path:   directory to make the temporary directory in, the system
+                temporary directory if None
+    """
+
+    def __init__(self, path=None):
+
+        self.path = tempfile.mkdtemp(prefix='awsm_static_', dir=path)
+        self.owner = True
+        self._fields = {}
+
+    def __getstate__(self):
+        return {'path': self.path}
+
+    def __setstate__(self, state):
+        self.path = state['path']
+        self.owner = False
+        self._fields = {}
+
+    def __contains__(self, name):
+        return os.path.isfile(self.filename(name))
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def filename(self, name):
+        """
+        File of a field in the registry
+        """
+
+        return os.path.join(self.path, '{}.npy'.format(name))
+
+    def holds(self, data):
+        """
+        Check if an array is attached to a field of this registry
+        """
+
+        field_file = getattr(data, 'field_file', None)
+        return field_file is not None and \
+            os.path.dirname(field_file) == self.path
+
+    def add(self, name, data):
+        """
+        Save a field to the registry, replacing any field with the same name.
+        The file is written under another name and renamed so processes never
+        attach to part of a field.
+
+        Args:
+            name:   name of the field
+            data:   numpy array
+
+        Returns:
+            read only memory map of the field
+        """
+
+        tmp = os.path.join(self.path, '.{}.tmp.npy'.format(name))
+        np.save(tmp, np.asarray(data))
+        os.replace(tmp, self.filename(name))
+        self._fields.pop(name, None)
+
+        return self.get(name)
+
+    def get(self, name):
+        """
+        Attach to a field in the registry
+
+        Args:
+            name:   name of the field
+
+        Returns:
+            read only memory map of the field
+        """
+
+        if name not in self._fields:
+            self._fields[name] = attach(self.filename(name))
+
+        return self._fields[name]
+
+    def close(self):
+        """
+        Detach from the fields and remove the directory if it is temporary
+        """
+
+        self._fields = {}
+        if self.owner:
+            shutil.rmtree(self.path, ignore_errors=True)
+
+
+class SharedField(np.memmap):
+    """
+    Read only memory map of a field file that is pickled as the file, see
+    :func:`attach`. Arrays derived from a field are pickled as usual.
+    """
+
+    def __array_finalize__(self, obj):
+        super().__array_finalize__(obj)
+        self.field_file = None
+
+    def __reduce__(self):
+        if self.field_file is None:
+            return super().__reduce__()
+        return (attach, (self.field_file,))
+
+
+def attach(filename):
+    """
+    Attach to a field file
+
+    Args:
+        filename:   .npy file of the field
+
+    Returns:
+        read only :class:`SharedField` memory map of the field
+    """
+
+    data = np.load(filename, mmap_mode='r').view(SharedField)
+    data.field_file = filename
+
+    return data
+
+
+def is_shared(data):
+    """
+    Check if an array is already a read only memory map
+    """
+
+    return isinstance(data, np.memmap) and not data.flags.writeable
+
+
+def share_topo(registry, topo):
+    """
+    Put the topo images in the registry and replace them on the topo
+    instance with their read only memory maps. Images shared by another
+    registry, like a topo passed from the previous day, are saved again so
+    they do not depend on a directory that was removed.
+
+    Args:
+        registry:   :class:`StaticFields`
+        topo:       topo instance
+    """
+
+    for k in TOPO_FIELDS:
+        v = getattr(topo, k, None)
+        if v is not None and not registry.holds(v):
+            setattr(topo, k, registry.add('topo_{}'.format(k), v))
+
+
+def share_init(registry, init, prefix='init'):
+    """
+    Put the init fields in the registry and replace them in the init
+    dictionary with their read only memory maps
+
+    Args:
+        registry:   :class:`StaticFields`
+        init:       dictionary of init fields
+        prefix:     prefix of the names of the fields in the registry
+    """
+
+    for k, v in init.items():
+        if isinstance(v, np.ndarray) and not registry.holds(v):
+            init[k] = registry.add('{}_{}'.format(prefix, k), v)
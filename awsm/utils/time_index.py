@@ -0,0 +1,206 @@
+# -*- coding: utf-8 -*-
+"""
+Time index of the AWSM netCDF files
+
+Finding a time step in the snow, em or update files only needs the water year
+hours of the time axis. These are computed from the numeric time values and
+the units with NumPy instead of converting every value to a datetime, and are
+kept for each file until it is changed, so the init, restart and update code
+can share them.
+"""
+
+import os
+import re
+import threading
+from datetime import datetime
+
+import netCDF4 as nc
+import numpy as np
+
+# seconds in each unit allowed in the CF time units
+UNIT_SECONDS = {
+    'second': 1, 'seconds': 1, 'sec': 1, 'secs': 1, 's': 1,
+    'minute': 60, 'minutes': 60, 'min': 60, 'mins': 60,
+    'hour': 3600, 'hours': 3600, 'hr': 3600, 'hrs': 3600, 'h': 3600,
+    'day': 86400, 'days': 86400, 'd': 86400,
+}
+
+# calendars that are the same as numpy datetime64
+STANDARD_CALENDARS = ['standard', 'gregorian', 'proleptic_gregorian']
+
+REFERENCE_DATE = re.compile(r'^(\d{4})-(\d{1,2})-(\d{1,2})'
+                            r'(?:[ T](\d{1,2}):(\d{1,2})'
+                            r'(?::(\d{1,2})(?:\.\d*)?)?)?$')
+
+_cache = {}
+_lock = threading.Lock()
+
+
+def parse_time_units(units):
+    """
+    Parse CF time units like 'hours since 2017-10-01 00:00:00'
+
+    Args:
+        units:  units attribute of the time variable
+
+    Returns:
+        tuple of the seconds in a time unit and the reference date as a
+        datetime64, or None if the units are not in a form that can be
+        computed with NumPy
+    """
+
+    parts = units.strip().split(' since ')
+    if len(parts) != 2:
+        return None
+
+    step = UNIT_SECONDS.get(parts[0].strip().lower())
+    m = REFERENCE_DATE.match(parts[1].strip())
+    if step is None or m is None:
+        return None
+
+    ref = datetime(*[int(v) if v is not None else 0 for v in m.groups()])
+
+    return step, np.datetime64(ref, 's')
+
+
+def water_year_hours_of(dates):
+    """
+    Water year hours of dates, the same as utils.water_day()[0]*24 for each
+    date. The water year starts on October 1st
+
+    Args:
+        dates:  array of datetime64
+
+    Returns:
+        float array of the hours since the start of the water year of each date
+    """
+
+    dates = np.asarray(dates, dtype='datetime64[s]')
+    year = dates.astype('datetime64[Y]')
+    month = (dates.astype('datetime64[M]') -
+             year.astype('datetime64[M]')).astype(np.int64)
+
+    # dates before October are in the water year that started last year
+    wy_start = year.astype(np.int64) - (month < 9)
+    wy_start = wy_start.astype('datetime64[Y]').astype('datetime64[M]') + \
+        np.timedelta64(9, 'M')
+
+    return (dates - wy_start.astype('datetime64[s]')) / np.timedelta64(1, 'h')
+
+
+def time_to_dates(values, units, calendar='standard'):
+    """
+    Convert the numeric time axis to dates. The dates keep the wall clock
+    time of the file, the same as replacing the time zone of the dates from
+    nc.num2date
+
+    Args:
+        values:     numeric time values
+        units:      units attribute of the time variable
+        calendar:   calendar attribute of the time variable
+
+    Returns:
+        array of datetime64
+    """
+
+    values = np.ma.getdata(values).astype(np.float64).ravel()
+    parsed = parse_time_units(units)
+
+    if parsed is None or calendar.lower() not in STANDARD_CALENDARS:
+        # units numpy does not know about, convert the slow way
+        dates = nc.num2date(values, units, calendar)
+        return np.array([datetime(*d.timetuple()[:6]) for d in dates],
+                        dtype='datetime64[s]')
+
+    step, ref = parsed
+    seconds = np.rint(values * step).astype(np.int64)
+
+    return ref + seconds.astype('timedelta64[s]')
+
+
+def read_time_index(path, variable='time'):
+    """
+    Dates and water year hours of the time axis in a netCDF file. These are
+    kept for the path until the modification time or size of the file
+    changes, so a file that is still being written is read again
+
+    Args:
+        path:       netCDF file
+        variable:   time variable in the file
+
+    Returns:
+        tuple of the dates as datetime64 and the water year hours, both read
+        only arrays
+    """
+
+    path = os.path.abspath(path)
+    st = os.stat(path)
+    key = (path, variable)
+    stamp = (st.st_mtime_ns, st.st_size)
+
+    with _lock:
+        cached = _cache.get(key)
+    if cached is not None and cached[0] == stamp:
+        return cached[1]
+
+    ds = nc.Dataset(path, 'r')
+    try:
+        t = ds.variables[variable]
+        calendar = getattr(t, 'calendar', 'standard')
+        dates = time_to_dates(t[:], t.units, calendar)
+    finally:
+        ds.close()
+
+    wyhr = water_year_hours_of(dates)
+    dates.setflags(write=False)
+    wyhr.setflags(write=False)
+
+    with _lock:
+        _cache[key] = (stamp, (dates, wyhr))
+
+    return dates, wyhr
+
+
+def water_year_hours(path, variable='time'):
+    """
+    Water year hours of the time axis in a netCDF file
+
+    Args:
+        path:       netCDF file
+        variable:   time variable in the file
+
+    Returns:
+        read only float array of water year hours
+    """
+
+    return read_time_index(path, variable)[1]
+
+
+def find_time_index(path, wyhr, variable='time'):
+    """
+    Index of the time step closest to a water year hour
+
+    Args:
+        path:       netCDF file
+        wyhr:       water year hour to find
+        variable:   time variable in the file
+
+    Returns:
+        tuple of the index, the water year hour at the index and the
+        absolute difference in hours
+    """
+
+    hours = water_year_hours(path, variable)
+    diff = np.absolute(hours - wyhr)
+    idt = int(np.argmin(diff))
+
+    return idt, hours[idt], diff[idt]
+
+
+def clear_cache():
+    """
+    Forget the time index of all files
+    """
+
+    with _lock:
+        _cache.clear()
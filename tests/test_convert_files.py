@@ -0,0 +1,221 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+test_convert_files
+----------------------------------
+
+Tests for converting between the SMRF netCDF files and iSnobal IPW files
+"""
+
+import logging
+import os
+import shutil
+import tempfile
+import unittest
+from datetime import datetime
+from types import SimpleNamespace
+from unittest import mock
+
+import netCDF4 as nc
+import numpy as np
+
+from awsm.convertFiles import convertFiles
+
+
+class FakeIPW():
+    """
+    Stand in for an IPW image that saves the bands with numpy
+    """
+
+    def __init__(self, fp=None):
+        self.bands = []
+        if fp is not None:
+            self.bands = [SimpleNamespace(data=b) for b in np.load(fp)]
+
+    def new_band(self, data):
+        self.bands.append(np.array(data))
+
+    def add_geo_hdr(self, *args):
+        pass
+
+    def write(self, fp, nbits):
+        with open(fp, 'wb') as f:
+            np.save(f, np.array(self.bands))
+
+
+class TestNc2Ipw(unittest.TestCase):
+    """
+    Test writing the IPW files with a process pool matches writing them
+    one at a time
+    """
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.nt = 30
+        self.paths = os.path.join(self.tmp_dir, 'smrf')
+        os.makedirs(self.paths)
+
+        for v in convertFiles.NC2IPW_INPUTS + convertFiles.NC2IPW_PPT:
+            data = np.random.random((self.nt, 3, 4))
+            if v == 'precip':
+                # precip in a few time steps only
+                data[np.arange(self.nt) % 7 != 0] = 0.0
+            elif v == 'net_solar':
+                # night for the first hours
+                data[:6] = 0.0
+            ds = nc.Dataset(os.path.join(self.paths, '{}.nc'.format(v)), 'w')
+            ds.createDimension('time', None)
+            ds.createDimension('y', 3)
+            ds.createDimension('x', 4)
+            ds.createVariable(v, 'f', ('time', 'y', 'x'))
+            ds.variables[v][:] = data
+            ds.close()
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def convert(self, name, workers, block_size=24):
+        """
+        Convert the SMRF files into a new data directory
+        """
+
+        pathdd = os.path.join(self.tmp_dir, name)
+        os.makedirs(os.path.join(pathdd, 'input'))
+        os.makedirs(os.path.join(pathdd, 'ppt_4b'))
+
+        myawsm = SimpleNamespace()
+        myawsm.topo = SimpleNamespace(u=0.0, v=0.0, du=1.0, dv=1.0,
+                                      units='m')
+        myawsm.csys = 'UTM'
+        myawsm._logger = logging.getLogger(__name__)
+        myawsm.start_date = datetime(2017, 10, 2)
+        myawsm.wy_start = datetime(2017, 10, 1)
+        myawsm.paths = self.paths
+        myawsm.pathdd = pathdd
+        myawsm.ppt_desc = os.path.join(pathdd, 'ppt_desc.txt')
+        myawsm.soil_temp = -2.5
+        myawsm.nbits = 16
+        myawsm.convert_workers = workers
+        myawsm.convert_block_size = block_size
+
+        convertFiles.nc2ipw_mea(myawsm, 'smrf')
+
+        return pathdd
+
+    @mock.patch.object(convertFiles.ipw, 'IPW', FakeIPW)
+    def test_parallel(self):
+        """ Parallel nc2ipw matches the serial conversion """
+
+        serial = self.convert('serial', 1)
+        parallel = self.convert('parallel', 3, block_size=5)
+
+        for d in ['input', 'ppt_4b']:
+            files = sorted(os.listdir(os.path.join(serial, d)))
+            self.assertEqual(files, sorted(os.listdir(os.path.join(parallel,
+                                                                   d))))
+            for fl in files:
+                np.testing.assert_array_equal(
+                    np.load(os.path.join(serial, d, fl)),
+                    np.load(os.path.join(parallel, d, fl)))
+
+        self.assertEqual(len(os.listdir(os.path.join(serial, 'input'))),
+                         self.nt)
+
+        # no solar band at night
+        self.assertEqual(len(np.load(os.path.join(serial, 'input',
+                                                  'in.0029'))), 5)
+        self.assertEqual(len(np.load(os.path.join(serial, 'input',
+                                                  'in.0030'))), 6)
+
+        # ppt_desc is in time order with the same hours
+        hours = []
+        for name in ['serial', 'parallel']:
+            with open(os.path.join(self.tmp_dir, name, 'ppt_desc.txt')) as f:
+                hours.append([int(line.split()[0]) for line in f])
+        self.assertEqual(hours[0], hours[1])
+        self.assertEqual(hours[0], [24 + t for t in range(0, self.nt, 7)])
+
+
+class TestIpw2Nc(unittest.TestCase):
+    """
+    Test reading the IPW outputs with a process pool matches reading them
+    one at a time
+    """
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.pathro = os.path.join(self.tmp_dir, 'output')
+        os.makedirs(self.pathro)
+
+        self.hours = list(range(100, 130))
+        for hr in self.hours:
+            for name, nbands in [('snow', 9), ('em', 10)]:
+                i = FakeIPW()
+                for b in range(nbands):
+                    i.new_band(np.random.random((3, 4)))
+                i.write(os.path.join(self.pathro, '{}.{:04d}'.format(name,
+                                                                     hr)), 16)
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def convert(self, name, workers):
+        """
+        Convert the IPW outputs into netCDF files in a new directory
+        """
+
+        pathrr = os.path.join(self.tmp_dir, name)
+        os.makedirs(pathrr)
+
+        myawsm = SimpleNamespace()
+        myawsm.topo = SimpleNamespace(x=np.arange(4), y=np.arange(3),
+                                      nx=4, ny=3)
+        myawsm._logger = logging.getLogger(__name__)
+        myawsm.tmz = 'MST'
+        myawsm.wy_start = datetime(2017, 10, 1)
+        myawsm.gitVersion = 'test'
+        myawsm.do_smrf = False
+        myawsm.pathro = self.pathro
+        myawsm.pathrr = pathrr
+        myawsm.convert_workers = workers
+        myawsm.output_chunks = None
+        myawsm.output_compression = 0
+        myawsm.output_shuffle = True
+        myawsm.output_significant_digits = None
+        myawsm.output_dtype = 'float32'
+
+        convertFiles.ipw2nc_mea(myawsm, 'smrf')
+
+        return pathrr
+
+    @mock.patch.object(convertFiles.ipw, 'IPW', FakeIPW)
+    def test_parallel(self):
+        """ Parallel ipw2nc matches the serial conversion """
+
+        serial = self.convert('serial', 1)
+        parallel = self.convert('parallel', 3)
+
+        for f in ['snow.nc', 'em.nc']:
+            ds_serial = nc.Dataset(os.path.join(serial, f))
+            ds_parallel = nc.Dataset(os.path.join(parallel, f))
+
+            np.testing.assert_array_equal(ds_serial.variables['time'][:],
+                                          self.hours)
+            for v in ds_serial.variables:
+                np.testing.assert_array_equal(ds_serial.variables[v][:],
+                                              ds_parallel.variables[v][:])
+
+            ds_serial.close()
+            ds_parallel.close()
+
+        # the snow bands are in the file in order
+        ds = nc.Dataset(os.path.join(serial, 'snow.nc'))
+        np.testing.assert_allclose(
+            ds.variables['snow_density'][5, :],
+            np.load(os.path.join(self.pathro, 'snow.0105'))[1], rtol=1e-6)
+        ds.close()
+
+
+if __name__ == '__main__':
+    unittest.main()
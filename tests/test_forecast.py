@@ -0,0 +1,157 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+test_forecast
+----------------------------------
+
+Tests for running the forecasts from each hour of a daily run
+"""
+
+import logging
+import os
+import shutil
+import tempfile
+import unittest
+from types import SimpleNamespace
+
+import numpy as np
+import pandas as pd
+import pytz
+
+from awsm.interface import forecast
+from awsm.interface import pysnobal_io as io_mod
+
+
+class FakeAWSM():
+    """
+    AWSM instance with a model run that saves its forecast inputs
+    """
+
+    def __init__(self, pathro):
+        self._logger = logging.getLogger(__name__)
+        cfg = {'grid': {'csys': 'UTM'},
+               'files': {'init_file': None, 'init_type': None},
+               'awsm master': {'model_type': 'smrf_ipysnobal'},
+               'isnobal restart': {'restart_crash': False,
+                                   'wyh_restart_output': None,
+                                   'depth_thresh': 0.05,
+                                   'output_folders': 'standard'},
+               'time': {'time_zone': 'MST'},
+               'awsm system': {'daily_state_check': True},
+               'gridded': {'forecast_flag': True}}
+        self.ucfg = SimpleNamespace(cfg=cfg)
+        self.config = self.ucfg.cfg
+        mask = np.ones((3, 4))
+        self.topo = SimpleNamespace(x=np.arange(4), y=np.arange(3),
+                                    mask=mask, roughness=0.005*mask,
+                                    dem=2000.0*mask)
+        self.pathro = pathro
+        self.pathrr = pathro
+        self.pathinit = pathro
+        self.wy_start = pd.to_datetime('2018-10-01')
+        self.tzinfo = pytz.timezone('MST')
+        self.n_forecast_hours = 18
+        self.snow_name = 'snow_00'
+        self.em_name = 'em_00'
+        self.start_date = pd.to_datetime('2018-10-02')
+        self.forecast_states = None
+        self.checkpoint_frequency = 10
+        self.state_on_disk = True
+        self.static_fields = None
+        self.model_state = None
+        self.myinit = None
+
+    def run_smrf_ipysnobal(self):
+        out = [self.start_wyhr, self.end_wyhr, os.getpid(),
+               self.myinit.init['z_s'].sum()]
+        np.save(os.path.join(self.pathro, self.snow_name + '.npy'),
+                np.array(out, dtype=np.float64))
+
+
+class TestForecastScheduler(unittest.TestCase):
+    """
+    Test the forecasts run in processes match running them one at a time
+    """
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.day_start = pd.to_datetime('2018-10-02')
+        self.hours = [self.day_start + pd.to_timedelta(h, unit='h')
+                      for h in range(6)]
+
+        # state at each hour of the day's run
+        tzinfo = pytz.timezone('MST')
+        self.states = io_mod.StateSnapshots(tzinfo, self.tmp_dir)
+        for h, t in enumerate(self.hours):
+            rec = {k: h * np.ones((3, 4)) for k in io_mod.INIT_STATE}
+            self.states.add(rec, t)
+
+    def tearDown(self):
+        self.states.close()
+        shutil.rmtree(self.tmp_dir)
+
+    def run_forecasts(self, name, processes):
+        pathro = os.path.join(self.tmp_dir, name)
+        os.makedirs(pathro)
+        myawsm = FakeAWSM(pathro)
+
+        scheduler = forecast.ForecastScheduler(myawsm, processes,
+                                               self.states)
+        for t in self.hours:
+            scheduler.add(t, self.day_start)
+        scheduler.run()
+
+        # the day's run is not changed
+        self.assertEqual(myawsm.snow_name, 'snow_00')
+        self.assertEqual(myawsm.checkpoint_frequency, 10)
+        self.assertIsNone(myawsm.myinit)
+
+        out = {}
+        for f in sorted(os.listdir(pathro)):
+            out[f] = np.load(os.path.join(pathro, f))
+
+        return out
+
+    def test_copies(self):
+        """ Forecasts do not share their options """
+
+        myawsm = FakeAWSM(self.tmp_dir)
+        f1 = forecast.forecast_awsm(myawsm, self.hours[1], self.day_start,
+                                    self.states.get(self.hours[1]))
+        f2 = forecast.forecast_awsm(myawsm, self.hours[2], self.day_start,
+                                    self.states.get(self.hours[2]))
+
+        f1.config['gridded']['forecast_flag'] = False
+        f1.topo.dem = None
+        self.assertTrue(f2.config['gridded']['forecast_flag'])
+        self.assertTrue(myawsm.config['gridded']['forecast_flag'])
+        self.assertIs(f2.config, f2.ucfg.cfg)
+        self.assertIs(f2.topo.dem, myawsm.topo.dem)
+
+    def test_parallel(self):
+        """ Forecasts in a process pool match the serial forecasts """
+
+        serial = self.run_forecasts('serial', 1)
+        parallel = self.run_forecasts('parallel', 3)
+
+        self.assertEqual(sorted(serial.keys()),
+                         ['snow_{:02d}.npy'.format(h) for h in range(6)])
+        self.assertEqual(sorted(serial.keys()), sorted(parallel.keys()))
+
+        pids = set()
+        for f, v in serial.items():
+            h = int(f[5:7])
+            # forecast from the state at its hour
+            np.testing.assert_array_equal(v[[0, 1, 3]],
+                                          [24 + h, 24 + h + 18, 12 * h])
+            np.testing.assert_array_equal(v[[0, 1, 3]],
+                                          parallel[f][[0, 1, 3]])
+            self.assertEqual(v[2], os.getpid())
+            pids.add(parallel[f][2])
+
+        self.assertNotIn(os.getpid(), pids)
+
+
+if __name__ == '__main__':
+    unittest.main()
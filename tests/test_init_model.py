@@ -0,0 +1,132 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+test_init_model
+----------------------------------
+
+Tests for initializing the model from the state kept in memory between runs
+"""
+
+import logging
+import os
+import shutil
+import tempfile
+import unittest
+from datetime import datetime
+from types import SimpleNamespace
+
+import netCDF4 as nc
+import numpy as np
+
+from awsm.data.init_model import FREEZE, modelInit
+
+NC_FIELDS = {'z_s': 'thickness', 'rho': 'snow_density', 'T_s_0': 'temp_surf',
+             'T_s': 'temp_snowcover', 'T_s_l': 'temp_lower',
+             'h2o_sat': 'water_saturation'}
+
+
+class TestStateInit(unittest.TestCase):
+    """
+    Test the state in memory is used when it matches the init file
+    """
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.init_file = os.path.join(self.tmp_dir, 'snow.nc')
+
+        ny, nx = 4, 5
+        mask = np.ones((ny, nx))
+        self.topo = SimpleNamespace(x=np.arange(nx), y=np.arange(ny),
+                                    mask=mask, roughness=0.005*mask,
+                                    dem=2000.0*mask)
+
+        # state at the end of the previous day, 2018-10-02 00:00
+        self.state = {'time': datetime(2018, 10, 2), 'wyhr': 24.0,
+                      'fields': {}}
+        for k in NC_FIELDS:
+            self.state['fields'][k] = np.random.random((ny, nx))
+        for k in ['T_s_0', 'T_s', 'T_s_l']:
+            self.state['fields'][k] -= 5.0
+
+        # outputs of the previous day, written an hour before the time step
+        ds = nc.Dataset(self.init_file, 'w')
+        ds.createDimension('time', None)
+        ds.createDimension('y', ny)
+        ds.createDimension('x', nx)
+        t = ds.createVariable('time', 'f', ('time',))
+        t.units = 'hours since 2018-10-01 00:00:00'
+        t.calendar = 'standard'
+        t[:] = [11, 23]
+        for k, v in NC_FIELDS.items():
+            ds.createVariable(v, 'f', ('time', 'y', 'x'))
+            ds.variables[v][0] = np.zeros((ny, nx))
+            ds.variables[v][1] = self.state['fields'][k]
+        ds.close()
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def init(self, start_wyhr, state_check=True):
+        cfg = {'grid': {'csys': 'UTM'},
+               'files': {'init_file': self.init_file,
+                         'init_type': 'netcdf_out'},
+               'awsm master': {'model_type': 'smrf_ipysnobal'},
+               'isnobal restart': {'restart_crash': False,
+                                   'wyh_restart_output': None,
+                                   'depth_thresh': 0.05,
+                                   'output_folders': 'standard'},
+               'time': {'time_zone': 'UTC'},
+               'awsm system': {'daily_state_check': state_check}}
+
+        return modelInit(logging.getLogger(__name__), cfg, self.topo,
+                         start_wyhr, self.tmp_dir, self.tmp_dir,
+                         self.tmp_dir, datetime(2018, 10, 1), self.state)
+
+    def assert_init(self, myinit, fields):
+        for k, v in fields.items():
+            if k in ['T_s_0', 'T_s', 'T_s_l']:
+                v = v + FREEZE
+            np.testing.assert_array_equal(myinit.init[k], v)
+
+    def test_state(self):
+        """ State in memory is used when it matches the last output """
+
+        myinit = self.init(24)
+        self.assert_init(myinit, self.state['fields'])
+
+        # the file is float32, the state is used and not the file
+        self.assertEqual(myinit.init['rho'].dtype, np.float64)
+        self.assertFalse(np.all(myinit.init['rho'] ==
+                                self.state['fields']['rho'].astype(np.float32)))
+
+    def test_fallback(self):
+        """ The init file is used if the state does not match """
+
+        fields = {}
+        ds = nc.Dataset(self.init_file)
+        for k, v in NC_FIELDS.items():
+            fields[k] = ds.variables[v][0].astype(np.float64)
+        ds.close()
+
+        # state is not from the start of the run
+        myinit = self.init(12)
+        self.assert_init(myinit, fields)
+
+        # state differs from the file
+        self.state['fields']['rho'] = self.state['fields']['rho'] + 10.0
+        ds = nc.Dataset(self.init_file)
+        for k, v in NC_FIELDS.items():
+            fields[k] = ds.variables[v][1].astype(np.float64)
+        ds.close()
+
+        myinit = self.init(24)
+        self.assert_init(myinit, fields)
+
+        # unless not checking the state
+        myinit = self.init(24, state_check=False)
+        self.assert_init(myinit, self.state['fields'])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,223 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+test_ipysnobal
+----------------------------------
+
+Tests for passing the SMRF forcing data to PySnobal
+"""
+
+import os
+import shutil
+import tempfile
+import threading
+import time
+import unittest
+
+import numpy as np
+import pandas as pd
+
+from awsm.interface import initialize_model as initmodel
+from awsm.interface import ipysnobal
+
+
+class TestForcingBuffer(unittest.TestCase):
+    """
+    Test the double buffered forcing data
+    """
+
+    def setUp(self):
+        np.random.seed(3)
+        self.data = {'T_a': np.random.uniform(-10, 10, (3, 4)),
+                     'T_pp': np.random.uniform(-10, 10, (3, 4)),
+                     'S_n': np.random.uniform(0, 800, (3, 4)),
+                     'm_pp': None}
+
+    def test_fill(self):
+        """ Buffers swap and the SMRF images are not changed """
+
+        original = {k: v.copy() for k, v in self.data.items()
+                    if v is not None}
+        forcing = ipysnobal.ForcingBuffer(3, 4, -2.5)
+
+        input1 = forcing.fill(self.data)
+        input2 = forcing.fill(self.data)
+        self.assertIsNot(input1['T_a'], input2['T_a'])
+        self.assertIs(forcing.fill(self.data)['T_a'], input1['T_a'])
+
+        for k, v in original.items():
+            np.testing.assert_array_equal(self.data[k], v)
+
+        np.testing.assert_array_equal(input2['T_a'],
+                                      original['T_a'] + ipysnobal.FREEZE)
+        np.testing.assert_array_equal(input2['S_n'], original['S_n'])
+        np.testing.assert_array_equal(input2['m_pp'], 0.0)
+        np.testing.assert_array_equal(input2['T_g'],
+                                      -2.5 + ipysnobal.FREEZE)
+
+        # a temperature without data is 0 C as before the buffers
+        data = dict(self.data, T_pp=None)
+        out = forcing.fill(data)
+        np.testing.assert_array_equal(out['T_pp'], ipysnobal.FREEZE)
+        np.testing.assert_array_equal(out['m_pp'], 0.0)
+
+        # filling new arrays leaves the buffers alone
+        out = forcing.fill(self.data, forcing.allocate())
+        self.assertIsNot(out['T_a'], input1['T_a'])
+        self.assertIsNot(out['T_a'], input2['T_a'])
+
+    def test_masked_domain(self):
+        """ Buffers hold the active cells of the mask """
+
+        mask = np.zeros((3, 4))
+        mask[1:, 1:3] = 1
+        domain = initmodel.MaskedDomain(mask)
+        forcing = ipysnobal.ForcingBuffer(3, 4, -2.5, domain)
+
+        out = forcing.fill(self.data)
+        self.assertEqual(out['T_pp'].shape, (1, 4))
+        np.testing.assert_array_equal(
+            out['T_pp'], domain.pack(self.data['T_pp'] + ipysnobal.FREEZE))
+        self.assertEqual(out['T_g'].shape, (1, 4))
+
+
+class TestSnobalState(unittest.TestCase):
+    """
+    Test the state block and its views
+    """
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        np.random.seed(4)
+        self.data = {'z_s': np.random.random((3, 4)),
+                     'rho': np.random.random((3, 4)),
+                     'current_time': np.zeros((3, 4))}
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def test_state(self):
+        """ Views, sync, snapshot and restore """
+
+        for path in [None, os.path.join(self.tmp_dir, 'state.npy')]:
+            state = initmodel.SnobalState(self.data, path)
+            output_rec = state.fields
+            self.assertEqual(state.block.shape, (3, 3, 4))
+            self.assertTrue(np.shares_memory(output_rec['rho'], state.block))
+            np.testing.assert_array_equal(output_rec['z_s'], self.data['z_s'])
+
+            snap = state.snapshot()
+            output_rec['current_time'][:] = 5.0
+            output_rec['rho'] = np.ones((3, 4))
+            state.sync()
+            self.assertTrue(np.shares_memory(output_rec['rho'], state.block))
+            np.testing.assert_array_equal(state.block[1], 1.0)
+            np.testing.assert_array_equal(state.block[2], 5.0)
+
+            state.restore(snap)
+            np.testing.assert_array_equal(output_rec['rho'], self.data['rho'])
+            np.testing.assert_array_equal(
+                state.as_dict(snap)['current_time'], 0.0)
+
+            state.flush()
+
+        # the state is on disk
+        np.testing.assert_array_equal(np.load(path)[0], self.data['z_s'])
+
+
+class FakePySnobal():
+    """
+    Stand in for PySnobal that records the time steps it runs
+    """
+
+    def __init__(self, fail=None, block=None):
+        self.fail = fail
+        self.block = block
+        self.started = threading.Event()
+        self.forcing = []
+        self.steps = []
+
+    def get_smrf_forcing(self, s, tstep, copy=False):
+        self.forcing.append(tstep)
+        return {'tstep': tstep}
+
+    def run_single_fist_step(self, s, forcing=None):
+        self.steps.append(forcing['tstep'])
+
+    def run_single(self, tstep, s, updater=None, forcing=None):
+        if self.block is not None:
+            self.started.set()
+            self.block.wait()
+        time.sleep(0.005)
+        if tstep == self.fail:
+            raise ValueError('ipysnobal error on time step {}'.format(tstep))
+        self.steps.append(forcing['tstep'])
+
+
+class TestPySnobalPipeline(unittest.TestCase):
+    """
+    Test running PySnobal behind the SMRF distribution
+    """
+
+    def setUp(self):
+        self.date_time = list(pd.date_range('2018-01-01', periods=10,
+                                            freq='60min', tz='MST'))
+
+    def run_pipeline(self, pipeline):
+        for output_count, t in enumerate(self.date_time):
+            pipeline.submit(output_count, t, None)
+            self.assertLessEqual(len(pipeline.pending), pipeline.depth)
+        pipeline.wait()
+
+    def test_order(self):
+        """ Time steps are run in order within the depth limit """
+
+        my_pysnobal = FakePySnobal()
+        pipeline = ipysnobal.PySnobalPipeline(my_pysnobal, 3)
+        try:
+            self.run_pipeline(pipeline)
+        finally:
+            pipeline.close()
+
+        self.assertEqual(my_pysnobal.steps, self.date_time)
+        self.assertEqual(len(pipeline.pending), 0)
+
+    def test_error(self):
+        """ A PySnobal error stops the distribution """
+
+        my_pysnobal = FakePySnobal(fail=self.date_time[3])
+        pipeline = ipysnobal.PySnobalPipeline(my_pysnobal, 2)
+        try:
+            self.assertRaises(ValueError, self.run_pipeline, pipeline)
+        finally:
+            pipeline.close()
+
+        # raised by the time step depth steps after the error is distributed
+        self.assertLessEqual(len(my_pysnobal.forcing), 6)
+        self.assertEqual(my_pysnobal.steps[:3], self.date_time[:3])
+        self.assertEqual(len(pipeline.pending), 0)
+
+    def test_close(self):
+        """ Time steps PySnobal has not started are cancelled """
+
+        block = threading.Event()
+        my_pysnobal = FakePySnobal(block=block)
+        pipeline = ipysnobal.PySnobalPipeline(my_pysnobal, 5)
+        for output_count, t in enumerate(self.date_time[:5]):
+            pipeline.submit(output_count, t, None)
+        futures = list(pipeline.pending)
+
+        # PySnobal is running the second time step when the run stops
+        self.assertTrue(my_pysnobal.started.wait(5))
+        timer = threading.Timer(0.05, block.set)
+        timer.start()
+        pipeline.close()
+        timer.join()
+
+        self.assertEqual(my_pysnobal.steps, self.date_time[:2])
+        self.assertTrue(all(f.cancelled() for f in futures[2:]))
+
+
+if __name__ == '__main__':
+    unittest.main()
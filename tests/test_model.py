@@ -106,6 +106,22 @@ class TestModel(AWSMTestCase):
         result = can_i_run_awsm(config)
         self.assertTrue(result)
 
+    def test_smrf_pysnobal_pipeline(self):
+        """ Test smrf passing variables to PySnobal running behind SMRF """
+
+        config = deepcopy(self.base_config)
+        config.raw_cfg['awsm master']['run_smrf'] = False
+        config.raw_cfg['awsm master']['make_in'] = False
+        config.raw_cfg['awsm master']['model_type'] = 'smrf_ipysnobal'
+        config.raw_cfg['system']['threading'] = False
+        config.raw_cfg['ipysnobal']['smrf_pipeline_depth'] = 2
+
+        config.apply_recipes()
+        config = cast_all_variables(config, config.mcfg)
+
+        result = can_i_run_awsm(config)
+        self.assertTrue(result)
+
     def test_smrf_pysnobal_thread(self):
         """  Test smrf passing variables to PySnobal threaded """
 
@@ -0,0 +1,616 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+test_pysnobal_io
+----------------------------------
+
+Tests for reading the PySnobal forcing data and writing the PySnobal outputs
+"""
+
+import logging
+import os
+import pickle
+import shutil
+import tempfile
+import time
+import unittest
+from unittest import mock
+
+import netCDF4 as nc
+import numpy as np
+import pandas as pd
+import pytz
+
+from awsm.interface import pysnobal_io as io_mod
+from awsm.interface import initialize_model as initmodel
+
+
+def make_output_file(fp, ny, nx, variables):
+    """
+    Create an empty output file with the same layout as the snow and em files
+    """
+
+    ds = nc.Dataset(fp, 'w')
+    ds.createDimension('time', None)
+    ds.createDimension('y', ny)
+    ds.createDimension('x', nx)
+    ds.createVariable('time', 'f', ('time',))
+    setattr(ds.variables['time'], 'units', 'hours since 2000-01-01 00:00:00')
+    setattr(ds.variables['time'], 'calendar', 'standard')
+    for v in variables:
+        ds.createVariable(v, 'f', ('time', 'y', 'x'))
+
+    return ds
+
+
+class FakeBand():
+    def __init__(self, data):
+        self.data = data
+
+
+class FakeIPW():
+    """
+    Stand in for an IPW file with band values made from the file name
+    """
+
+    def __init__(self, fp):
+        name = os.path.basename(fp)
+        hr = int(name.split('_')[-1].split('.')[-1])
+        nbands = 4 if name.startswith('ppt') else 6
+        self.bands = [FakeBand(np.full((3, 4), hr + 0.1*b))
+                      for b in range(nbands)]
+
+
+class FakeAWSM():
+    """
+    The attributes of an AWSM instance used to read IPW forcing
+    """
+
+    def __init__(self):
+        self.pathi = 'input'
+        self.path_ppt = 'ppt_4b'
+        self.soil_temp = -2.5
+        self.topo = mock.Mock(ny=3, nx=4)
+
+
+class TestMaskedDomain(unittest.TestCase):
+    """
+    Test packing and unpacking the active cells
+    """
+
+    def test_round_trip(self):
+        """ Unpacking a packed state gives back the full grid """
+
+        mask = np.zeros((4, 5))
+        mask[1:3, 1:4] = 1
+        domain = initmodel.MaskedDomain(mask)
+        self.assertEqual(domain.n, 6)
+
+        state = {'z_s': np.random.random((4, 5)),
+                 'T_s': 198.16 * np.ones((4, 5))}
+        packed = domain.pack_dict(state, keep_background=True)
+        self.assertEqual(packed['z_s'].shape, (1, 6))
+        self.assertEqual(domain.background['T_s'], 198.16)
+
+        for k, v in state.items():
+            np.testing.assert_array_equal(domain.unpack(packed[k], k), v)
+
+        # scalars are spread over the active cells
+        np.testing.assert_array_equal(domain.pack(2.0), 2.0*np.ones((1, 6)))
+
+
+class TestOutputWriter(unittest.TestCase):
+    """
+    Test the buffered writer against writing each time step to the file
+    """
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.ny = 4
+        self.nx = 5
+        self.output_vars = [v.lower() for v in
+                            list(io_mod.SNOW_OUT) + list(io_mod.EM_OUT)]
+
+        rec_keys = list(io_mod.SNOW_OUT.values()) + \
+            list(io_mod.EM_OUT.values())
+        self.records = []
+        for h in range(7):
+            rec = {k: np.random.random((self.ny, self.nx)) + 270.0
+                   for k in rec_keys}
+            self.records.append(rec)
+
+        self.dates = [pd.to_datetime('2000-01-01 01:00') +
+                      pd.to_timedelta(h, unit='h') for h in range(7)]
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def write_files(self, name, buffer_size, thread=False, domain=None):
+        """
+        Write all the records with a writer of the given buffer size
+        """
+
+        records = self.records
+        if domain is not None:
+            records = [domain.pack_dict(rec) for rec in self.records]
+
+        options = {'output': {}, 'domain': domain}
+        options['output']['snow'] = make_output_file(
+            os.path.join(self.tmp_dir, 'snow_{}.nc'.format(name)),
+            self.ny, self.nx, io_mod.SNOW_OUT.keys())
+        options['output']['em'] = make_output_file(
+            os.path.join(self.tmp_dir, 'em_{}.nc'.format(name)),
+            self.ny, self.nx, io_mod.EM_OUT.keys())
+
+        writer = io_mod.OutputWriter(options, self.output_vars, buffer_size)
+        if thread:
+            writer = io_mod.AsyncOutputWriter(writer, 2,
+                                              logging.getLogger(__name__))
+            writer.start()
+
+        with writer:
+            for rec, dt in zip(records, self.dates):
+                writer.write(rec, dt)
+
+    def test_buffered_output(self):
+        """ Buffered output matches the output of each time step """
+
+        self.write_files('single', 1)
+        self.write_files('buffer', 3)
+
+        for f in ['snow', 'em']:
+            single = nc.Dataset(os.path.join(self.tmp_dir,
+                                             '{}_single.nc'.format(f)))
+            buffered = nc.Dataset(os.path.join(self.tmp_dir,
+                                               '{}_buffer.nc'.format(f)))
+
+            self.assertEqual(len(buffered.variables['time']), 7)
+            for v in single.variables:
+                np.testing.assert_array_equal(single.variables[v][:],
+                                              buffered.variables[v][:])
+            single.close()
+            buffered.close()
+
+    def test_thread_output(self):
+        """ Output written from the background thread matches """
+
+        self.write_files('single', 1)
+        self.write_files('thread', 2, thread=True)
+
+        for f in ['snow', 'em']:
+            single = nc.Dataset(os.path.join(self.tmp_dir,
+                                             '{}_single.nc'.format(f)))
+            threaded = nc.Dataset(os.path.join(self.tmp_dir,
+                                               '{}_thread.nc'.format(f)))
+
+            for v in single.variables:
+                np.testing.assert_array_equal(single.variables[v][:],
+                                              threaded.variables[v][:])
+            single.close()
+            threaded.close()
+
+    def test_masked_domain(self):
+        """ Packed outputs are written to the full grid """
+
+        mask = np.ones((self.ny, self.nx))
+        mask[0, :] = 0
+        domain = initmodel.MaskedDomain(mask)
+        domain.pack_dict(self.records[0], keep_background=True)
+
+        self.write_files('single', 1)
+        self.write_files('domain', 3, domain=domain)
+
+        single = nc.Dataset(os.path.join(self.tmp_dir, 'snow_single.nc'))
+        packed = nc.Dataset(os.path.join(self.tmp_dir, 'snow_domain.nc'))
+        for v in io_mod.SNOW_OUT:
+            np.testing.assert_array_equal(single.variables[v][:, 1:, :],
+                                          packed.variables[v][:, 1:, :])
+            # outside the mask keeps the first record
+            np.testing.assert_array_equal(single.variables[v][0, 0, :],
+                                          packed.variables[v][-1, 0, :])
+        single.close()
+        packed.close()
+
+    def test_netcdf_lock(self):
+        """ The output thread waits while another thread uses netCDF """
+
+        fp = os.path.join(self.tmp_dir, 'snow_lock.nc')
+        options = {'output': {}, 'domain': None}
+        options['output']['snow'] = make_output_file(
+            fp, self.ny, self.nx, io_mod.SNOW_OUT.keys())
+        options['output']['em'] = make_output_file(
+            os.path.join(self.tmp_dir, 'em_lock.nc'),
+            self.ny, self.nx, io_mod.EM_OUT.keys())
+
+        writer = io_mod.AsyncOutputWriter(
+            io_mod.OutputWriter(options, self.output_vars, 1), 2,
+            logging.getLogger(__name__))
+        writer.start()
+
+        with io_mod.NC_LOCK:
+            writer.write(self.records[0], self.dates[0])
+            time.sleep(0.1)
+            self.assertEqual(len(options['output']['snow'].variables['time']),
+                             0)
+
+        writer.close()
+        ds = nc.Dataset(fp)
+        self.assertEqual(len(ds.variables['time']), 1)
+        ds.close()
+
+    def test_temperature_conversion(self):
+        """ Temperatures are written in C """
+
+        self.write_files('temp', 2)
+
+        ds = nc.Dataset(os.path.join(self.tmp_dir, 'snow_temp.nc'))
+        expected = (self.records[-1]['T_s_0'] - io_mod.FREEZE)
+        np.testing.assert_array_equal(ds.variables['temp_surf'][-1, :],
+                                      expected.astype(np.float32))
+        ds.close()
+
+
+class TestStorageProfile(unittest.TestCase):
+    """
+    Test creating the output variables with a storage profile
+    """
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.ds = make_output_file(os.path.join(self.tmp_dir, 'snow.nc'),
+                                   50, 60, [])
+        self.profile = {'chunks': None, 'complevel': 4, 'shuffle': True,
+                        'significant_digits': {'thickness': 3},
+                        'dtype': 'float32'}
+
+    def tearDown(self):
+        self.ds.close()
+        shutil.rmtree(self.tmp_dir)
+
+    def test_chunks(self):
+        """ Chunks are derived from the run length or set in the profile """
+
+        var = io_mod.create_output_variable(self.ds, 'thickness',
+                                            self.profile, 10)
+        self.assertEqual(var.chunking(), [10, 50, 60])
+        self.assertTrue(var.filters()['zlib'])
+        self.assertEqual(var.filters()['complevel'], 4)
+        self.assertEqual(var.least_significant_digit, 3)
+
+        self.profile['chunks'] = [6, 10, 100]
+        var = io_mod.create_output_variable(self.ds, 'snow_density',
+                                            self.profile, 10)
+        self.assertEqual(var.chunking(), [6, 10, 60])
+
+    def test_packed(self):
+        """ Packed variables are within the resolution of the scale """
+
+        self.profile['dtype'] = 'float16'
+        var = io_mod.create_output_variable(self.ds, 'temp_surf',
+                                            self.profile, 10)
+        self.assertEqual(var.dtype, np.int16)
+
+        data = np.random.uniform(-40, 0, (2, 50, 60))
+        data[0, 0, 0] = -200.0
+        data[0, 0, 1] = np.nan
+        var[:2, :] = io_mod.pack_values(var, data)
+
+        out = var[:2, :]
+        self.assertAlmostEqual(float(out[0, 0, 0]), -75.0, places=2)
+        self.assertTrue(out.mask[0, 0, 1])
+        np.testing.assert_allclose(out[1], data[1],
+                                   atol=var.scale_factor)
+
+        # variables without a range stay float32
+        var = io_mod.create_output_variable(self.ds, 'cold_content',
+                                            self.profile, 10)
+        self.assertEqual(var.dtype, np.float32)
+
+
+class TestForcingReader(unittest.TestCase):
+    """
+    Test the forcing reader against reading each time step from the files
+    """
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.ny = 3
+        self.nx = 4
+        self.nt = 10
+
+        tzinfo = pytz.timezone('MST')
+        self.date_time = [(pd.to_datetime('2000-01-01 00:00') +
+                           pd.to_timedelta(h, unit='h')).replace(tzinfo=tzinfo)
+                          for h in range(self.nt)]
+
+        self.force = {}
+        for f in io_mod.FORCE_MAP.keys():
+            if f == 'soil_temp':
+                self.force[f] = -2.5 * np.ones((self.ny, self.nx))
+                continue
+
+            ds = nc.Dataset(os.path.join(self.tmp_dir, '{}.nc'.format(f)),
+                            'w')
+            ds.createDimension('time', None)
+            ds.createDimension('y', self.ny)
+            ds.createDimension('x', self.nx)
+            ds.createVariable('time', 'f', ('time',))
+            setattr(ds.variables['time'], 'units',
+                    'hours since 2000-01-01 00:00:00')
+            setattr(ds.variables['time'], 'calendar', 'standard')
+            ds.createVariable(f, 'f', ('time', 'y', 'x'),
+                              chunksizes=(4, self.ny, self.nx))
+            ds.variables['time'][:] = np.arange(self.nt)
+            ds.variables[f][:] = np.random.random((self.nt, self.ny,
+                                                   self.nx))
+            ds.close()
+            self.force[f] = nc.Dataset(
+                os.path.join(self.tmp_dir, '{}.nc'.format(f)), 'r')
+
+    def tearDown(self):
+        io_mod.close_files(self.force)
+        shutil.rmtree(self.tmp_dir)
+
+    def test_reader(self):
+        """ Forcing reader matches get_timestep_netcdf """
+
+        for block_size in [0, 1, 3]:
+            reader = io_mod.ForcingReader(self.force, self.date_time,
+                                          block_size)
+            for tstep in self.date_time:
+                expected = initmodel.get_timestep_netcdf(self.force, tstep)
+                inpt = reader.get(tstep)
+
+                self.assertEqual(sorted(inpt.keys()),
+                                 sorted(expected.keys()))
+                for k, v in expected.items():
+                    np.testing.assert_array_equal(inpt[k], v)
+
+    def test_chunk_blocks(self):
+        """ Blocks line up with the time chunks and the cache is limited """
+
+        reader = io_mod.ForcingReader(self.force, self.date_time)
+        for f in reader.block_size:
+            self.assertEqual(reader.block_size[f], 4)
+
+        reader.get(self.date_time[5])
+        for key in reader.cache:
+            self.assertEqual(key[1], 4)
+
+        # a tiny cache only keeps the last block read
+        reader = io_mod.ForcingReader(self.force, self.date_time,
+                                      cache_size=0)
+        for tstep in self.date_time:
+            expected = initmodel.get_timestep_netcdf(self.force, tstep)
+            inpt = reader.get(tstep)
+            for k, v in expected.items():
+                np.testing.assert_array_equal(inpt[k], v)
+            self.assertEqual(len(reader.cache), 1)
+
+    def test_masked_domain(self):
+        """ Forcing reader returns the active cells """
+
+        mask = np.ones((self.ny, self.nx))
+        mask[:, 0] = 0
+        domain = initmodel.MaskedDomain(mask)
+
+        reader = io_mod.ForcingReader(self.force, self.date_time,
+                                      domain=domain)
+        for tstep in self.date_time:
+            expected = initmodel.get_timestep_netcdf(self.force, tstep)
+            inpt = reader.get(tstep)
+            for k, v in expected.items():
+                self.assertEqual(inpt[k].shape, (1, domain.n))
+                np.testing.assert_array_equal(inpt[k][0], v[:, 1:].ravel())
+
+    def test_missing_time(self):
+        """ Forcing reader raises an error for time steps not in the files """
+
+        late = self.date_time[-1] + pd.to_timedelta(1, unit='h')
+        reader = io_mod.ForcingReader(self.force, self.date_time + [late])
+
+        self.assertRaises(ValueError, reader.get, late)
+
+    def test_prefetch(self):
+        """ Forcing read ahead matches reading each time step """
+
+        for nthreads in [1, 2]:
+            reader = io_mod.ForcingReader(self.force, self.date_time, 2)
+            with io_mod.ForcingPrefetcher(reader.get, self.date_time, 3,
+                                          nthreads) as prefetcher:
+                for tstep in self.date_time:
+                    expected = initmodel.get_timestep_netcdf(self.force,
+                                                             tstep)
+                    inpt = prefetcher.get(tstep)
+                    for k, v in expected.items():
+                        np.testing.assert_array_equal(inpt[k], v)
+
+    def test_prefetch_error(self):
+        """ Errors reading ahead are raised when the time step is requested """
+
+        late = self.date_time[-1] + pd.to_timedelta(1, unit='h')
+        dates = self.date_time + [late]
+        reader = io_mod.ForcingReader(self.force, dates)
+
+        with io_mod.ForcingPrefetcher(reader.get, dates, 4) as prefetcher:
+            for tstep in self.date_time:
+                prefetcher.get(tstep)
+            self.assertRaises(ValueError, prefetcher.get, late)
+
+
+class TestIPWForcingReader(unittest.TestCase):
+    """
+    Test the IPW forcing reader against get_timestep_ipw
+    """
+
+    def setUp(self):
+        tzinfo = pytz.timezone('MST')
+        self.date_time = [(pd.to_datetime('2000-10-01 00:00') +
+                           pd.to_timedelta(h, unit='h')).replace(tzinfo=tzinfo)
+                          for h in range(8)]
+        self.input_list = np.arange(8)
+        self.ppt_list = np.array([2, 3, 6])
+        self.myawsm = FakeAWSM()
+
+    @mock.patch.object(io_mod.ipw, 'IPW', FakeIPW)
+    def test_reader(self):
+        """ IPW reader matches get_timestep_ipw """
+
+        for nprocesses in [0, 2]:
+            with io_mod.IPWForcingReader(self.myawsm, self.input_list,
+                                         self.ppt_list, self.date_time,
+                                         nprocesses) as reader:
+                for tstep in self.date_time:
+                    expected = initmodel.get_timestep_ipw(tstep,
+                                                          self.input_list,
+                                                          self.ppt_list,
+                                                          self.myawsm)
+                    inpt = reader.get(tstep)
+
+                    self.assertEqual(sorted(inpt.keys()),
+                                     sorted(expected.keys()))
+                    for k, v in expected.items():
+                        np.testing.assert_array_equal(inpt[k], v)
+
+    @mock.patch.object(io_mod.ipw, 'IPW', FakeIPW)
+    def test_missing_input(self):
+        """ IPW reader raises an error for hours without an input file """
+
+        reader = io_mod.IPWForcingReader(self.myawsm, self.input_list[:4],
+                                         self.ppt_list, self.date_time)
+
+        self.assertRaises(ValueError, reader.get, self.date_time[5])
+
+
+class TestCheckpoint(unittest.TestCase):
+    """
+    Test saving and restoring the PySnobal state
+    """
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.path = os.path.join(self.tmp_dir, 'checkpoint.npz')
+        self.date_time = list(pd.date_range('2018-01-01', periods=10,
+                                            freq='60min', tz='MST'))
+        np.random.seed(5)
+        self.data = {'z_s': np.random.random((3, 4)),
+                     'cc_s': np.random.random((3, 4)),
+                     'current_time': np.zeros((3, 4))}
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def test_restore(self):
+        """ The state, counter and forcing are restored exactly """
+
+        state = initmodel.SnobalState(self.data)
+        writer = mock.Mock()
+        logger = logging.getLogger(__name__)
+
+        with io_mod.CheckpointWriter(self.path, state, 3, logger) as ckpt:
+            for j, tstep in enumerate(self.date_time[1:], start=2):
+                state.fields['current_time'][:] = j
+                input1 = {'T_a': j * np.ones((3, 4))}
+                ckpt.save(j, tstep, input1, writer)
+
+        # saved at j of 4, 7 and 10 with the outputs flushed first
+        self.assertEqual(writer.flush.call_count, 3)
+        self.assertFalse(os.path.exists(self.path + '.tmp'))
+
+        restored = initmodel.SnobalState(self.data)
+        j, start, input1 = io_mod.restore_checkpoint(self.path, restored,
+                                                     self.date_time)
+        # the last checkpoint was after the last time step
+        self.assertEqual(j, 10)
+        self.assertEqual(start, 10)
+        np.testing.assert_array_equal(input1['T_a'], 10.0)
+        np.testing.assert_array_equal(restored.block, state.block)
+
+        # a different state can not be restored
+        other = initmodel.SnobalState({'z_s': np.zeros((3, 4))})
+        self.assertRaises(ValueError, io_mod.restore_checkpoint, self.path,
+                          other, self.date_time)
+
+    def test_restore_last_step(self):
+        """ A checkpoint at the last time step leaves nothing to run """
+
+        state = initmodel.SnobalState(self.data)
+        state.fields['current_time'][:] = 10
+        logger = logging.getLogger(__name__)
+
+        with io_mod.CheckpointWriter(self.path, state, 1, logger) as ckpt:
+            ckpt.save(10, self.date_time[-1], {'T_a': np.ones((3, 4))})
+
+        restored = initmodel.SnobalState(self.data)
+        j, start, input1 = io_mod.restore_checkpoint(self.path, restored,
+                                                     self.date_time)
+        self.assertEqual(j, 10)
+        self.assertEqual(start, len(self.date_time))
+        self.assertEqual(self.date_time[start:], [])
+        np.testing.assert_array_equal(restored.block, state.block)
+
+        # the checkpoint is not in a run that ended before it
+        with self.assertRaisesRegex(ValueError, 'is not in the run from'):
+            io_mod.restore_checkpoint(self.path, restored,
+                                      self.date_time[:-1])
+
+
+class TestStateSnapshots(unittest.TestCase):
+    """
+    Test keeping the state at each output for the forecasts
+    """
+
+    def test_snapshots(self):
+        """ Snapshots are copies on the full grid in Celcius """
+
+        mask = np.zeros((3, 4))
+        mask[1:, 1:] = 1
+        domain = initmodel.MaskedDomain(mask)
+        state = {k: np.random.random((3, 4)) for k in io_mod.INIT_STATE}
+        for k in io_mod.TEMP_STATE:
+            state[k] += 260.0
+        packed = domain.pack_dict(state, keep_background=True)
+
+        tzinfo = pytz.timezone('MST')
+        date_time = list(pd.date_range('2018-10-01', periods=3,
+                                       freq='60min', tz=tzinfo))
+        tmp_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tmp_dir)
+        snapshots = io_mod.StateSnapshots(tzinfo, tmp_dir)
+        for tstep in date_time:
+            snapshots.add(packed, tstep, domain)
+            packed['z_s'] += 1.0
+
+        # found by the wall clock time
+        snap = snapshots.get(pd.to_datetime('2018-10-01 01:00'))
+        self.assertEqual(snap['wyhr'], 1.0)
+        np.testing.assert_array_equal(snap['fields']['z_s'][mask == 1],
+                                      state['z_s'][mask == 1] + 1.0)
+        np.testing.assert_array_equal(snap['fields']['z_s'][mask == 0],
+                                      state['z_s'][mask == 0])
+        np.testing.assert_allclose(snap['fields']['T_s'],
+                                   state['T_s'] - io_mod.FREEZE)
+
+        self.assertEqual(snapshots.get(date_time[2])['time'], date_time[2])
+        self.assertIsNone(snapshots.get(pd.to_datetime('2018-10-01 03:00')))
+
+        # the snapshots are saved to files and not kept in memory
+        self.assertEqual(len(os.listdir(snapshots.path)), 3)
+        for snap in snapshots.states.values():
+            self.assertNotIn('fields', snap)
+
+        # a pickled copy reads the files but does not remove them
+        copied = pickle.loads(pickle.dumps(snapshots))
+        expected = snapshots.get(date_time[1])['fields']['z_s']
+        np.testing.assert_array_equal(
+            copied.get(date_time[1])['fields']['z_s'], expected)
+        copied.close()
+        self.assertTrue(os.path.isdir(snapshots.path))
+
+        snapshots.close()
+        self.assertFalse(os.path.isdir(snapshots.path))
+
+
+if __name__ == '__main__':
+    unittest.main()
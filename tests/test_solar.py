@@ -0,0 +1,86 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+test_solar
+----------------------------------
+
+Tests for the solar geometry cache
+"""
+
+import logging
+import os
+import shutil
+import tempfile
+import unittest
+from unittest import mock
+
+import numpy as np
+import pytz
+from datetime import datetime, timedelta
+
+from awsm.interface import solar
+
+
+def fake_sunang(t, lat, lon, zone=0, slope=0, aspect=0):
+    # sun up between 6 and 18
+    cosz = np.cos((t.hour - 12) * np.pi / 12.0)
+    return cosz, t.hour * 10.0 - 120.0
+
+
+def fake_shade(slope, aspect, azimuth, cosz):
+    return cosz * np.cos(slope) + azimuth * np.sin(aspect)
+
+
+class TestSolarGeometry(unittest.TestCase):
+    """
+    Test the cached solar geometry matches computing each time step
+    """
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        np.random.seed(1)
+        self.slope = np.random.random((4, 5))
+        self.aspect = np.random.random((4, 5))
+        start = pytz.timezone('MST').localize(datetime(2018, 1, 1))
+        self.date_time = [start + timedelta(hours=k) for k in range(30)]
+        self.logger = logging.getLogger(__name__)
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def geometry(self, date_time=None):
+        return solar.SolarGeometry(self.slope, self.aspect, 43.0, -116.0,
+                                   date_time or self.date_time,
+                                   self.tmp_dir, self.logger, flush_every=4)
+
+    @mock.patch.object(solar.radiation, 'shade', fake_shade, create=True)
+    @mock.patch.object(solar.radiation, 'sunang', fake_sunang, create=True)
+    def test_cache(self):
+        """ Cached solar geometry matches each time step """
+
+        cache = self.geometry()
+        for t in self.date_time:
+            cosz, azimuth, illum_ang = cache.get(t)
+            e_cosz, e_azimuth, e_illum = solar.solar_geometry(
+                t, 43.0, -116.0, self.slope, self.aspect)
+            self.assertEqual(cosz, e_cosz)
+            self.assertEqual(azimuth, e_azimuth)
+            if e_illum is None:
+                self.assertIsNone(illum_ang)
+            else:
+                np.testing.assert_array_equal(illum_ang, e_illum)
+
+        # the cache is read by later runs and a new date range gets its own
+        with mock.patch.object(solar.radiation, 'shade',
+                               side_effect=fake_shade) as shade:
+            self.geometry()
+            self.assertFalse(shade.called)
+            self.geometry(self.date_time[:10])
+            self.assertTrue(shade.called)
+
+        self.assertEqual(len(os.listdir(self.tmp_dir)), 2)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,126 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+test_static_fields
+----------------------------------
+
+Tests for sharing the static fields of a run through memory mapped files
+"""
+
+import os
+import pickle
+import shutil
+import tempfile
+import unittest
+from concurrent.futures import ProcessPoolExecutor
+from types import SimpleNamespace
+
+import numpy as np
+
+from awsm.utils import static_fields
+
+
+def field_sum(registry, name):
+    """
+    Attach to a field in a worker process
+    """
+
+    data = registry.get(name)
+    return float(np.sum(data)), data.flags.writeable
+
+
+class TestStaticFields(unittest.TestCase):
+    """
+    Test saving and attaching to the static fields
+    """
+
+    def test_registry(self):
+        """ Fields are read only maps shared by name """
+
+        dem = np.random.random((30, 40))
+        with static_fields.StaticFields() as registry:
+            path = registry.path
+            shared = registry.add('dem', dem)
+            np.testing.assert_array_equal(shared, dem)
+            self.assertFalse(shared.flags.writeable)
+            self.assertIn('dem', registry)
+            self.assertIs(registry.get('dem'), shared)
+
+            # only the directory is pickled
+            self.assertLess(len(pickle.dumps(registry)), 200)
+
+            # fields are pickled as their file, derived arrays as data
+            attached = pickle.loads(pickle.dumps(shared))
+            self.assertLess(len(pickle.dumps(shared)), 300)
+            self.assertTrue(static_fields.is_shared(attached))
+            np.testing.assert_array_equal(attached, dem)
+            part = pickle.loads(pickle.dumps(shared[2:5]))
+            np.testing.assert_array_equal(part, dem[2:5])
+
+            with ProcessPoolExecutor(2) as executor:
+                results = list(executor.map(field_sum, [registry] * 2,
+                                            ['dem'] * 2))
+            for total, writeable in results:
+                self.assertAlmostEqual(total, np.sum(dem))
+                self.assertFalse(writeable)
+
+            # a worker does not remove the directory
+            pickle.loads(pickle.dumps(registry)).close()
+            self.assertTrue(os.path.isdir(path))
+
+            # replacing a field keeps the old map valid
+            registry.add('dem', 2 * dem)
+            np.testing.assert_array_equal(shared, dem)
+            np.testing.assert_array_equal(registry.get('dem'), 2 * dem)
+
+        self.assertFalse(os.path.isdir(path))
+
+    def test_share_topo(self):
+        """ Topo images and init fields are replaced by the shared maps """
+
+        mask = np.ones((3, 4))
+        topo = SimpleNamespace(dem=2000.0 * mask, mask=mask,
+                               roughness=0.005 * mask, slope=None,
+                               aspect=mask, x=np.arange(4), y=np.arange(3))
+        init = {'z_s': np.zeros((3, 4)), 'mask': mask}
+
+        with static_fields.StaticFields() as registry:
+            static_fields.share_topo(registry, topo)
+            static_fields.share_init(registry, init)
+
+            self.assertTrue(static_fields.is_shared(topo.dem))
+            self.assertIsNone(topo.slope)
+            np.testing.assert_array_equal(topo.x, np.arange(4))
+            self.assertIn('topo_mask', registry)
+            self.assertIn('init_z_s', registry)
+            self.assertTrue(static_fields.is_shared(init['z_s']))
+
+            # shared fields are not saved again
+            dem = topo.dem
+            static_fields.share_topo(registry, topo)
+            self.assertIs(topo.dem, dem)
+
+        # a topo shared by a closed registry is saved to the next one
+        with static_fields.StaticFields() as registry:
+            static_fields.share_topo(registry, topo)
+            self.assertIsNot(topo.dem, dem)
+            self.assertTrue(registry.holds(topo.dem))
+            self.assertTrue(os.path.isfile(topo.dem.field_file))
+            np.testing.assert_array_equal(topo.dem, 2000.0 * mask)
+
+    def test_run_directory(self):
+        """ A registry in the run directory is removed when closed """
+
+        pathrr = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, pathrr)
+
+        with static_fields.StaticFields(pathrr) as registry:
+            registry.add('dem', np.ones((3, 4)))
+            self.assertEqual(os.path.dirname(registry.path), pathrr)
+
+        self.assertEqual(os.listdir(pathrr), [])
+
+
+if __name__ == '__main__':
+    unittest.main()
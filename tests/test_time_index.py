@@ -0,0 +1,110 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+test_time_index
+----------------------------------
+
+Tests for the water year hours of the time axis of the AWSM netCDF files
+"""
+
+import os
+import shutil
+import tempfile
+import unittest
+from datetime import datetime, timedelta
+
+import netCDF4 as nc
+import numpy as np
+import pytz
+
+from smrf.utils import utils
+
+from awsm.utils import time_index
+
+
+class TestTimeIndex(unittest.TestCase):
+    """
+    Test the water year hours match converting each date
+    """
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.path = os.path.join(self.tmp_dir, 'snow.nc')
+        self.tzinfo = pytz.timezone('MST')
+
+        # hourly across the start of the 2020 water year, after a leap day
+        self.units = 'hours since 2019-09-01 00:00:00'
+        self.times = np.arange(0, 24*60, 1.0)
+        self.write(self.times, self.units)
+        time_index.clear_cache()
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+        time_index.clear_cache()
+
+    def write(self, times, units):
+        ds = nc.Dataset(self.path, 'w')
+        ds.createDimension('time', None)
+        t = ds.createVariable('time', 'f', ('time',))
+        t.units = units
+        t.calendar = 'standard'
+        t.time_zone = 'MST'
+        t[:] = times
+        ds.close()
+
+    def expected(self, times, units):
+        dates = nc.num2date(times, units, 'standard')
+        dates = [datetime(*d.timetuple()[:6]).replace(tzinfo=self.tzinfo)
+                 for d in dates]
+        return np.array([utils.water_day(d)[0]*24.0 for d in dates])
+
+    def test_water_year_hours(self):
+        """ Water year hours match utils.water_day for each date """
+
+        wyhr = time_index.water_year_hours(self.path)
+        np.testing.assert_allclose(wyhr,
+                                   self.expected(self.times, self.units))
+
+        # the water year starts over on October 1st
+        self.assertEqual(wyhr[24*30], 0.0)
+        self.assertEqual(wyhr[24*30 - 1], 24*365 - 1)
+
+    def test_units(self):
+        """ Other units and reference dates """
+
+        units = 'minutes since 2016-02-28 06:30'
+        times = np.arange(0, 60*24*5, 90.0)
+        self.write(times, units)
+
+        np.testing.assert_allclose(time_index.water_year_hours(self.path),
+                                   self.expected(times, units))
+
+    def test_find_time_index(self):
+        """ Closest time step and the cache is updated with the file """
+
+        idt, wyhr, diff = time_index.find_time_index(self.path, 29.2)
+        self.assertEqual(idt, 24*31 + 5)
+        self.assertEqual(wyhr, 29)
+        self.assertAlmostEqual(diff, 0.2)
+
+        # the water year hours are kept while the file is the same
+        hours = time_index.water_year_hours(self.path)
+        self.assertIs(hours, time_index.water_year_hours(self.path))
+
+        # adding time steps to the file reads it again
+        ds = nc.Dataset(self.path, 'a')
+        ds.variables['time'][len(self.times)] = self.times[-1] + 1
+        ds.close()
+        st = os.stat(self.path)
+        later = st.st_mtime + 10
+        os.utime(self.path, (later, later))
+
+        dates, hours = time_index.read_time_index(self.path)
+        self.assertEqual(len(hours), len(self.times) + 1)
+        self.assertEqual(dates[-1].astype(datetime),
+                         datetime(2019, 9, 1) + timedelta(hours=24*60))
+
+
+if __name__ == '__main__':
+    unittest.main()
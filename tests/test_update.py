@@ -0,0 +1,335 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+test_update
+----------------------------------
+
+Tests for the windowed gap filling used when updating the snow state with
+lidar depths
+"""
+
+import os
+import shutil
+import tempfile
+import unittest
+import warnings
+from datetime import datetime
+from types import SimpleNamespace
+
+import netCDF4 as nc
+import numpy as np
+import pandas as pd
+import pytz
+
+from awsm.interface import ingest_data
+
+
+def reference_fill(rho, T_s_0, T_s_l, T_s, h2o_sat, I, I_25, Buf):
+    """
+    Pixel by pixel windowed means from the original updating procedure
+    """
+
+    nrows, ncols = rho.shape
+    X, Y = np.meshgrid(range(ncols), range(nrows))
+
+    tmp1 = np.ones((nrows+2*Buf, Buf))
+    tmp1[:] = np.nan
+    tmp2 = np.ones((Buf, ncols))
+    tmp2[:] = np.nan
+    rho_buf = np.concatenate((tmp1, np.concatenate((tmp2, rho, tmp2), axis=0), tmp1), axis=1)
+    T_s_0_buf = np.concatenate((tmp1, np.concatenate((tmp2, T_s_0, tmp2), axis=0), tmp1), axis=1)
+    T_s_l_buf = np.concatenate((tmp1, np.concatenate((tmp2, T_s_l, tmp2), axis=0), tmp1), axis=1)
+    T_s_buf = np.concatenate((tmp1, np.concatenate((tmp2, T_s, tmp2), axis=0), tmp1), axis=1)
+    h2o_buf = np.concatenate((tmp1, np.concatenate((tmp2, h2o_sat, tmp2), axis=0), tmp1), axis=1)
+
+    for ix, iy in zip(I[0], I[1]):
+        xt = X[ix, iy]+Buf
+        yt = Y[ix, iy]+Buf
+        n = range(11, Buf+2, 10)
+        for n1 in n:
+            xl = xt - int((n1 - 1) / 2)
+            xh = xt + int((n1 - 1) / 2)
+            yl = yt - int((n1 - 1) / 2)
+            yh = yt + int((n1 - 1) / 2)
+            window = rho_buf[yl:yh, xl:xh]
+            qq = np.where(np.isfinite(window))
+            if (len(qq[0]) > 10):
+                rho[ix, iy] = np.nanmean(window[:])
+                T_s_0[ix, iy] = np.nanmean(T_s_0_buf[yl:yh, xl:xh])
+                T_s[ix, iy] = np.nanmean(T_s_buf[yl:yh, xl:xh])
+                h2o_sat[ix, iy] = np.nanmean(h2o_buf[yl:yh, xl:xh])
+
+            if np.isfinite(rho[ix, iy]):
+                break
+
+    for ix, iy in zip(I_25[0], I_25[1]):
+        xt = X[ix, iy] + Buf
+        yt = Y[ix, iy] + Buf
+        n = range(11, Buf+2, 10)
+        for jj in n:
+            xl = xt - int((jj-1)/2)
+            xh = xt + int((jj-1)/2)
+            yl = yt - int((jj-1)/2)
+            yh = yt + int((jj-1)/2)
+            window = T_s_l_buf[yl:yh, xl:xh]
+            T_s_l[ix, iy] = np.nanmean(window[:])
+            if not np.any(np.isnan(T_s_l[ix, iy])):
+                break
+
+
+class TestWindowedMeanFill(unittest.TestCase):
+    """
+    Test the summed area table gap filling against the pixel by pixel loop
+    """
+
+    def setUp(self):
+        np.random.seed(42)
+        shape = (60, 70)
+        self.buf = 40
+
+        self.rho = np.random.uniform(100, 400, shape)
+        self.T_s_0 = np.random.uniform(-20, 0, shape)
+        self.T_s_l = np.random.uniform(-20, 0, shape)
+        self.T_s = np.random.uniform(-20, 0, shape)
+        self.h2o_sat = np.random.uniform(0, 1, shape)
+
+        # large gaps in the density and scattered gaps in the others
+        self.rho[np.random.random(shape) < 0.7] = np.nan
+        self.rho[5:58, 5:65] = np.nan
+        for v in [self.T_s_0, self.T_s_l, self.T_s, self.h2o_sat]:
+            v[np.random.random(shape) < 0.3] = np.nan
+        self.T_s_l[:, 20:] = np.nan
+
+        self.I = np.where(np.isnan(self.rho))
+        self.I_25 = np.where(np.random.random(shape) < 0.2)
+
+    def test_fill(self):
+        """ Windowed means match the original loop """
+
+        fields = [self.rho, self.T_s_0, self.T_s_l, self.T_s, self.h2o_sat]
+        expected = [f.copy() for f in fields]
+        with warnings.catch_warnings():
+            # nanmean of empty windows
+            warnings.simplefilter('ignore', RuntimeWarning)
+            reference_fill(*expected, I=self.I, I_25=self.I_25, Buf=self.buf)
+
+        rho, T_s_0, T_s_l, T_s, h2o_sat = [f.copy() for f in fields]
+        found, means = ingest_data.windowed_mean_fill(
+            self.I[0], self.I[1], self.buf, rho,
+            {'rho': rho, 'T_s_0': T_s_0, 'T_s': T_s, 'h2o_sat': h2o_sat},
+            min_count=10)
+        for field, key in [(rho, 'rho'), (T_s_0, 'T_s_0'), (T_s, 'T_s'),
+                           (h2o_sat, 'h2o_sat')]:
+            field[self.I[0][found], self.I[1][found]] = means[key][found]
+
+        found, means = ingest_data.windowed_mean_fill(
+            self.I_25[0], self.I_25[1], self.buf, T_s_l, {'T_s_l': T_s_l})
+        T_s_l[self.I_25] = means['T_s_l']
+
+        # some cells should need the larger windows
+        self.assertTrue(np.any(np.isnan(expected[0])))
+        self.assertTrue(np.any(np.isnan(expected[2][self.I_25])))
+
+        for e, v in zip(expected, [rho, T_s_0, T_s_l, T_s, h2o_sat]):
+            np.testing.assert_array_equal(np.isnan(e), np.isnan(v))
+            np.testing.assert_allclose(e, v, rtol=1e-10)
+
+
+class TestNearestNeighborFill(unittest.TestCase):
+    """
+    Test the KD-tree inverse distance weighting
+    """
+
+    def test_fill(self):
+        """ Neighbors are weighted by inverse distance """
+
+        data = np.full((20, 20), np.nan)
+        data[5, 5] = 1.0
+        data[5, 8] = 4.0
+        data[15, 15] = 100.0
+        other = data.copy()
+        other[5, 8] = np.nan
+
+        found, means = ingest_data.nearest_neighbor_fill(
+            [5, 19], [6, 0], np.isfinite(data), {'data': data, 'other': other},
+            k=2, max_distance=5)
+
+        np.testing.assert_array_equal(found, [True, False])
+        # distances of 1 and 2 cells
+        self.assertAlmostEqual(means['data'][0], (1.0 + 4.0/2)/(1 + 1.0/2))
+        # NaN neighbors are left out
+        self.assertAlmostEqual(means['other'][0], 1.0)
+        self.assertTrue(np.isnan(means['data'][1]))
+
+    def test_exact(self):
+        """ A valid pixel keeps its own value """
+
+        data = np.full((20, 20), np.nan)
+        data[5, 5] = 1.0 + 1e-9
+        data[5, 6] = 4.0
+        other = data.copy()
+        other[5, 5] = np.nan
+        valid = np.isfinite(data)
+
+        found, means = ingest_data.nearest_neighbor_fill(
+            [5], [5], valid, {'data': data, 'other': other}, k=2)
+
+        self.assertTrue(found[0])
+        self.assertEqual(means['data'][0], data[5, 5])
+        # NaN at the pixel uses the neighbors
+        self.assertEqual(means['other'][0], 4.0)
+
+
+class TestTiledFill(unittest.TestCase):
+    """
+    Test filling the update gaps in tiles matches the full domain
+    """
+
+    def setUp(self):
+        np.random.seed(7)
+        shape = (90, 110)
+        self.buf = 30
+
+        self.fields = {}
+        self.fields['rho'] = np.random.uniform(100, 400, shape)
+        for k in ['T_s_0', 'T_s', 'T_s_l']:
+            self.fields[k] = np.random.uniform(-20, 0, shape)
+        self.fields['h2o_sat'] = np.random.uniform(0, 1, shape)
+
+        self.fields['rho'][np.random.random(shape) < 0.6] = np.nan
+        self.fields['rho'][20:70, 30:90] = np.nan
+        self.fields['T_s_l'][np.random.random(shape) < 0.5] = np.nan
+
+        self.holes = np.isnan(self.fields['rho'])
+        self.holes_25 = np.random.random(shape) < 0.2
+
+    def fill(self, interpolation, tile_size=0, processes=1):
+        fields = {k: v.copy() for k, v in self.fields.items()}
+        with warnings.catch_warnings():
+            warnings.simplefilter('ignore', RuntimeWarning)
+            if tile_size > 0:
+                missing = ingest_data.tiled_fill_update_gaps(
+                    fields, self.holes, self.holes_25, self.buf,
+                    interpolation, 10, tile_size, processes)
+            else:
+                missing = ingest_data.fill_update_gaps(
+                    fields, self.holes, self.holes_25, self.buf,
+                    interpolation, 10)
+        return fields, missing
+
+    def test_tiles(self):
+        """ Tiles stitch back to the untiled result """
+
+        for interpolation in ['window', 'kdtree']:
+            expected, missing = self.fill(interpolation)
+            self.assertTrue(missing > 0)
+
+            for tile_size, processes in [(25, 1), (40, 3)]:
+                fields, m = self.fill(interpolation, tile_size, processes)
+                self.assertEqual(m, missing)
+                for k, v in expected.items():
+                    np.testing.assert_array_equal(np.isnan(v),
+                                                  np.isnan(fields[k]))
+                    np.testing.assert_allclose(fields[k], v, rtol=1e-10)
+
+
+class TestUpdateFlights(unittest.TestCase):
+    """
+    Test reading the flights in the update file
+    """
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.update_file = os.path.join(self.tmp_dir, 'flights.nc')
+
+        ds = nc.Dataset(self.update_file, 'w')
+        ds.createDimension('time', None)
+        ds.createDimension('y', 3)
+        ds.createDimension('x', 4)
+        ds.createVariable('time', 'f', ('time',))
+        ds.variables['time'].units = 'hours since 2018-01-01 00:00:00'
+        ds.variables['time'].calendar = 'standard'
+        ds.createVariable('x', 'f', ('x',))
+        ds.createVariable('y', 'f', ('y',))
+        ds.createVariable('depth', 'f', ('time', 'y', 'x'))
+        ds.variables['x'][:] = np.arange(4)
+        ds.variables['y'][:] = np.arange(3)
+        ds.variables['time'][:] = [24, 48, 72]
+        depth = np.ones((3, 3, 4)) * np.array([1, 2, 3])[:, None, None]
+        depth[1, 0, 0] = 500.0
+        ds.variables['depth'][:] = depth
+        ds.close()
+
+        self.tzinfo = pytz.timezone('MST')
+        self.myawsm = SimpleNamespace(
+            update_file=self.update_file, flight_numbers=[1, 2],
+            tzinfo=self.tzinfo, _logger=None,
+            end_date=pd.to_datetime('2018-02-01'),
+            config={'update depth': {'update_change_file': None}},
+            output_chunks=None, output_compression=0, output_shuffle=True,
+            output_significant_digits=None, output_dtype='float32',
+            active_layer=0.25, update_buffer=40,
+            update_interpolation='window', update_neighbors=10,
+            update_tile_size=0, update_processes=1,
+            topo=SimpleNamespace(ny=3, nx=4, mask=np.ones((3, 4))),
+            pathinit=self.tmp_dir, gitVersion='test', smrf_version='test')
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def test_flights(self):
+        """ Flights are filtered and the depths are read when needed """
+
+        updater = ingest_data.StateUpdater(self.myawsm)
+
+        self.assertEqual(list(updater.update_info.keys()), [1, 2])
+        for k, v in updater.update_info.items():
+            self.assertNotIn('depth', v)
+            self.assertEqual(updater.update_dates[v['date_time']], k)
+
+        dt = datetime(2018, 1, 3).replace(tzinfo=self.tzinfo)
+        self.assertIn(dt, updater.update_dates)
+
+        D = updater.read_depth(updater.update_info[2])
+        self.assertTrue(np.isnan(D[0, 0]))
+        np.testing.assert_array_equal(D[1:, :], 2.0)
+
+    def test_change_file(self):
+        """ Update changes are written once with the summaries """
+
+        change_file = os.path.join(self.tmp_dir, 'changes.nc')
+        self.myawsm.config['update depth']['update_change_file'] = change_file
+        self.myawsm.config['time'] = {'start_date': '2018-01-01 00:00:00',
+                                      'time_zone': 'MST'}
+        self.myawsm.topo.mask[0, :] = 0
+
+        updater = ingest_data.StateUpdater(self.myawsm)
+        self.assertEqual(updater.delta_ds.variables['swe_change'].chunking(),
+                         [1, 3, 4])
+
+        diff = np.zeros((3, 4))
+        diff[1:, 1] = 12.0
+        diff[0, 0] = 100.0
+        for k, v in updater.update_info.items():
+            updater.output_update_changes(diff * k, diff, diff * k,
+                                          v['date_time'], False)
+
+        # nothing is written until the updater is closed
+        self.assertEqual(len(updater.delta_ds.variables['time']), 0)
+        updater.close()
+        self.assertIsNone(updater.delta_ds)
+
+        ds = nc.Dataset(change_file)
+        np.testing.assert_array_equal(ds.variables['time'][:], [24, 48])
+        np.testing.assert_array_equal(ds.variables['pixels_changed'][:],
+                                      [2, 2])
+        np.testing.assert_allclose(ds.variables['basin_swe_change'][:],
+                                   [24.0/8, 48.0/8])
+        np.testing.assert_allclose(ds.variables['swe_change'][1, :],
+                                   diff * 2)
+        ds.close()
+
+
+if __name__ == '__main__':
+    unittest.main()